@@ -3,12 +3,48 @@ import glob
 import json
 import subprocess
 import threading
+from contextlib import asynccontextmanager
+import numpy as np
 from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from src.eval.infer_multi import ModelWrapper
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, FileResponse
+from src.eval.infer_multi import load_registered, predict_many
+from src.eval.inverse import inverse_design, REFINE
+from src.eval.dataset_index import DatasetIndex
+from src.eval.peaks import peak_list
+from src.eval.similarity import similarity_index
+from src.eval.spectra_grid import mlp_grid, mie_grid, mie_grid_size, downsample, to_bytes, axes_header, MAX_MIE_SPECTRA
+from src.eval.prediction_cache import PredictionCache
+from src.eval.telemetry import TimingMiddleware, timed, render_metrics
+from src.eval.shared_pack import attach as attach_pack
+from src.eval.traffic import RECORD_ENV, RecordingMiddleware, record_upload
+from src.eval.drift import DriftMonitor
 
-app = FastAPI(title="NanoOptics Prediction API")
+@asynccontextmanager
+async def lifespan(app):
+    # Warm the default model per worker at startup rather than at import, so
+    # importing api (tests, uvicorn's reloader/supervisor) loads nothing
+    try:
+        if os.path.exists(os.path.join(MODELS_DIR, "final_demo_model.json")):
+            get_model("final_demo_model")
+        elif os.path.exists(os.path.join(MODELS_DIR, "physics_pretrained.json")):
+            get_model("physics_pretrained")
+    except Exception as e:
+        print(f"Error loading default model: {e}")
+    global drift_monitor
+    try:
+        # Resumes snapshots of previous runs and persists from a background thread.
+        # Served peaks are compared with each model's own (stored) predictions on the training set
+        drift_monitor = DriftMonitor(BASE_DIR, snapshot_dir=DRIFT_DIR,
+                                     peak_reference=lambda name: get_dataset().predictions(get_model(name))["peak_nm"])
+        drift_monitor.start()
+    except OSError as e:
+        print(f"Drift monitoring disabled: {e}")
+    yield
+    if drift_monitor is not None:
+        drift_monitor.stop()
+
+app = FastAPI(title="NanoOptics Prediction API", lifespan=lifespan)
 
 # Allow CORS for frontend development
 app.add_middleware(
@@ -17,42 +53,52 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Grid-Shape", "X-Grid-Axes"],
 )
+# Outermost: per-stage Server-Timing header, request histograms, in-flight gauge
+app.add_middleware(TimingMiddleware)
+# Opt-in traffic log for src/bench/replay.py; outside TimingMiddleware so it sees Server-Timing
+if os.environ.get(RECORD_ENV):
+    app.add_middleware(RecordingMiddleware, log_dir=os.environ[RECORD_ENV])
 
 # --- Model Management ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MODELS_DIR = os.path.join(os.path.dirname(__file__), "models", "registered")
 loaded_models = {}
+model_signatures = {}
+prediction_cache = PredictionCache(maxsize=4096)
+# Set by serve.py: weights, normalization and the OOD gate memory-mapped from one
+# pack shared by all workers. None when run as plain `uvicorn api:app`.
+shared_pack = attach_pack()
+# Feature/peak distribution of served requests vs. training (see GET /drift); set at startup
+DRIFT_DIR = os.path.join(BASE_DIR, "outputs", "drift")
+drift_monitor = None
+
+def _model_signature(json_path, model_path):
+    return (os.stat(json_path).st_mtime_ns, os.stat(model_path).st_mtime_ns)
 
 def get_model(model_name: str):
-    if model_name in loaded_models:
-        return loaded_models[model_name]
-    
-    # Try to load
     json_path = os.path.join(MODELS_DIR, f"{model_name}.json")
-    if not os.path.exists(json_path):
-        # Try finding ANY json if name is simple
-        pass
-
-    if os.path.exists(json_path):
-        with open(json_path) as f:
-            meta = json.load(f)
-        path = meta["path"]
-        if not os.path.isabs(path):
-            path = os.path.join(os.path.dirname(__file__), path)
-        print(f"Loading model {model_name} from {path}")
-        loaded_models[model_name] = ModelWrapper(path)
-        return loaded_models[model_name]
+    if model_name in loaded_models:
+        wrapper = loaded_models[model_name]
+        try:
+            if _model_signature(json_path, wrapper.model_path) == model_signatures[model_name]:
+                return wrapper
+        except OSError:
+            pass
+        # Registry entry or checkpoint changed on disk: hot-swap and drop stale predictions
+        print(f"Model {model_name} changed on disk, reloading")
+        del loaded_models[model_name]
+        prediction_cache.invalidate(model_name)
     
-    raise HTTPException(status_code=404, detail=f"Model {model_name} not found")
-
-# Initialize default model
-try:
-    if os.path.exists(os.path.join(MODELS_DIR, "final_demo_model.json")):
-        get_model("final_demo_model")
-    elif os.path.exists(os.path.join(MODELS_DIR, "physics_pretrained.json")):
-        get_model("physics_pretrained")
-except Exception as e:
-    print(f"Error loading default model: {e}")
+    try:
+        # Attaches to the shared pack unless this entry changed since serve.py built it
+        wrapper = load_registered(model_name, models_dir=MODELS_DIR, cache=prediction_cache, shared=shared_pack)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    loaded_models[model_name] = wrapper
+    model_signatures[model_name] = _model_signature(json_path, wrapper.model_path)
+    return wrapper
 
 # --- Endpoints ---
 
@@ -69,34 +115,314 @@ def list_models():
                 models.append(json.load(jf))
     return {"models": models}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    # Prometheus text format
+    stats = prediction_cache.stats()
+    cache_lines = [
+        "# HELP nanooptics_prediction_cache_hits_total Prediction cache hits",
+        "# TYPE nanooptics_prediction_cache_hits_total counter",
+        f"nanooptics_prediction_cache_hits_total {stats['hits']}",
+        "# HELP nanooptics_prediction_cache_misses_total Prediction cache misses",
+        "# TYPE nanooptics_prediction_cache_misses_total counter",
+        f"nanooptics_prediction_cache_misses_total {stats['misses']}",
+        "# HELP nanooptics_prediction_cache_entries Prediction cache size",
+        "# TYPE nanooptics_prediction_cache_entries gauge",
+        f"nanooptics_prediction_cache_entries {stats['size']}",
+        "# HELP nanooptics_models_loaded Models currently loaded",
+        "# TYPE nanooptics_models_loaded gauge",
+        f"nanooptics_models_loaded {len(loaded_models)}",
+    ]
+    if drift_monitor is not None:
+        report = drift_monitor.report()
+        cache_lines += [
+            "# HELP nanooptics_drift_score Max recent-window PSI of served features/peaks vs. training",
+            "# TYPE nanooptics_drift_score gauge",
+            f"nanooptics_drift_score {report['drift_score'] if report['drift_score'] is not None else 'NaN'}",
+            "# HELP nanooptics_drift_psi Recent-window PSI vs. training per quantity",
+            "# TYPE nanooptics_drift_psi gauge",
+        ]
+        for name, q in report["quantities"].items():
+            value = q["psi_recent"] if q["psi_recent"] is not None else "NaN"
+            cache_lines.append(f'nanooptics_drift_psi{{quantity="{name}"}} {value}')
+    return render_metrics(cache_lines)
+
+@app.get("/drift")
+def drift(histograms: bool = Query(False, description="Include live, recent-window and training histograms")):
+    # Uploaded-image features and predicted peaks vs. the training distribution
+    if drift_monitor is None:
+        raise HTTPException(status_code=503, detail="Drift monitor not running")
+    return drift_monitor.report(histograms=histograms)
+
+@app.get("/cache/stats")
+def cache_stats():
+    return prediction_cache.stats()
+
+@app.get("/models/{model_name}/basis")
+def get_model_basis(model_name: str):
+    # Lets clients that request output=coefficients reconstruct spectra themselves
+    wrapper = get_model(model_name)
+    if wrapper.basis is None:
+        raise HTTPException(status_code=404, detail=f"Model {model_name} has no spectral basis")
+    return {
+        "wavelengths": wrapper.wavelengths.tolist(),
+        "mean": wrapper.basis.mean.tolist(),
+        "components": wrapper.basis.components.tolist()
+    }
+
 @app.post("/predict")
 async def predict(
     file: UploadFile = File(...), 
-    model: str = Query("final_demo_model", description="Model name to use")
+    model: str = Query("final_demo_model", description="Model name to use"),
+    output: str = Query("spectrum", description="spectrum | coefficients | both"),
+    neighbors: int = Query(0, ge=0, le=50, description="Also return the k nearest training samples (by features)")
 ):
-    temp_filename = ""
     try:
         wrapper = get_model(model)
         
-        contents = await file.read()
-        temp_filename = f"temp_{file.filename}"
-        with open(temp_filename, "wb") as f:
-            f.write(contents)
+        with timed("upload"):
+            # Decoded straight from memory; nothing is written to disk
+            contents = await file.read()
+        record_upload(file.filename, contents)
             
-        res = wrapper.predict(image_path=temp_filename)
+        if output not in ("spectrum", "coefficients", "both"):
+            raise HTTPException(status_code=400, detail=f"Unknown output '{output}'")
+        if output != "spectrum" and wrapper.basis is None:
+            raise HTTPException(status_code=400, detail=f"Model {model} has no spectral basis; use output=spectrum")
+
+        res = wrapper.predict(image_bytes=contents)
+        if drift_monitor is not None:
+            with timed("drift"):
+                drift_monitor.observe(res["features"], {model: res["peak_nm"]}, res["ood"])
         
-        return {
-            "wavelengths": res["wavelengths"].tolist(),
-            "spectrum": res["spectrum"].tolist(),
+        body = {
             "peak": res["peak_nm"],
             "fwhm": res["fwhm_nm"],
-            "features": {
-                "mean_diameter": float(res["features"][0]),
-                "std_diameter": float(res["features"][1]),
-                "count": int(res["features"][2]),
-                "aspect_ratio": float(res["features"][3])
+            # Every resolved band, main peak first (center_nm, height, prominence, fwhm_nm, ...)
+            "peaks": res["peaks"],
+            "features": _features_body(res["features"]),
+            "model_used": model,
+            # "surrogate" (the network) or "mie" (exact solver for out-of-distribution inputs)
+            "path": res["path"],
+            "ood": res["ood"]
+        }
+        if neighbors:
+            with timed("neighbors"):
+                body["neighbors"] = _neighbors_body(*similarity_index(BASE_DIR).by_features(res["features"], neighbors))
+        with timed("serialize"):
+            if output in ("spectrum", "both"):
+                body["wavelengths"] = res["wavelengths"].tolist()
+                body["spectrum"] = res["spectrum"].tolist()
+            if "std" in res:
+                # Ensemble models: spread across members (bands only alongside the spectrum)
+                body["uncertainty"] = _uncertainty_body(res, bands=output in ("spectrum", "both"))
+            if output in ("coefficients", "both"):
+                # Reconstruct with GET /models/{model}/basis: spectrum = mean + coefficients @ components
+                body["coefficients"] = res["coefficients"].tolist()
+            # Render here so JSON encoding is part of the timed stage
+            return JSONResponse(content=body)
+
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/predict/compare")
+async def predict_compare(
+    file: UploadFile = File(...),
+    models: str = Query("all", description="Comma-separated model names or 'all'")
+):
+    # One upload + one segmentation, then every requested model on the same features
+    try:
+        if models == "all":
+            names = [os.path.splitext(os.path.basename(f))[0] for f in sorted(glob.glob(os.path.join(MODELS_DIR, "*.json")))]
+        else:
+            names = [n.strip() for n in models.split(",") if n.strip()]
+        # A model that fails to load is reported in errors like one that fails to predict
+        wrappers, errors, missing = {}, {}, 0
+        for n in names:
+            try:
+                wrappers[n] = get_model(n)
+            except HTTPException as he:
+                errors[n] = he.detail
+                missing += he.status_code == 404
+            except Exception as e:
+                errors[n] = str(e)
+        if not wrappers:
+            raise HTTPException(status_code=404 if names and missing == len(names) else 500,
+                                detail=f"No model could be loaded: {errors}")
+
+        with timed("upload"):
+            contents = await file.read()
+        record_upload(file.filename, contents)
+
+        results, predict_errors = predict_many(wrappers, image_bytes=contents)
+        errors.update(predict_errors)
+        if not results:
+            raise HTTPException(status_code=500, detail=f"All models failed: {errors}")
+
+        first = next(iter(results.values()))
+        if drift_monitor is not None:
+            with timed("drift"):
+                drift_monitor.observe(first["features"], {name: res["peak_nm"] for name, res in results.items()}, first["ood"])
+        return {
+            "wavelengths": first["wavelengths"].tolist(),
+            "features": _features_body(first["features"]),
+            "results": {
+                name: {
+                    "spectrum": res["spectrum"].tolist(),
+                    "peak": res["peak_nm"],
+                    "fwhm": res["fwhm_nm"],
+                    "peaks": res["peaks"],
+                    "path": res["path"],
+                    "ood": res["ood"],
+                    **({"uncertainty": _uncertainty_body(res)} if "std" in res else {})
+                }
+                for name, res in results.items()
             },
-            "model_used": model
+            "errors": errors
+        }
+
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+MAX_INVERSE_CANDIDATES = 250_000
+
+# Plain def: FastAPI runs it in the threadpool, so a long search does not stall other requests
+@app.post("/inverse")
+def inverse(payload: dict, model: str = Query("final_demo_model", description="Model name to use")):
+    # payload: {target_spectrum: [251 floats], wavelengths: [...], peak_nm, peak_tol, fwhm_nm, fwhm_tol, k, n_candidates}
+    try:
+        wrapper = get_model(model)
+
+        target = payload.get("target_spectrum")
+        if target is not None:
+            target = np.asarray(target, dtype=np.float32)
+            if payload.get("wavelengths") is not None:
+                # Resample onto the model's grid
+                target = np.interp(wrapper.wavelengths, np.asarray(payload["wavelengths"], dtype=np.float32), target)
+        n_candidates = int(payload.get("n_candidates", 100_000))
+        if not 1 <= n_candidates <= MAX_INVERSE_CANDIDATES:
+            raise HTTPException(status_code=400, detail=f"n_candidates must be between 1 and {MAX_INVERSE_CANDIDATES:,}")
+        # The top k are picked from the refined candidates
+        k = int(payload.get("k", 5))
+        max_k = min(REFINE, n_candidates)
+        if not 1 <= k <= max_k:
+            raise HTTPException(status_code=400, detail=f"k must be between 1 and {max_k}")
+
+        out = inverse_design(
+            wrapper,
+            target=target,
+            peak_nm=payload.get("peak_nm"),
+            fwhm_nm=payload.get("fwhm_nm"),
+            peak_tol=float(payload.get("peak_tol", 5.0)),
+            fwhm_tol=float(payload.get("fwhm_tol", 10.0)),
+            k=k,
+            n_candidates=n_candidates,
+            seed=int(payload.get("seed", 0))
+        )
+        with timed("serialize"):
+            return JSONResponse(content={
+                "wavelengths": out["wavelengths"].tolist(),
+                "results": [
+                    {
+                        "features": _features_body(list(r["features"].values())),
+                        "spectrum": r["spectrum"].tolist(),
+                        "peak": r["peak_nm"],
+                        "fwhm": r["fwhm_nm"],
+                        "score": r["score"],
+                        "ood": r["ood"]
+                    }
+                    for r in out["results"]
+                ],
+                "n_candidates": out["n_candidates"],
+                "search_ms": round(out["total_ms"], 1),
+                "model_used": model
+            })
+
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Plain def (threadpool): up to MAX_SPECTRA spectra (MAX_MIE_SPECTRA for Mie) are built and serialized here
+@app.post("/grid")
+def spectra_grid(payload: dict, model: str = Query("final_demo_model", description="Model name (source=mlp)")):
+    # payload: {source: "mlp"|"mie", axes: {name: value | [values] | {start, stop, num, log}}, downsample, format, dtype}
+    # Returns a binary .npz (spectra, wavelengths, axis values[, in_range]) or .npy (spectra only)
+    try:
+        source = payload.get("source", "mlp")
+        fmt = payload.get("format", "npz")
+        axes = payload.get("axes", {})
+        # Reject oversized Mie grids before any spectra are computed
+        if source == "mie":
+            n_mie = mie_grid_size(axes)
+            if n_mie > MAX_MIE_SPECTRA:
+                raise HTTPException(status_code=400, detail=f"Mie grid has {n_mie:,} points, limit is {MAX_MIE_SPECTRA:,}")
+        with timed("grid"):
+            if source == "mie":
+                grid = mie_grid(axes)
+            elif source == "mlp":
+                grid = mlp_grid(get_model(model), axes)
+            else:
+                raise HTTPException(status_code=400, detail=f"Unknown source '{source}'")
+            grid = downsample(grid, int(payload.get("downsample", 1)))
+        with timed("serialize"):
+            content = to_bytes(grid, fmt, payload.get("dtype", "float32"))
+        return Response(
+            content=content,
+            media_type="application/octet-stream",
+            headers={
+                "X-Grid-Shape": ",".join(str(n) for n in grid["spectra"].shape),
+                "X-Grid-Axes": axes_header(grid) + ",wavelength",
+                "Content-Disposition": f'attachment; filename="grid_{source}.{fmt}"'
+            }
+        )
+
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- Similar Training Samples ---
+
+def _neighbors_body(dist, ids, spectrum=True):
+    index = similarity_index(BASE_DIR)
+    return [index.describe(i, d, spectrum=spectrum) for d, i in zip(dist[0], ids[0])]
+
+@app.post("/similar/spectrum")
+async def similar_by_spectrum(payload: dict):
+    # payload: {spectrum: [...], wavelengths: [...] (optional, resampled onto the index grid), k, include_spectra}
+    try:
+        if payload.get("spectrum") is None:
+            raise HTTPException(status_code=400, detail="Missing 'spectrum'")
+        k = int(payload.get("k", 5))
+        if not 1 <= k <= 50:
+            raise HTTPException(status_code=400, detail="k must be between 1 and 50")
+        index = similarity_index(BASE_DIR)
+        with timed("neighbors"):
+            dist, ids = index.by_spectrum(payload["spectrum"], k=k, wavelengths=payload.get("wavelengths"))
+        return {
+            "wavelengths": index.wavelengths.tolist(),
+            "neighbors": _neighbors_body(dist, ids, spectrum=payload.get("include_spectra", True))
         }
 
     except ValueError as ve:
@@ -107,10 +433,111 @@ async def predict(
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if temp_filename and os.path.exists(temp_filename):
-            try: os.remove(temp_filename)
-            except: pass
+
+# --- Dataset Browsing ---
+
+dataset_index = None
+
+def get_dataset():
+    # Built on first use; reads morphology_features.csv only
+    global dataset_index
+    if dataset_index is None:
+        dataset_index = DatasetIndex(BASE_DIR)
+    return dataset_index
+
+def _dataset_row(item_id: int):
+    dataset = get_dataset()
+    if not 0 <= item_id < len(dataset):
+        raise HTTPException(status_code=404, detail=f"No dataset item {item_id}")
+    return dataset
+
+@app.get("/dataset")
+def list_dataset(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(24, ge=1, le=200),
+    q: str = Query(None, description="Filter by image path substring"),
+    model: str = Query(None, description="Also return each item's predicted peak from this model's stored index")
+):
+    dataset = get_dataset()
+    total, items = dataset.page(offset, limit, q)
+    if model:
+        preds = dataset.predictions(get_model(model))
+        for item in items:
+            item["peak"] = float(preds["peak_nm"][item["id"]])
+    return {"total": total, "offset": offset, "limit": limit, "items": items}
+
+@app.get("/dataset/{item_id}/thumbnail")
+def dataset_thumbnail(item_id: int):
+    dataset = _dataset_row(item_id)
+    try:
+        path = dataset.thumbnail(item_id)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=86400"})
+
+@app.get("/dataset/{item_id}/image")
+def dataset_image(item_id: int):
+    dataset = _dataset_row(item_id)
+    path = dataset.image_path(item_id)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail=f"Image not found: {dataset.paths[item_id]}")
+    return FileResponse(path)
+
+@app.get("/dataset/{item_id}/similar")
+def dataset_similar(
+    item_id: int,
+    by: str = Query("features", description="features | spectrum"),
+    k: int = Query(5, ge=1, le=50)
+):
+    # The item itself is the first hit (distance 0), so ask for one more and drop it
+    _dataset_row(item_id)
+    index = similarity_index(BASE_DIR)
+    if by == "features":
+        dist, ids = index.by_features(index.features[item_id], k + 1)
+    elif by == "spectrum":
+        dist, ids = index.by_spectrum(index.spectra[item_id], k + 1)
+    else:
+        raise HTTPException(status_code=400, detail=f"Unknown 'by' value '{by}'")
+    keep = ids[0] != item_id
+    return {"id": item_id, "by": by, "neighbors": _neighbors_body(dist[:, keep][:, :k], ids[:, keep][:, :k])}
+
+@app.get("/dataset/{item_id}/prediction")
+def dataset_prediction(item_id: int, model: str = Query("final_demo_model", description="Model name to use")):
+    # Same body as /predict, served from the stored per-model prediction index
+    dataset = _dataset_row(item_id)
+    wrapper = get_model(model)
+    preds = dataset.predictions(wrapper)
+    return {
+        "peak": float(preds["peak_nm"][item_id]),
+        "fwhm": float(preds["fwhm_nm"][item_id]),
+        "peaks": peak_list(preds["peaks"], item_id),
+        "features": _features_body(dataset.features[item_id]),
+        "model_used": model,
+        "path": str(preds["path"][item_id]),
+        "ood": wrapper.gate.describe(preds["ood"], item_id) if preds["ood"] is not None else None,
+        "wavelengths": preds["wavelengths"].tolist(),
+        "spectrum": preds["spectra"][item_id].tolist()
+    }
+
+def _uncertainty_body(res, bands=True):
+    body = {
+        "n_members": res["n_members"],
+        "peak_std": float(res["peak_nm_std"])
+    }
+    if bands:
+        body["std"] = res["std"].tolist()
+        body["lower"] = res["lower"].tolist()
+        body["upper"] = res["upper"].tolist()
+        body["band_percentiles"] = list(res["band"])
+    return body
+
+def _features_body(feats):
+    return {
+        "mean_diameter": float(feats[0]),
+        "std_diameter": float(feats[1]),
+        "count": int(feats[2]),
+        "aspect_ratio": float(feats[3])
+    }
 
 # --- Evaluation Endpoints ---
 
@@ -0,0 +1,43 @@
+import os
+import time
+import argparse
+
+from src.eval.shared_pack import PACK_ENV, build_pack
+from src.eval.traffic import RECORD_ENV
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the API with several workers sharing one memory-mapped copy of the models")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pack", type=str, default="outputs/shared_pack",
+                        help="Directory the parent writes weights, normalization and the OOD gate to")
+    parser.add_argument("--record", type=str, default=None,
+                        help="Append every request to a traffic log in this directory (replay with src/bench/replay.py)")
+    args = parser.parse_args()
+
+    import uvicorn
+    import api
+
+    # Load every registered model once here (hashing, the OOD gate's k-NN pass)
+    # and write the arrays out; workers then only mmap them, so startup does not
+    # grow with the number of workers
+    t0 = time.perf_counter()
+    names = sorted(os.path.splitext(f)[0] for f in os.listdir(api.MODELS_DIR) if f.endswith(".json"))
+    wrappers, signatures = {}, {}
+    for name in names:
+        try:
+            wrappers[name] = api.get_model(name)
+            signatures[name] = list(api.model_signatures[name])
+        except Exception as e:
+            print(f"  {name}: not packed ({e})")
+    print(f"Loaded {len(wrappers)} models in {(time.perf_counter() - t0) * 1000:.0f} ms")
+    build_pack(os.path.abspath(args.pack), wrappers, signatures)
+
+    os.environ[PACK_ENV] = os.path.abspath(args.pack)
+    if args.record:
+        os.environ[RECORD_ENV] = os.path.abspath(args.record)
+    uvicorn.run("api:app", host=args.host, port=args.port, workers=args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+import numpy as np
+import cv2
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+BENCH_DIR = os.path.join(ROOT_DIR, "outputs", "bench")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+BATCH_SIZES = [1, 4, 16, 64, 256, 1024, 4096]
+ALL_STAGES = ["load_gray", "segmentation", "simulate_spectrum", "predict", "api_predict", "evaluate_models"]
+
+def time_stage(fn, warmup=3, repeats=20, items=1):
+    """
+    Run fn() `warmup` times untimed, then `repeats` timed runs.
+    Times are reported per item (fn processes `items` inputs per call).
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000 / items)
+    times = np.array(times)
+    return {
+        "median_ms": float(np.median(times)),
+        "mean_ms": float(times.mean()),
+        "min_ms": float(times.min()),
+        "p95_ms": float(np.percentile(times, 95)),
+        "std_ms": float(times.std()),
+        "repeats": repeats,
+        "items": items
+    }
+
+def fixed_inputs(n_images):
+    """Deterministic inputs from data/subset: n 8-bit PNGs and every 16-bit TIFF."""
+    eight_bit = sorted(glob.glob(os.path.join(ROOT_DIR, "data", "subset", "dopad", "*.png")))[:n_images]
+    sixteen_bit = []
+    for p in sorted(glob.glob(os.path.join(ROOT_DIR, "data", "subset", "extra", "**", "*.tif"), recursive=True)):
+        img = cv2.imread(p, cv2.IMREAD_UNCHANGED)
+        if img is not None and img.dtype == np.uint16:
+            sixteen_bit.append(p)
+    return eight_bit, sixteen_bit[:n_images]
+
+# ---------- Stages ----------
+def bench_load_gray(args, eight_bit, sixteen_bit):
+    from src.features.extract_features import load_gray
+    # Multi-megapixel JPEGs exercise the reduced-resolution decode
+    large_jpeg = sorted(glob.glob(os.path.join(ROOT_DIR, "data", "subset", "extra", "**", "*.jpg"), recursive=True))[:args.n_images]
+    results = {}
+    for label, paths in [("load_gray_8bit", eight_bit), ("load_gray_16bit", sixteen_bit), ("load_gray_large_jpeg", large_jpeg)]:
+        if not paths:
+            print(f"  {label}: no inputs, skipped")
+            continue
+        results[label] = time_stage(lambda: [load_gray(p) for p in paths], args.warmup, args.repeats, len(paths))
+    return results
+
+def bench_segmentation(args, eight_bit, sixteen_bit):
+    from src.features.extract_features import load_gray
+    from src.eval.infer_multi import segment_features
+    images = [load_gray(p) for p in eight_bit]
+
+    def run():
+        for img in images:
+            try:
+                segment_features(img)
+            except ValueError:
+                pass  # "No particles detected" is a valid outcome for timing
+    return {"segmentation": time_stage(run, args.warmup, args.repeats, len(images))}
+
+def bench_simulate_spectrum(args, eight_bit, sixteen_bit):
+    from src.simulation.generate_spectra import simulate_spectrum
+    diameters = [10.0, 25.0, 50.0, 100.0]
+    return {"simulate_spectrum": time_stage(lambda: [simulate_spectrum(d) for d in diameters],
+                                            max(1, args.warmup // 3), max(3, args.repeats // 4), len(diameters))}
+
+def bench_predict(args, eight_bit, sixteen_bit):
+    from src.eval.infer_multi import ModelWrapper
+    model_path = os.path.join(ROOT_DIR, "models", "registered", "final_demo_model.pth")
+    rng = np.random.default_rng(0)
+    results = {}
+    for backend in args.backends.split(","):
+        wrapper = ModelWrapper(model_path, backend=backend)
+        for bs in BATCH_SIZES:
+            feats = (rng.standard_normal((bs, 4)) * wrapper.X_std + wrapper.X_mean).astype(np.float32)
+            results[f"predict_{backend}_bs{bs}"] = time_stage(
+                lambda: wrapper.predict_batch(feats), args.warmup, args.repeats, 1
+            )
+            results[f"predict_{backend}_bs{bs}"]["per_sample_us"] = results[f"predict_{backend}_bs{bs}"]["median_ms"] * 1000 / bs
+    return results
+
+def bench_api_predict(args, eight_bit, sixteen_bit):
+    from fastapi.testclient import TestClient
+    import api
+    client = TestClient(api.app)
+    with open(eight_bit[0], "rb") as f:
+        contents = f.read()
+
+    def run():
+        # Cold cache: measure the full decode -> segment -> forward -> JSON path
+        api.prediction_cache.invalidate()
+        r = client.post("/predict", files={"file": (os.path.basename(eight_bit[0]), contents)})
+        r.raise_for_status()
+    return {"api_predict": time_stage(run, args.warmup, args.repeats, 1)}
+
+def bench_evaluate_models(args, eight_bit, sixteen_bit):
+    env = os.environ.copy()
+    env["PYTHONPATH"] = ROOT_DIR + (os.pathsep + env["PYTHONPATH"] if "PYTHONPATH" in env else "")
+    outdir = tempfile.mkdtemp(prefix="bench_eval_")
+    cmd = [sys.executable, os.path.join(ROOT_DIR, "src", "eval", "evaluate_models.py"),
+           "--data", os.path.join(ROOT_DIR, "data", "experimental"), "--outdir", outdir]
+
+    def run():
+        subprocess.run(cmd, env=env, cwd=ROOT_DIR, check=True, stdout=subprocess.DEVNULL)
+    return {"evaluate_models": time_stage(run, 0, max(1, args.repeats // 10), 1)}
+
+STAGE_FUNCS = {
+    "load_gray": bench_load_gray,
+    "segmentation": bench_segmentation,
+    "simulate_spectrum": bench_simulate_spectrum,
+    "predict": bench_predict,
+    "api_predict": bench_api_predict,
+    "evaluate_models": bench_evaluate_models,
+}
+
+# ---------- Baseline comparison ----------
+def compare(results, baseline, threshold):
+    """Return rows for every stage present in both runs; a stage regresses if its median grew > threshold."""
+    rows = []
+    for name, stats in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            continue
+        ratio = stats["median_ms"] / base["median_ms"] if base["median_ms"] > 0 else float("inf")
+        rows.append({
+            "stage": name,
+            "baseline_ms": base["median_ms"],
+            "current_ms": stats["median_ms"],
+            "ratio": ratio,
+            "regression": ratio > 1 + threshold
+        })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the TEM -> spectrum pipeline stage by stage")
+    parser.add_argument("--stages", type=str, default=",".join(ALL_STAGES), help="Comma-separated subset of: " + ", ".join(ALL_STAGES))
+    parser.add_argument("--n_images", type=int, default=8, help="Fixed inputs per image stage")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--backends", type=str, default="numpy", help="ModelWrapper backends for the predict stage (numpy,torch)")
+    parser.add_argument("--out", type=str, default=None, help="Result JSON (default: outputs/bench/<run_id>.json)")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE, help="Baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown that counts as a regression")
+    parser.add_argument("--save_baseline", action="store_true", help="Also write this run as the new baseline")
+    parser.add_argument("--fail_on_regression", action="store_true", help="Exit with status 1 if any stage regressed")
+    args = parser.parse_args()
+
+    os.chdir(ROOT_DIR)
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    eight_bit, sixteen_bit = fixed_inputs(args.n_images)
+    print(f"Inputs: {len(eight_bit)} 8-bit, {len(sixteen_bit)} 16-bit images")
+
+    results = {}
+    for stage in args.stages.split(","):
+        print(f"Running {stage}...")
+        results.update(STAGE_FUNCS[stage](args, eight_bit, sixteen_bit))
+
+    run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report = {
+        "run_id": run_id,
+        "created_at": datetime.now().isoformat(),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__
+        },
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "inputs": {"8bit": [os.path.relpath(p, ROOT_DIR) for p in eight_bit],
+                   "16bit": [os.path.relpath(p, ROOT_DIR) for p in sixteen_bit]},
+        "results": results
+    }
+
+    print(f"\n{'stage':<32}{'median ms':>12}{'p95 ms':>12}")
+    for name, stats in results.items():
+        print(f"{name:<32}{stats['median_ms']:>12.4f}{stats['p95_ms']:>12.4f}")
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.threshold)
+        report["comparison"] = {"baseline": os.path.relpath(args.baseline, ROOT_DIR), "threshold": args.threshold, "stages": rows}
+        regressions = [r for r in rows if r["regression"]]
+        print(f"\nvs. baseline {baseline.get('run_id')} (threshold +{args.threshold:.0%}):")
+        for r in rows:
+            flag = "  REGRESSION" if r["regression"] else ""
+            print(f"{r['stage']:<32}{r['baseline_ms']:>12.4f} -> {r['current_ms']:>10.4f}  x{r['ratio']:.2f}{flag}")
+
+    out = args.out or os.path.join(BENCH_DIR, f"{run_id}.json")
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nSaved results to {out}")
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from src.eval.traffic import RECORD_ENV, read_log, blob_path
+
+def load_bodies(log_dir, records):
+    """Read each distinct request body once; records share them by hash."""
+    bodies = {}
+    for rec in records:
+        sha1 = rec["sha1"]
+        if sha1 and sha1 not in bodies:
+            with open(blob_path(log_dir, sha1), "rb") as f:
+                bodies[sha1] = f.read()
+    return bodies
+
+def build_request(rec, bodies):
+    url = rec["path"] + (f"?{rec['query']}" if rec["query"] else "")
+    kwargs = {}
+    if rec["filename"]:
+        kwargs["files"] = {"file": (rec["filename"], bodies[rec["sha1"]])}
+    elif rec["sha1"]:
+        kwargs["content"] = bodies[rec["sha1"]]
+        if rec["content_type"]:
+            kwargs["headers"] = {"content-type": rec["content_type"]}
+    return rec["method"], url, kwargs
+
+def cache_events(server_timing):
+    names = [part.split(";")[0].strip() for part in server_timing.split(",")]
+    return names.count("cache_hit"), names.count("cache_miss")
+
+async def replay(client, records, bodies, speed=1.0, concurrency=64):
+    """
+    Send every record at its original offset from the first arrival divided by
+    `speed` (speed <= 0: all at once), with at most `concurrency` in flight.
+    Latency is measured from the scheduled time, so queueing behind the
+    concurrency limit counts, as it would for a real client.
+    """
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(concurrency)
+    results = []
+    start = loop.time()
+    first = records[0]["arrival"]
+
+    async def one(rec, due):
+        method, url, kwargs = build_request(rec, bodies)
+        async with sem:
+            sent = loop.time()
+            try:
+                r = await client.request(method, url, **kwargs)
+                status, timing = r.status_code, r.headers.get("server-timing", "")
+            except Exception as e:
+                status, timing = 0, ""
+                print(f"{method} {url}: {e}")
+            done = loop.time()
+        hits, misses = cache_events(timing)
+        results.append({"path": rec["path"], "status": status, "latency": done - due, "service": done - sent,
+                        "lag": sent - due, "hits": hits, "misses": misses, "recorded": rec["latency"]})
+
+    tasks = []
+    for rec in records:
+        due = start + (rec["arrival"] - first) / speed if speed > 0 else start
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(rec, max(due, start))))
+    await asyncio.gather(*tasks)
+    return results, loop.time() - start
+
+def summarize(results, wall):
+    def stats(rows):
+        lat = np.array([r["latency"] for r in rows]) * 1000
+        recorded = np.array([r["recorded"] for r in rows]) * 1000
+        hits = sum(r["hits"] for r in rows)
+        lookups = hits + sum(r["misses"] for r in rows)
+        return {
+            "requests": len(rows),
+            "errors": sum(1 for r in rows if not 200 <= r["status"] < 400),
+            "p50_ms": float(np.percentile(lat, 50)),
+            "p90_ms": float(np.percentile(lat, 90)),
+            "p99_ms": float(np.percentile(lat, 99)),
+            "max_ms": float(lat.max()),
+            "recorded_p50_ms": float(np.percentile(recorded, 50)),
+            "recorded_p99_ms": float(np.percentile(recorded, 99)),
+            "cache_hit_rate": hits / lookups if lookups else None
+        }
+
+    summary = {"wall_s": wall, "throughput_rps": len(results) / wall if wall > 0 else float("inf"),
+               "max_lag_ms": max(r["lag"] for r in results) * 1000, "all": stats(results), "paths": {}}
+    for path in sorted({r["path"] for r in results}):
+        summary["paths"][path] = stats([r for r in results if r["path"] == path])
+    return summary
+
+def print_summary(summary):
+    print(f"{summary['all']['requests']} requests in {summary['wall_s']:.2f} s: "
+          f"{summary['throughput_rps']:.1f} req/s, max dispatch lag {summary['max_lag_ms']:.1f} ms")
+    print(f"{'path':<32}{'n':>7}{'err':>5}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'rec p50':>9}{'rec p99':>9}{'hit%':>7}")
+    for path, s in [("(all)", summary["all"])] + list(summary["paths"].items()):
+        hit = f"{s['cache_hit_rate'] * 100:.0f}" if s["cache_hit_rate"] is not None else "-"
+        print(f"{path[:31]:<32}{s['requests']:>7}{s['errors']:>5}{s['p50_ms']:>9.1f}{s['p90_ms']:>9.1f}"
+              f"{s['p99_ms']:>9.1f}{s['max_ms']:>9.1f}{s['recorded_p50_ms']:>9.1f}{s['recorded_p99_ms']:>9.1f}{hit:>7}")
+
+async def run(args, records, bodies):
+    import httpx
+
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits) as client:
+            return await replay(client, records, bodies, args.speed, args.concurrency)
+
+    # Offline: the app in this process through ASGI, no sockets; startup hooks run as under uvicorn
+    os.environ.pop(RECORD_ENV, None)  # never record the replay into a log
+    import api
+    transport = httpx.ASGITransport(app=api.app)
+    async with api.app.router.lifespan_context(api.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=timeout) as client:
+            return await replay(client, records, bodies, args.speed, args.concurrency)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded traffic log (serve.py --record) against the API")
+    parser.add_argument("log_dir", type=str)
+    parser.add_argument("--url", type=str, default=None, help="Server to drive, e.g. http://localhost:8000 (default: api.app in-process)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time compression: 1 = original arrival pattern, 4 = 4x faster, 0 = all at once")
+    parser.add_argument("--concurrency", type=int, default=64, help="Max requests in flight")
+    parser.add_argument("--paths", type=str, default=None, help="Comma-separated paths to replay (default: all)")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--out", type=str, default=None, help="Also write the summary as JSON")
+    args = parser.parse_args()
+
+    records = read_log(args.log_dir)
+    if args.paths:
+        keep = {p.strip() for p in args.paths.split(",")}
+        records = [r for r in records if r["path"] in keep]
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print(f"No requests to replay in {args.log_dir}")
+        return
+    bodies = load_bodies(args.log_dir, records)
+    span = records[-1]["arrival"] - records[0]["arrival"]
+    print(f"Replaying {len(records)} requests ({len(bodies)} distinct bodies, {span:.1f} s recorded) "
+          f"at {args.speed:g}x against {args.url or 'api.app (in-process)'}")
+
+    t0 = time.perf_counter()
+    results, wall = asyncio.run(run(args, records, bodies))
+    summary = summarize(results, wall)
+    summary.update(speed=args.speed, concurrency=args.concurrency, target=args.url or "in-process",
+                   recorded_span_s=span, total_s=time.perf_counter() - t0)
+    print_summary(summary)
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Saved {args.out}")
+
+if __name__ == "__main__":
+    main()
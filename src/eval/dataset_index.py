@@ -0,0 +1,222 @@
+import os
+import sys
+import csv
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from src.features.decode import load_gray
+from src.eval.peaks import PEAK_FIELDS
+
+THUMB_SIZE = 160
+# FeatureGate.check() arrays kept in the prediction stores
+OOD_KEYS = ("flagged", "score", "out_of_range")
+
+class DatasetIndex:
+    """
+    Browsable view of the training set: one row per line of
+    morphology_features.csv. Thumbnails are written once to
+    data/processed/thumbnails and predictions for each model are stored in
+    data/processed/dataset_predictions/<model>.npz, rebuilt only when the
+    checkpoint or the feature table changes.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.csv_path = os.path.join(base_dir, "data", "processed", "morphology_features.csv")
+        self.thumb_dir = os.path.join(base_dir, "data", "processed", "thumbnails")
+        self.pred_dir = os.path.join(base_dir, "data", "processed", "dataset_predictions")
+
+        # csv module rather than pandas: this is loaded by the API process
+        with open(self.csv_path, newline="") as f:
+            rows = list(csv.DictReader(f))
+        self.paths = [r["image_path"] for r in rows]
+        self.features = np.array([[float(r["mean_diam_px"]), float(r["std_diam_px"]),
+                                   float(r["particle_count"]), float(r["mean_aspect"])] for r in rows], dtype=np.float32)
+        self.features_hash = hashlib.sha1(self.features.tobytes()).hexdigest()
+        self._predictions = {}
+        # One build per model at a time; concurrent callers wait for it and reuse the result
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def item(self, i):
+        path = self.paths[i]
+        f = self.features[i]
+        return {
+            "id": i,
+            "name": os.path.basename(path),
+            "folder": os.path.basename(os.path.dirname(path)),
+            "has_image": os.path.exists(self.image_path(i)),
+            "features": {
+                "mean_diameter": float(f[0]),
+                "std_diameter": float(f[1]),
+                "count": int(f[2]),
+                "aspect_ratio": float(f[3])
+            }
+        }
+
+    def page(self, offset=0, limit=24, q=None):
+        """(total matching, items) for rows whose path contains q (case-insensitive)."""
+        ids = range(len(self))
+        if q:
+            q = q.lower()
+            ids = [i for i in ids if q in self.paths[i].lower()]
+        return len(ids), [self.item(i) for i in list(ids)[offset:offset + limit]]
+
+    def image_path(self, i):
+        path = self.paths[i]
+        return path if os.path.isabs(path) else os.path.join(self.base_dir, path)
+
+    # --- Thumbnails ---
+
+    def thumbnail_path(self, i):
+        # Keyed by the source path, so re-extracted CSVs with reordered rows keep their cache
+        key = hashlib.sha1(self.paths[i].encode()).hexdigest()[:16]
+        return os.path.join(self.thumb_dir, f"{key}_{THUMB_SIZE}.jpg")
+
+    def thumbnail(self, i):
+        """Path to the cached JPEG thumbnail, generated on first use or when the source is newer."""
+        out = self.thumbnail_path(i)
+        src = self.image_path(i)
+        try:
+            if os.path.getmtime(out) >= os.path.getmtime(src):
+                return out
+        except OSError:
+            pass
+        img = load_gray(src, target_size=THUMB_SIZE)
+        h, w = img.shape
+        scale = THUMB_SIZE / max(h, w)
+        if scale < 1:
+            img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+        os.makedirs(self.thumb_dir, exist_ok=True)
+        ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        if not ok:
+            raise ValueError(f"Could not encode thumbnail for {src}")
+        # Write-then-rename so a concurrent reader never sees a partial file
+        # Unique per thread: API routes run in a threadpool and may build the same file at once
+        tmp = out + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(buf.tobytes())
+        os.replace(tmp, out)
+        return out
+
+    def build_thumbnails(self, workers=8):
+        def work(i):
+            try:
+                self.thumbnail(i)
+                return None
+            except (OSError, ValueError) as e:
+                return f"{self.paths[i]}: {e}"
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return [e for e in pool.map(work, range(len(self))) if e]
+
+    # --- Precomputed predictions ---
+
+    def predictions(self, wrapper):
+        """
+        Stored batch predictions of `wrapper` for every row:
+        {spectra (N, W), peak_nm, fwhm_nm, peaks, path, ood, wavelengths}, with
+        peaks as returned by src.eval.peaks.analyze and ood the gate's check()
+        (None when the model skips it).
+        """
+        name = wrapper.model_id
+        cached = self._predictions.get(name)
+        if cached is not None and self._fresh(cached, wrapper):
+            return cached
+        with self._locks_guard:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            return self._load_or_build(name, wrapper)
+
+    def _load_or_build(self, name, wrapper):
+        cached = self._predictions.get(name)
+        if cached is not None and self._fresh(cached, wrapper):
+            return cached
+
+        store = os.path.join(self.pred_dir, f"{name}.npz")
+        if os.path.exists(store):
+            with np.load(store) as data:
+                cached = _unpack({k: data[k] for k in data.files})
+            if self._fresh(cached, wrapper):
+                self._predictions[name] = cached
+                return cached
+
+        # The whole dataset is one predict_batch call (~15 ms for 1.2k rows)
+        res = wrapper.predict_batch(self.features)
+        # npz is flat: per-peak arrays go in as peak_<field>, the OOD check as ood_<key>
+        stored = {
+            "spectra": np.asarray(res["spectra"], dtype=np.float32),
+            "peak_nm": res["peak_nm"],
+            "fwhm_nm": res["fwhm_nm"],
+            "n_peaks": res["peaks"]["count"],
+            "path": res["path"],
+            "wavelengths": res["wavelengths"],
+            "model_hash": np.array(wrapper.model_hash),
+            "ood_policy": np.array(wrapper.ood),
+            "features_hash": np.array(self.features_hash)
+        }
+        stored.update({f"peak_{f}": res["peaks"][f] for f in PEAK_FIELDS})
+        if res["ood"] is not None:
+            stored.update({f"ood_{k}": res["ood"][k] for k in OOD_KEYS})
+        os.makedirs(self.pred_dir, exist_ok=True)
+        tmp = store + f".{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmp, **stored)
+        os.replace(tmp, store)
+        cached = _unpack(stored)
+        self._predictions[name] = cached
+        return cached
+
+    def _fresh(self, cached, wrapper):
+        # Stores without per-peak arrays predate the multi-peak analysis; the OOD policy
+        # decides which rows are Mie spectra
+        return (cached["peaks"] is not None and str(cached["model_hash"]) == wrapper.model_hash
+                and str(cached.get("ood_policy")) == wrapper.ood
+                and str(cached["features_hash"]) == self.features_hash)
+
+def _unpack(stored):
+    """The flat npz arrays plus "peaks" and "ood" regrouped (None where the store lacks them)."""
+    cached = dict(stored)
+    cached["peaks"] = None
+    if all(f"peak_{f}" in stored for f in PEAK_FIELDS):
+        cached["peaks"] = {f: stored[f"peak_{f}"] for f in PEAK_FIELDS}
+        cached["peaks"]["count"] = stored["n_peaks"]
+    cached["ood"] = {k: stored[f"ood_{k}"] for k in OOD_KEYS} if "ood_flagged" in stored else None
+    return cached
+
+def main():
+    parser = argparse.ArgumentParser(description="Build dataset thumbnails and per-model prediction indexes for the API")
+    parser.add_argument("--models", type=str, default="all", help="Comma-separated registered model names or 'all'")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--skip_thumbnails", action="store_true")
+    args = parser.parse_args()
+
+    from src.eval.infer_multi import load_registered
+
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+    index = DatasetIndex(base_dir)
+    print(f"{len(index)} rows in {index.csv_path}")
+
+    if not args.skip_thumbnails:
+        failed = index.build_thumbnails(workers=args.workers)
+        print(f"Thumbnails in {index.thumb_dir} ({len(failed)} failed)")
+        for e in failed:
+            print("  ", e)
+
+    models_dir = os.path.join(base_dir, "models", "registered")
+    names = [os.path.splitext(f)[0] for f in sorted(os.listdir(models_dir)) if f.endswith(".json")] \
+        if args.models == "all" else [n.strip() for n in args.models.split(",")]
+    for name in names:
+        wrapper = load_registered(name, models_dir=models_dir)
+        preds = index.predictions(wrapper)
+        print(f"{name}: {len(preds['spectra'])} predictions -> {os.path.join(index.pred_dir, name + '.npz')}")
+
+if __name__ == "__main__":
+    main()
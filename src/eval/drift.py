@@ -0,0 +1,402 @@
+import os
+import glob
+import json
+import math
+import time
+import threading
+import numpy as np
+
+from src.eval.ood import FEATURE_NAMES, load_training_features
+from src.eval.similarity import source_hash
+
+# Features are binned in training-z units, peaks in nm; both with an underflow and overflow bin
+Z_RANGE = (-4.0, 4.0, 32)
+PEAK_RANGE = (300.0, 800.0, 100)
+# Population stability index bands commonly used for score monitoring
+PSI_WARNING = 0.1
+PSI_DRIFT = 0.25
+# PSI is scored on ~10 groups of fine bins holding equal training mass: with all
+# 34-102 fine bins, sampling noise alone reads as drift at a few hundred requests
+PSI_GROUPS = 10
+MIN_COUNT = 200
+
+class Sketch:
+    """
+    Running moments (Welford) and a fixed-bin histogram of one quantity.
+    observe() is O(1): the bins are uniform, so the index is arithmetic.
+    Sketches with the same bins merge exactly (merge()), which is how the
+    rolling window, worker snapshots and restarts are combined.
+    """
+
+    def __init__(self, lo, hi, n_bins):
+        self.lo = lo
+        self.hi = hi
+        self.n_bins = n_bins
+        self.width = (hi - lo) / n_bins
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.counts = [0] * (n_bins + 2)
+
+    def observe(self, x):
+        if not math.isfinite(x):
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        if x < self.lo:
+            self.counts[0] += 1
+        elif x >= self.hi:
+            self.counts[-1] += 1
+        else:
+            self.counts[1 + min(int((x - self.lo) / self.width), self.n_bins - 1)] += 1
+
+    @classmethod
+    def from_values(cls, values, lo, hi, n_bins):
+        """Sketch of a whole array at once (training references)."""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        sketch = cls(lo, hi, n_bins)
+        if len(values) == 0:
+            return sketch
+        sketch.n = len(values)
+        sketch.mean = float(values.mean())
+        sketch.m2 = float(((values - sketch.mean) ** 2).sum())
+        sketch.min = float(values.min())
+        sketch.max = float(values.max())
+        bins = np.clip(((values - lo) / sketch.width).astype(np.int64), 0, n_bins - 1) + 1
+        bins[values < lo] = 0
+        bins[values >= hi] = n_bins + 1
+        sketch.counts = np.bincount(bins, minlength=n_bins + 2).tolist()
+        return sketch
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        return self
+
+    def copy(self):
+        return Sketch.from_state(self.state())
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    def edges(self):
+        return [self.lo + i * self.width for i in range(self.n_bins + 1)]
+
+    def state(self):
+        return {"lo": self.lo, "hi": self.hi, "n_bins": self.n_bins, "n": self.n, "mean": self.mean, "m2": self.m2,
+                "min": self.min if self.n else None, "max": self.max if self.n else None, "counts": list(self.counts)}
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(state["lo"], state["hi"], state["n_bins"])
+        sketch.n = state["n"]
+        sketch.mean = state["mean"]
+        sketch.m2 = state["m2"]
+        sketch.min = state["min"] if state["min"] is not None else math.inf
+        sketch.max = state["max"] if state["max"] is not None else -math.inf
+        sketch.counts = list(state["counts"])
+        return sketch
+
+def psi(counts, reference, groups=PSI_GROUPS):
+    """
+    Population stability index of a histogram against the reference one (same
+    bins), after merging adjacent bins into ~`groups` of equal reference mass.
+    None below MIN_COUNT observations.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    reference = np.asarray(reference, dtype=np.float64)
+    if counts.sum() < MIN_COUNT or reference.sum() == 0:
+        return None
+    # A group ends at each bin where the reference CDF crosses k/groups
+    cdf = np.cumsum(reference) / reference.sum()
+    ends = np.unique(np.searchsorted(cdf, np.arange(1, groups) / groups, side="left"))
+    starts = np.concatenate([[0], ends + 1])
+    starts = starts[starts < len(counts)]
+    p = np.add.reduceat(counts, starts)
+    q = np.add.reduceat(reference, starts)
+    # Add-half smoothing so groups empty on either side stay finite
+    p = (p + 0.5) / (p.sum() + 0.5 * len(p))
+    q = (q + 0.5) / (q.sum() + 0.5 * len(q))
+    return float(((p - q) * np.log(p / q)).sum())
+
+def status_for(score):
+    if score is None:
+        return "insufficient_data"
+    return "drift" if score >= PSI_DRIFT else "warning" if score >= PSI_WARNING else "ok"
+
+def peak_key(model):
+    return f"peak_nm:{model}"
+
+def _new_sketch(key):
+    return Sketch(*PEAK_RANGE) if key.startswith("peak_nm:") else Sketch(*Z_RANGE)
+
+class DriftMonitor:
+    """
+    Distribution of served inputs and predictions against the training set.
+
+    Tracks the four features (in X_mean/X_std z-units) and every model's
+    predicted peak wavelength, over the service lifetime and over a rolling
+    window of the last `window` to 2x`window` images (two alternating
+    buckets, so the window costs nothing per request). Drift scores are PSIs
+    against training histograms: the training features, and for peaks what
+    that model predicts on the training features (`peak_reference(model)`),
+    i.e. its own output on in-distribution inputs.
+
+    Each process owns snapshot_dir/drift.<pid>.json, written every `interval`
+    seconds by a background thread (never on the request path). A new monitor
+    merges snapshots of processes that are no longer running (or of an
+    earlier run with its own pid), so counts survive restarts without being
+    counted twice, and report() folds in the latest snapshots of the other
+    live workers.
+    """
+
+    def __init__(self, base_dir, snapshot_dir=None, peak_reference=None, window=500, interval=30.0):
+        processed = os.path.join(base_dir, "data", "processed")
+        self.X_mean = np.load(os.path.join(processed, "X_mean.npy")).astype(np.float64)
+        self.X_std = np.load(os.path.join(processed, "X_std.npy")).astype(np.float64)
+        # Plain floats: observe() touches four values, where NumPy call overhead dominates
+        self._norm = list(zip(self.X_mean.tolist(), self.X_std.tolist()))
+        self.peak_reference = peak_reference
+        self.window = window
+        self.interval = interval
+        self.snapshot_dir = snapshot_dir
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        z_train = (load_training_features(base_dir) - self.X_mean) / self.X_std
+        self.reference = {name: Sketch.from_values(z_train[:, i], *Z_RANGE) for i, name in enumerate(FEATURE_NAMES)}
+        # Snapshots taken against another feature table / normalization are not resumed
+        self.reference_hash = source_hash(base_dir)
+
+        self.lifetime = {}
+        self.current = {}
+        self.previous = {}
+        self.in_window = 0
+        self.observed = 0
+        self.ood_flagged = 0
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+            self._adopt_orphans()
+
+    # --- Request path ---
+
+    def observe(self, feats, peaks=None, ood=None):
+        """One served image: raw (4,) features, {model: predicted peak nm}, OOD verdict."""
+        values = [(name, (float(f) - m) / s) for name, f, (m, s) in zip(FEATURE_NAMES, feats, self._norm)]
+        values += [(peak_key(model), float(peak)) for model, peak in (peaks or {}).items()]
+        with self._lock:
+            if self.in_window >= self.window:
+                self.previous, self.current = self.current, {}
+                self.in_window = 0
+            self.in_window += 1
+            self.observed += 1
+            if ood is not None and ood.get("flagged"):
+                self.ood_flagged += 1
+            for key, value in values:
+                for sketches in (self.lifetime, self.current):
+                    sketch = sketches.get(key)
+                    if sketch is None:
+                        sketch = sketches[key] = _new_sketch(key)
+                    sketch.observe(value)
+
+    # --- Reporting ---
+
+    def state(self):
+        with self._lock:
+            recent = {k: s.copy() for k, s in self.previous.items()}
+            for k, s in self.current.items():
+                recent[k] = recent[k].merge(s) if k in recent else s.copy()
+            return {
+                "reference_hash": self.reference_hash,
+                "pid": os.getpid(),
+                "written": time.time(),
+                "observed": self.observed,
+                "ood_flagged": self.ood_flagged,
+                "lifetime": {k: s.state() for k, s in self.lifetime.items()},
+                "recent": {k: s.state() for k, s in recent.items()}
+            }
+
+    def report(self, histograms=False):
+        """Drift summary for this worker plus the latest snapshots of the other live workers."""
+        states = [self.state()] + self._peer_states()
+        lifetime = _merge_states([s["lifetime"] for s in states])
+        recent = _merge_states([s["recent"] for s in states])
+        observed = sum(s["observed"] for s in states)
+
+        quantities = {}
+        for key in FEATURE_NAMES + sorted(k for k in lifetime if k.startswith("peak_nm:")):
+            ref = self.reference.get(key) or self._peak_reference(key)
+            life = lifetime.get(key) or _new_sketch(key)
+            rec = recent.get(key) or _new_sketch(key)
+            body = {
+                "unit": "nm" if key.startswith("peak_nm:") else "z",
+                "count": life.n,
+                "mean": life.mean if life.n else None,
+                "std": life.std if life.n else None,
+                "min": life.min if life.n else None,
+                "max": life.max if life.n else None,
+                "train_mean": ref.mean if ref else None,
+                "train_std": ref.std if ref else None,
+                # Shift of the recent mean in training standard deviations
+                "mean_shift": (rec.mean - ref.mean) / ref.std if ref and rec.n and ref.std > 0 else None,
+                "psi": psi(life.counts, ref.counts) if ref else None,
+                "psi_recent": psi(rec.counts, ref.counts) if ref else None
+            }
+            if histograms:
+                body["histogram"] = {"edges": life.edges(), "counts": life.counts, "recent": rec.counts,
+                                     "train": ref.counts if ref else None}
+            quantities[key] = body
+
+        scores = [q["psi_recent"] for q in quantities.values() if q["psi_recent"] is not None]
+        score = max(scores) if scores else None
+        return {
+            "status": status_for(score),
+            "drift_score": score,
+            "thresholds": {"warning": PSI_WARNING, "drift": PSI_DRIFT, "min_count": MIN_COUNT},
+            "observed": observed,
+            "recent_window": recent[FEATURE_NAMES[0]].n if FEATURE_NAMES[0] in recent else 0,
+            "workers": len(states),
+            "ood_rate": sum(s["ood_flagged"] for s in states) / observed if observed else None,
+            "quantities": quantities
+        }
+
+    def _peak_reference(self, key):
+        if self.peak_reference is None:
+            return None
+        try:
+            peaks = self.peak_reference(key.split(":", 1)[1])
+        except Exception as e:
+            print(f"Drift monitor: no peak reference for {key}: {e}")
+            return None
+        return Sketch.from_values(peaks, *PEAK_RANGE) if peaks is not None else None
+
+    # --- Persistence ---
+
+    def snapshot_path(self, pid=None):
+        return os.path.join(self.snapshot_dir, f"drift.{pid or os.getpid()}.json")
+
+    def save(self):
+        if not self.snapshot_dir:
+            return
+        path = self.snapshot_path()
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state(), f)
+        os.replace(tmp, path)
+
+    def start(self):
+        """Write a snapshot every `interval` seconds from a daemon thread."""
+        if not self.snapshot_dir or self._thread is not None:
+            return
+
+        def loop():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.save()
+                except OSError as e:
+                    print(f"Drift snapshot failed: {e}")
+
+        self._thread = threading.Thread(target=loop, name="drift-snapshots", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.save()
+
+    def _snapshots(self):
+        for path in glob.glob(os.path.join(glob.escape(self.snapshot_dir), "drift.*.json")):
+            try:
+                pid = int(os.path.basename(path).split(".")[1])
+            except ValueError:
+                continue
+            yield pid, path
+
+    def _adopt_orphans(self):
+        for pid, path in self._snapshots():
+            # Our own pid here is a previous run (containers restart with the same pid)
+            if pid != os.getpid() and _alive(pid):
+                continue
+            # Rename first: of several workers starting together, exactly one adopts each file
+            claimed = path + f".claimed.{os.getpid()}"
+            try:
+                os.replace(path, claimed)
+            except OSError:
+                continue
+            try:
+                with open(claimed) as f:
+                    state = json.load(f)
+                if state.get("reference_hash") == self.reference_hash:
+                    self._merge_state(state)
+                    print(f"Drift monitor: resumed {state['observed']} observations from pid {pid}")
+                else:
+                    print(f"Drift monitor: dropped snapshot from pid {pid} (training statistics changed)")
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Drift monitor: unreadable snapshot {path}: {e}")
+            finally:
+                os.remove(claimed)
+        self.save()
+
+    def _merge_state(self, state):
+        with self._lock:
+            self.observed += state["observed"]
+            self.ood_flagged += state["ood_flagged"]
+            for k, s in state["lifetime"].items():
+                self.lifetime.setdefault(k, _new_sketch(k)).merge(Sketch.from_state(s))
+            # The adopted window becomes our previous bucket
+            for k, s in state["recent"].items():
+                self.previous.setdefault(k, _new_sketch(k)).merge(Sketch.from_state(s))
+
+    def _peer_states(self):
+        if not self.snapshot_dir:
+            return []
+        states = []
+        for pid, path in self._snapshots():
+            if pid == os.getpid() or not _alive(pid):
+                continue
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if state.get("reference_hash") == self.reference_hash:
+                states.append(state)
+        return states
+
+def _merge_states(group):
+    merged = {}
+    for states in group:
+        for k, s in states.items():
+            sketch = Sketch.from_state(s)
+            merged[k] = merged[k].merge(sketch) if k in merged else sketch
+    return merged
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
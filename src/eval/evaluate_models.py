@@ -8,6 +8,7 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from datetime import datetime
 from src.eval.infer_multi import ModelWrapper
+from src.eval import peaks as peak_analysis
 
 def compute_metrics(y_true, y_pred, peak_tol=5.0, wavelengths=None):
     # MSE/RMSE/MAE
@@ -23,20 +24,26 @@ def compute_metrics(y_true, y_pred, peak_tol=5.0, wavelengths=None):
     sam_rad = np.arccos(np.clip(cosine, -1.0, 1.0))
     sam_deg = np.degrees(sam_rad)
     
-    # Peak Stats
-    true_peak_idx = np.argmax(y_true)
-    pred_peak_idx = np.argmax(y_pred)
-    
+    # Peak Stats: main peak (sub-grid) and FWHM, plus band-level matching of every resolved peak
     if wavelengths is not None:
-        true_peak_nm = wavelengths[true_peak_idx]
-        pred_peak_nm = wavelengths[pred_peak_idx]
+        both = np.stack([np.asarray(y_true, dtype=np.float64), np.asarray(y_pred, dtype=np.float64)])
+        peaks = peak_analysis.analyze(both, wavelengths)
+        (true_peak_nm, pred_peak_nm), (true_fwhm, pred_fwhm) = peak_analysis.primary(peaks, both, wavelengths)
         peak_error = abs(true_peak_nm - pred_peak_nm)
         peak_within_tol = 1 if peak_error <= peak_tol else 0
+        fwhm_error = abs(true_fwhm - pred_fwhm)
+        true_n, pred_n = int(peaks["count"][0]), int(peaks["count"][1])
+        # A band counts as matched when the other spectrum has a peak within peak_tol of it
+        dist = np.abs(peaks["center_nm"][0, :true_n, None] - peaks["center_nm"][1, None, :pred_n])
+        true_matched = int((dist <= peak_tol).any(axis=1).sum())
+        pred_matched = int((dist <= peak_tol).any(axis=0).sum())
     else:
         true_peak_nm = 0
         pred_peak_nm = 0
         peak_error = 0
         peak_within_tol = 0
+        true_fwhm = pred_fwhm = fwhm_error = 0
+        true_n = pred_n = true_matched = pred_matched = 0
         
     return {
         "mse": float(mse),
@@ -46,7 +53,14 @@ def compute_metrics(y_true, y_pred, peak_tol=5.0, wavelengths=None):
         "true_peak_nm": float(true_peak_nm),
         "pred_peak_nm": float(pred_peak_nm),
         "peak_error_nm": float(peak_error),
-        "peak_within_tol": int(peak_within_tol)
+        "peak_within_tol": int(peak_within_tol),
+        "true_fwhm_nm": float(true_fwhm),
+        "pred_fwhm_nm": float(pred_fwhm),
+        "fwhm_error_nm": float(fwhm_error),
+        "true_n_peaks": true_n,
+        "pred_n_peaks": pred_n,
+        "true_peaks_matched": true_matched,
+        "pred_peaks_matched": pred_matched
     }
 
 def main():
@@ -82,7 +96,7 @@ def main():
             
         try:
             print(f"Loading {meta['model_name']} from {model_path}...")
-            loaded_models[meta['model_name']] = ModelWrapper(model_path)
+            loaded_models[meta['model_name']] = ModelWrapper(model_path, ood="flag")  # score the surrogate itself, no Mie fallback
         except Exception as e:
             print(f"Failed to load {meta['model_name']}: {e}")
 
@@ -149,7 +163,8 @@ def main():
                     "image_path": img_path,
                     "model_name": m_name,
                     "pred_peak_nm": res['peak_nm'],
-                    "pred_fwhm_nm": res['fwhm_nm']
+                    "pred_fwhm_nm": res['fwhm_nm'],
+                    "pred_n_peaks": len(res['peaks'])
                 }
                 
                 if gt_spectrum is not None:
@@ -179,7 +194,8 @@ def main():
                     row.update(metrics)
                 else:
                     # No GT or size mismatch
-                    row.update({k: None for k in ["mse","rmse","mae","sam_deg","true_peak_nm","peak_error_nm","peak_within_tol"]})
+                    row.update({k: None for k in ["mse","rmse","mae","sam_deg","true_peak_nm","peak_error_nm","peak_within_tol",
+                                                  "true_fwhm_nm","fwhm_error_nm","true_n_peaks","true_peaks_matched","pred_peaks_matched"]})
                 
                 results.append(row)
                 
@@ -222,6 +238,7 @@ def main():
                 "sam_deg": float(m_df["sam_deg"].mean()),
                 "peak_error_mean": float(m_df["peak_error_nm"].mean()),
                 "peak_error_std": float(m_df["peak_error_nm"].std()),
+                "fwhm_error_mean": float(m_df["fwhm_error_nm"].mean()),
                 # Precision/Recall/F1 (tolerance based)
                 "samples_with_gt": int(m_df["mse"].notnull().sum()),
                 "tp": int(m_df["peak_within_tol"].sum())
@@ -231,6 +248,11 @@ def main():
             stats["precision"] = stats["tp"] / n_gt if n_gt > 0 else 0
             stats["recall"] = stats["tp"] / n_gt if n_gt > 0 else 0 # Identical in this definition
             stats["f1"] = 2 * stats["precision"] * stats["recall"] / (stats["precision"] + stats["recall"] + 1e-9)
+            # Band level: every resolved peak, not just the main one
+            gt_df = m_df[m_df["mse"].notnull()]
+            n_pred, n_true = gt_df["pred_n_peaks"].sum(), gt_df["true_n_peaks"].sum()
+            stats["band_precision"] = float(gt_df["pred_peaks_matched"].sum() / n_pred) if n_pred > 0 else 0
+            stats["band_recall"] = float(gt_df["true_peaks_matched"].sum() / n_true) if n_true > 0 else 0
             
             summary["models"][m_name] = stats
         else:
@@ -1,24 +1,192 @@
 import os
-import torch
+import json
+from functools import lru_cache
 import numpy as np
 import cv2
-from src.models.mlp import SpectrumMLP
+from src.models.basis import SpectralBasis, basis_path_for
+from src.features.decode import load_gray
+from src.eval.numpy_backend import NumpyMLP, StackedMLP
+from src.eval.ood import FeatureGate
+from src.eval.prediction_cache import file_sha1
+from src.eval.telemetry import timed, note, PARTICLE_COUNT
+from src.eval import peaks as peak_analysis
+from src.simulation.mie import simulate_spectra, diameter_nm
+
+# What to do with inputs outside the training feature distribution:
+# "mie" = compute them with the exact solver, "flag" = report only, "off" = skip the check
+OOD_POLICIES = ("mie", "flag", "off")
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+MODELS_DIR = os.path.join(ROOT_DIR, "models", "registered")
+
+# Exported inference artifacts live next to the float checkpoint
+VARIANT_SUFFIXES = {
+    "torchscript": ".ts.pt",
+    "int8": ".int8.ts.pt",
+}
+
+def variant_path_for(model_path, variant):
+    return os.path.splitext(model_path)[0] + VARIANT_SUFFIXES[variant]
+
+def extract_features(source):
+    """Features from an image file path or in-memory image bytes (e.g. an upload)."""
+    with timed("decode"):
+        # Full resolution: reduced JPEG decoding moves features off the training distribution
+        img = load_gray(source)
+
+    with timed("segmentation"):
+        feats = segment_features(img)
+    PARTICLE_COUNT.observe(float(feats[2]))
+    return feats
+
+def segment_features(img):
+    """Otsu segmentation of an 8-bit grayscale micrograph -> [mean diam, std diam, count, aspect]."""
+    img = cv2.resize(img, (512, 512))
+    blur = cv2.GaussianBlur(img, (5,5), 0)
+    _, th = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    kernel = np.ones((3,3), np.uint8)
+    th = cv2.morphologyEx(th, cv2.MORPH_OPEN, kernel, iterations=1)
+    return mask_features(th)
+
+def particle_stats(th):
+    """
+    Contours of a binary mask with area > 20 px -> (areas, bounding-box
+    aspect ratios, bounding-box centres (N, 2)).
+    """
+    cnts, _ = cv2.findContours(th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    areas = []
+    aspect_ratios = []
+    centers = []
+    for c in cnts:
+        a = cv2.contourArea(c)
+        if a > 20:
+            areas.append(a)
+            x,y,w,h = cv2.boundingRect(c)
+            if h > 0: aspect_ratios.append(w/h)
+            else: aspect_ratios.append(1.0)
+            centers.append((x + w / 2, y + h / 2))
+    return np.array(areas), np.array(aspect_ratios), np.array(centers, dtype=np.float32).reshape(-1, 2)
+
+def mask_features(th):
+    """Features of the particles (non-zero pixels) in a binary 512x512 mask, as measured by segment_features."""
+    areas, aspect_ratios, _ = particle_stats(th)
+    if len(areas) == 0:
+        # Fallback for empty image or bad segmentation
+        raise ValueError("No particles detected. Try adjusting image contrast or using a cleaner micrograph.")
+    return features_from_stats(areas, aspect_ratios)
+
+def features_from_stats(areas, aspect_ratios):
+    eq_diam = np.sqrt(4 * areas / np.pi)
+    return np.array([
+        eq_diam.mean(),
+        eq_diam.std(),
+        len(eq_diam),
+        np.mean(aspect_ratios)
+    ], dtype=np.float32)
 
 class ModelWrapper:
-    def __init__(self, model_path, device="cpu"):
+    def __init__(self, model_path, device="cpu", basis_path=None, variant="auto", backend="torch",
+                 cache=None, model_id=None, members=None, band=(5, 95), ood="mie", shared=None):
+        if ood not in OOD_POLICIES:
+            raise ValueError(f"ood must be one of {OOD_POLICIES}, got {ood!r}")
         self.device = device
         self.model_path = model_path
+        self.basis = None
+        self.basis_path = None
+        self.backend = backend
+        # Ensembles: K independently trained checkpoints run as one stacked forward pass
+        self.members = members
+        self.band = band
+
+        # Optional shared PredictionCache; entries are tied to this exact checkpoint
+        self.cache = cache
+        self.model_id = model_id or os.path.splitext(os.path.basename(model_path))[0]
+        self.base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.ood = ood
+
+        # Serving workers attach to a SharedPack (src/eval/shared_pack.py): weights,
+        # normalization and the OOD gate are memory-mapped instead of parsed and hashed
+        if shared is not None:
+            self._attach(shared)
+            return
+
+        self.model_hash = file_sha1(model_path)
+        if members:
+            self.model_hash = ":".join(file_sha1(p) for p in members)
         
         # Load constraints/normalization
-        self.base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
         self.X_mean = np.load(os.path.join(self.base_dir, "data/processed/X_mean.npy"))
         self.X_std = np.load(os.path.join(self.base_dir, "data/processed/X_std.npy"))
         self.wavelengths = np.load(os.path.join(self.base_dir, "data/processed/wavelengths.npy"))
+
+        # The surrogate is only trusted inside the training feature range
+        self.gate = feature_gate(self.base_dir) if ood != "off" else None
         
         # Load Model
-        # TODO: Detect architecture if multiple exist. For now assume SpectrumMLP
-        self.model = SpectrumMLP(in_dim=4, out_dim=251)
-        
+        # The NumPy backend covers plain Linear/ReLU stacks without importing torch;
+        # anything else (pickled modules, TorchScript variants) falls back to torch.
+        if members:
+            # Members must share one architecture; (M, N, out) comes out of one batched matmul per layer
+            self.model = StackedMLP([NumpyMLP.load(p) for p in members])
+            self.backend = "numpy"
+            self.variant = "ensemble"
+        elif backend == "numpy":
+            try:
+                self.model = NumpyMLP.load(model_path)
+                self.variant = "float"
+            except ValueError as e:
+                print(f"NumPy backend cannot load {model_path} ({e}), falling back to torch")
+                self.backend = "torch"
+        if self.backend == "torch":
+            self.model = self._load_torch(model_path, device, variant)
+
+        # Basis sidecar (see src/training/train.py --basis)
+        if basis_path is None and os.path.exists(basis_path_for(model_path)):
+            basis_path = basis_path_for(model_path)
+        if basis_path is not None:
+            self.basis_path = basis_path
+            self.basis = SpectralBasis.load(basis_path)
+            print(f"Loaded spectral basis (k={self.basis.k}) from {basis_path}")
+            self.model_hash += ":" + file_sha1(basis_path)
+
+    def _attach(self, pack):
+        entry = pack.manifest["models"][self.model_id]
+        self.model_hash = entry["model_hash"]
+        self.variant = entry["variant"]
+        self.backend = "numpy"
+        self.X_mean = pack.array("common", "X_mean")
+        self.X_std = pack.array("common", "X_std")
+        self.wavelengths = pack.array("common", "wavelengths")
+        self.gate = pack.gate() if self.ood != "off" else None
+        self.model = pack.network(self.model_id)
+        self.basis = pack.basis(self.model_id)
+        self.basis_path = entry["basis_path"]
+
+    def _load_torch(self, model_path, device, variant):
+        import torch
+
+        # Prefer compiled artifacts exported by register_uploads.py --export
+        if variant == "auto":
+            variant = "torchscript" if os.path.exists(variant_path_for(model_path, "torchscript")) else "float"
+        self.variant = variant
+
+        if variant == "float":
+            model = self._load_eager(model_path, device)
+        else:
+            artifact = variant_path_for(model_path, variant)
+            if not os.path.exists(artifact):
+                raise FileNotFoundError(f"No {variant} artifact at {artifact}; run register_uploads.py --export")
+            model = torch.jit.load(artifact, map_location=device)
+            
+        model.to(device)
+        model.eval()
+        return model
+
+    def _load_eager(self, model_path, device):
+        import torch
+        from src.models.mlp import SpectrumMLP, dims_from_state_dict
+
         # Determine how to load (full model vs state_dict)
         try:
             state_dict = torch.load(model_path, map_location=device)
@@ -29,90 +197,325 @@ class ModelWrapper:
                 # Remove 'model.' prefix if present (common in Lightning)
                 state_dict = {k.replace("model.", ""): v for k, v in state_dict.items()}
             
-            self.model.load_state_dict(state_dict)
+            # Hidden widths come from sweeps; compact heads predict K basis coefficients
+            in_dim, hidden, out_dim = dims_from_state_dict(state_dict)
+            model = SpectrumMLP(in_dim=in_dim, out_dim=out_dim, hidden=hidden)
+            model.load_state_dict(state_dict)
         except Exception as e:
             print(f"Failed to load state dict, trying full model load: {e}")
-            self.model = torch.load(model_path, map_location=device)
-            
-        self.model.to(device)
-        self.model.eval()
+            model = torch.load(model_path, map_location=device)
+        return model
 
-    def extract_features(self, img_path):
-        # Reusing logic from predict.py
-        img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-        if img is None:
-            raise ValueError(f"Could not load image {img_path}")
+    def extract_features(self, source):
+        return extract_features(source)
 
-        if len(img.shape) == 3:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    def forward(self, feats_norm):
+        """
+        Raw model outputs (spectra or basis coefficients) for an (N, 4) batch
+        of normalized features: (N, out), or (M, N, out) for an ensemble.
+        """
+        if self.backend == "numpy":
+            return self.model(feats_norm)
 
-        if img.dtype == np.uint16:
-            img = (img / 65535.0 * 255).astype(np.uint8)
-            
-        img = cv2.resize(img, (512, 512))
-        blur = cv2.GaussianBlur(img, (5,5), 0)
-        _, th = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-        kernel = np.ones((3,3), np.uint8)
-        th = cv2.morphologyEx(th, cv2.MORPH_OPEN, kernel, iterations=1)
-        cnts, _ = cv2.findContours(th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        areas = []
-        aspect_ratios = []
-        for c in cnts:
-            a = cv2.contourArea(c)
-            if a > 20:
-                areas.append(a)
-                x,y,w,h = cv2.boundingRect(c)
-                if h > 0: aspect_ratios.append(w/h)
-                else: aspect_ratios.append(1.0)
-
-        if len(areas) == 0:
-            # Fallback for empty image or bad segmentation
-            raise ValueError("No particles detected. Try adjusting image contrast or using a cleaner micrograph.")
-
-        areas = np.array(areas)
-        eq_diam = np.sqrt(4 * areas / np.pi)
-
-        feats = np.array([
-            eq_diam.mean(),
-            eq_diam.std(),
-            len(eq_diam),
-            np.mean(aspect_ratios)
-        ], dtype=np.float32)
-        return feats
-
-    def predict(self, image_path=None, features=None):
+        import torch
+        with torch.no_grad():
+            tensor = torch.as_tensor(np.asarray(feats_norm, dtype=np.float32)).to(self.device)
+            return self.model(tensor).cpu().numpy()
+
+    def predict(self, image_path=None, features=None, image_bytes=None):
         if image_path:
             feats = self.extract_features(image_path)
+        elif image_bytes is not None:
+            feats = self.extract_features(image_bytes)
         elif features is not None:
             feats = features
         else:
-            raise ValueError("Must provide image_path or features")
+            raise ValueError("Must provide image_path, image_bytes or features")
 
-        # Normalize
-        feats_norm = (feats - self.X_mean) / self.X_std
-        
-        # Predict
-        with torch.no_grad():
-            tensor = torch.tensor(feats_norm, dtype=torch.float32).unsqueeze(0).to(self.device)
-            pred = self.model(tensor).cpu().numpy()[0]
-
-        # Post-process stats
-        peak_idx = np.argmax(pred)
-        peak_nm = float(self.wavelengths[peak_idx])
-        max_val = pred[peak_idx]
-        half_max = max_val / 2.0
-        
-        indices = np.where(pred > half_max)[0]
-        if len(indices) > 0:
-            fwhm_nm = float(self.wavelengths[indices[-1]] - self.wavelengths[indices[0]])
-        else:
-            fwhm_nm = 0.0
+        cached = self.cached(feats)
+        if cached is not None:
+            return cached
 
-        return {
+        check = self.check_ood(feats)
+        if self.use_mie(check):
+            with timed("mie"):
+                return self.finish_mie(feats, check)
+
+        # Normalize + Predict
+        with timed("normalize"):
+            feats_norm = self.normalize(feats)[None, :]
+        with timed("forward"):
+            pred = self.sample(self.forward(feats_norm), 0)
+        with timed("postprocess"):
+            return self.finish(feats, pred, check)
+
+    def check_ood(self, feats):
+        """FeatureGate.check() for one (4,) or a batch of (N, 4) raw features, None when disabled."""
+        if self.gate is None:
+            return None
+        with timed("ood"):
+            return self.gate.check(feats)
+
+    def use_mie(self, check, i=0):
+        return check is not None and self.ood == "mie" and bool(check["flagged"][i])
+
+    def finish_mie(self, feats, check):
+        """Prediction dict from the exact Mie solver, for inputs the surrogate should not answer."""
+        spectrum = simulate_spectra(diameter_nm(feats[0]))[0].astype(np.float32)
+        return self.finish(feats, spectrum, check, path="mie")
+
+    def sample(self, out, i):
+        """Row i of a forward() result (all members' rows for an ensemble)."""
+        return out[:, i] if self.members else out[i]
+
+    def predict_batch(self, features):
+        """Vectorized predict for an (N, 4) array of raw features (no caching)."""
+        features = np.asarray(features, dtype=np.float32)
+        pred = self.forward(self.normalize(features))
+        if self.members:
+            bands = self._bands(pred)
+            pred = pred.mean(axis=0)
+        coeffs = None
+        if self.basis is not None:
+            coeffs = pred
+            pred = self.basis.decode(coeffs)
+
+        # Flagged rows are recomputed together in one batched Mie call
+        check = self.check_ood(features)
+        path = np.full(len(features), "surrogate")
+        if check is not None and self.ood == "mie" and check["flagged"].any():
+            rows = np.flatnonzero(check["flagged"])
+            with timed("mie"):
+                pred = np.array(pred, dtype=np.float32)
+                pred[rows] = simulate_spectra(diameter_nm(features[rows, 0]))
+            if coeffs is not None:
+                coeffs = np.array(coeffs)
+                coeffs[rows] = self.basis.encode(pred[rows])
+            path[rows] = "mie"
+
+        peaks = peak_analysis.analyze(pred, self.wavelengths)
+        peak_nm, fwhm_nm = peak_analysis.primary(peaks, pred, self.wavelengths)
+        result = {
             "wavelengths": self.wavelengths,
-            "spectrum": pred,
+            "spectra": pred,
             "peak_nm": peak_nm,
             "fwhm_nm": fwhm_nm,
-            "features": feats
+            "peaks": peaks,
+            "features": features,
+            "coefficients": coeffs,
+            "path": path,
+            "ood": check
         }
+        if self.members:
+            # Bands describe the surrogate members; they are meaningless for Mie rows
+            result.update(bands)
+        return result
+
+    def _bands(self, member_out):
+        """Per-wavelength spread across ensemble members; member_out is (M, ..., out)."""
+        spectra = member_out if self.basis is None else self.basis.decode(member_out)
+        lower, upper = member_percentiles(spectra, self.band)
+        flat = spectra.reshape(-1, spectra.shape[-1])
+        peak_nm = peak_stats(flat, self.wavelengths)[0].reshape(spectra.shape[:-1])
+        return {
+            "std": spectra.std(axis=0),
+            "lower": lower.astype(np.float32),
+            "upper": upper.astype(np.float32),
+            "band": self.band,
+            "peak_nm_std": peak_nm.std(axis=0),
+            "n_members": len(spectra)
+        }
+
+    def normalize(self, feats):
+        return (feats - self.X_mean) / self.X_std
+
+    def cached(self, feats):
+        if self.cache is None:
+            return None
+        hit = self.cache.get(self.cache.key(self.model_id, self.model_hash, feats))
+        note("cache_hit" if hit is not None else "cache_miss")
+        return dict(hit, features=feats) if hit is not None else None
+
+    def finish(self, feats, pred, check=None, path="surrogate"):
+        """
+        Turn one raw model output into the prediction dict (and cache it).
+        With path="mie", pred is already the full exact spectrum.
+        """
+        # Ensembles: report the member mean (decode is linear, so mean of coefficients == mean spectrum)
+        bands = None
+        if self.members and path == "surrogate":
+            bands = self._bands(pred)
+            bands["peak_nm_std"] = float(bands["peak_nm_std"])
+            pred = pred.mean(axis=0)
+
+        # Reconstruct the full spectrum from basis coefficients
+        coeffs = None
+        if self.basis is not None:
+            if path == "surrogate":
+                coeffs = pred
+                pred = self.basis.decode(coeffs)
+            else:
+                # Keep output=coefficients working: project the exact spectrum onto the basis
+                coeffs = self.basis.encode(pred)
+
+        # Post-process stats: main peak plus every resolved band
+        peaks = peak_analysis.analyze(pred, self.wavelengths)
+        peak_nm, fwhm_nm = peak_analysis.primary(peaks, pred, self.wavelengths)
+
+        result = {
+            "wavelengths": self.wavelengths,
+            "spectrum": pred,
+            "peak_nm": float(peak_nm[0]),
+            "fwhm_nm": float(fwhm_nm[0]),
+            "peaks": peak_analysis.peak_list(peaks, 0),
+            "features": feats,
+            "coefficients": coeffs,
+            "path": path,
+            "ood": self.gate.describe(check) if check is not None else None
+        }
+        if bands is not None:
+            result.update(bands)
+        if self.cache is not None:
+            # Cached arrays are shared between responses, so freeze them
+            arrays = [pred, coeffs]
+            if bands is not None:
+                arrays += [bands["std"], bands["lower"], bands["upper"]]
+            for arr in arrays:
+                if arr is not None:
+                    arr.setflags(write=False)
+            self.cache.put(self.cache.key(self.model_id, self.model_hash, feats), result)
+        return result
+
+def load_registered(name, models_dir=MODELS_DIR, ood=None, cache=None, shared=None):
+    """
+    ModelWrapper for a registry entry: a name in models_dir or the path of a
+    registry JSON. Paths in the entry are relative to the repo root; variant,
+    backend, ensemble members and the OOD policy come from the entry (ood
+    overrides the policy). With a SharedPack the wrapper attaches to it unless
+    the entry changed since the pack was built.
+    """
+    json_path = name if name.endswith(".json") else os.path.join(models_dir, f"{name}.json")
+    if not os.path.exists(json_path):
+        names = sorted(os.path.splitext(f)[0] for f in os.listdir(models_dir) if f.endswith(".json"))
+        raise FileNotFoundError(f"No registered model '{name}' (available: {', '.join(names)})")
+    model_id = os.path.splitext(os.path.basename(json_path))[0]
+
+    def resolve(p):
+        return p if os.path.isabs(p) else os.path.join(ROOT_DIR, p)
+
+    with open(json_path) as f:
+        meta = json.load(f)
+    path = resolve(meta["path"])
+    if shared is not None and shared.entry(model_id, json_path, path) is None:
+        shared = None
+    print(f"{'Attaching' if shared else 'Loading'} model {model_id} from {shared.pack_dir if shared else path}")
+    # NumPy backend by default; torch is only imported for entries pinned to backend="torch"
+    # (e.g. to serve an exported TorchScript/int8 variant) or architectures NumPy can't run
+    return ModelWrapper(
+        path,
+        basis_path=resolve(meta["basis"]) if meta.get("basis") else None,
+        variant=meta.get("variant", "auto"),
+        backend=meta.get("backend", "numpy"),
+        cache=cache,
+        model_id=model_id,
+        members=[resolve(p) for p in meta["ensemble"]] if meta.get("ensemble") else None,
+        # Inputs outside the training feature range go to the exact Mie solver unless the entry says otherwise
+        ood=ood or meta.get("ood", "mie"),
+        shared=shared
+    )
+
+def peak_stats(spectra, wavelengths):
+    """Main-peak wavelength and FWHM for each row of (N, W) spectra (same definition as finish())."""
+    spectra = np.atleast_2d(spectra)
+    # Main peak only: no lower-ranked bands, areas or centroids
+    peaks = peak_analysis.analyze(spectra, wavelengths, max_peaks=1, areas=False)
+    return peak_analysis.primary(peaks, spectra, wavelengths)
+
+def member_percentiles(x, qs):
+    """
+    np.percentile(x, qs, axis=0) (linear interpolation) for a small member
+    axis. np.sort along a short leading axis is slow, so for M <= 8 the
+    members are sorted with an odd-even compare-swap network of elementwise
+    min/max over whole arrays.
+    """
+    m = len(x)
+    if m > 8:
+        s = np.sort(x, axis=0)
+    else:
+        s = [np.array(v) for v in x]
+        for r in range(m):
+            for i in range(r % 2, m - 1, 2):
+                lo = np.minimum(s[i], s[i + 1])
+                np.maximum(s[i], s[i + 1], out=s[i + 1])
+                s[i] = lo
+    out = []
+    for q in qs:
+        pos = q / 100 * (m - 1)
+        lo = int(pos)
+        hi = min(lo + 1, m - 1)
+        out.append(s[lo] + (s[hi] - s[lo]) * (pos - lo))
+    return out
+
+def predict_many(wrappers, image_path=None, features=None, image_bytes=None):
+    """
+    Score one input with several models. Features are extracted once, and
+    NumPy-backed models with identical layer shapes run as one stacked
+    batched forward pass. Returns ({name: prediction}, {name: error}).
+    """
+    if image_path:
+        feats = extract_features(image_path)
+    elif image_bytes is not None:
+        feats = extract_features(image_bytes)
+    elif features is not None:
+        feats = features
+    else:
+        raise ValueError("Must provide image_path, image_bytes or features")
+
+    results, errors = {}, {}
+    groups = {}
+    checks = {}
+    for name, wrapper in wrappers.items():
+        cached = wrapper.cached(feats)
+        if cached is not None:
+            results[name] = cached
+            continue
+        checks[name] = wrapper.check_ood(feats)
+        if wrapper.use_mie(checks[name]):
+            try:
+                with timed("mie"):
+                    results[name] = wrapper.finish_mie(feats, checks[name])
+            except Exception as e:
+                errors[name] = str(e)
+        elif wrapper.backend == "numpy" and not wrapper.members:
+            groups.setdefault(wrapper.model.signature, []).append(name)
+        else:
+            groups[("single", name)] = [name]
+
+    for names in groups.values():
+        members = [wrappers[n] for n in names]
+        try:
+            # (M, 1, 4): each model normalizes with its own statistics
+            x = np.stack([w.normalize(feats)[None, :] for w in members])
+            if len(members) > 1:
+                raw = _stacked(tuple(w.model for w in members))(x)
+                for i, (name, w) in enumerate(zip(names, members)):
+                    results[name] = w.finish(feats, raw[i, 0], checks[name])
+            else:
+                w = members[0]
+                results[names[0]] = w.finish(feats, w.sample(w.forward(x[0]), 0), checks[names[0]])
+        except Exception as e:
+            for name in names:
+                errors[name] = str(e)
+    return results, errors
+
+@lru_cache(maxsize=4)
+def feature_gate(base_dir):
+    # One index per checkout, shared by every loaded model (they normalize with the same X_mean/X_std)
+    X_mean = np.load(os.path.join(base_dir, "data/processed/X_mean.npy"))
+    X_std = np.load(os.path.join(base_dir, "data/processed/X_std.npy"))
+    return FeatureGate.from_training_data(base_dir, X_mean, X_std)
+
+@lru_cache(maxsize=8)
+def _stacked(models):
+    # Stacking copies every weight matrix, so reuse it across requests
+    return StackedMLP(models)
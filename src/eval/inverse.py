@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from src.eval.infer_multi import peak_stats, feature_gate
+from src.eval import peaks as peak_analysis
+from src.eval.numpy_backend import NumpyMLP
+from src.eval.ood import FEATURE_NAMES
+from src.eval.telemetry import timed
+
+# Physical lower bounds for [mean diam px, std diam px, count, aspect]
+FEATURE_MIN = np.array([1.0, 0.0, 1.0, 0.1], dtype=np.float32)
+
+# Softness of the differentiable peak / FWHM stand-ins used during refinement
+PEAK_SHARPNESS = 50.0
+HALF_PROMINENCE_SHARPNESS = 20.0
+
+# Candidates refined by gradient descent; the top k are picked from these
+REFINE = 64
+
+class Objective:
+    """
+    Score for candidate spectra against a target spectrum and/or peak/FWHM
+    constraints (lower is better). Terms are dimensionless and added:
+      - spectrum: MSE relative to the target's mean square;
+      - peak / FWHM: squared error in units of the tolerance.
+    score() uses the exact main peak and FWHM (src.eval.peaks). grad() takes
+    the errors from the same exact values and their derivatives from smooth
+    stand-ins (soft-argmax; a sigmoid count above the main peak's half-
+    prominence level, over that peak's band) so the input can be refined by
+    gradient descent.
+    """
+
+    def __init__(self, wavelengths, target=None, peak_nm=None, fwhm_nm=None, peak_tol=5.0, fwhm_tol=10.0):
+        if target is None and peak_nm is None and fwhm_nm is None:
+            raise ValueError("Give a target spectrum, peak_nm and/or fwhm_nm")
+        self.wavelengths = np.asarray(wavelengths, dtype=np.float32)
+        self.step = float(self.wavelengths[1] - self.wavelengths[0])
+        self.target = None
+        if target is not None:
+            self.target = np.asarray(target, dtype=np.float32)
+            if self.target.shape != self.wavelengths.shape:
+                raise ValueError(f"Target spectrum needs {len(self.wavelengths)} values, got {self.target.shape}")
+            self.target_ms = float(np.mean(self.target ** 2)) or 1.0
+        self.peak_nm = peak_nm
+        self.fwhm_nm = fwhm_nm
+        self.peak_tol = peak_tol
+        self.fwhm_tol = fwhm_tol
+
+    def score(self, spectra):
+        total = np.zeros(len(spectra), dtype=np.float64)
+        if self.target is not None:
+            total += np.mean((spectra - self.target) ** 2, axis=1) / self.target_ms
+        if self.peak_nm is not None or self.fwhm_nm is not None:
+            peak, fwhm = peak_stats(spectra, self.wavelengths)
+            if self.peak_nm is not None:
+                total += ((peak - self.peak_nm) / self.peak_tol) ** 2
+            if self.fwhm_nm is not None:
+                total += ((fwhm - self.fwhm_nm) / self.fwhm_tol) ** 2
+        return total
+
+    def grad(self, spectra):
+        """d(smooth score)/d(spectra), (N, W)."""
+        g = np.zeros_like(spectra)
+        if self.target is not None:
+            g += 2 * (spectra - self.target) / (spectra.shape[1] * self.target_ms)
+        if self.peak_nm is None and self.fwhm_nm is None:
+            return g
+
+        # Range, maximum and the half-prominence level are treated as constants
+        peaks = peak_analysis.analyze(spectra, self.wavelengths, max_peaks=1, areas=False)
+        peak, fwhm = peak_analysis.primary(peaks, spectra, self.wavelengths)
+        hi = spectra.max(axis=1, keepdims=True)
+        r = hi - spectra.min(axis=1, keepdims=True) + 1e-6
+        if self.peak_nm is not None:
+            a = PEAK_SHARPNESS * (spectra - hi) / r
+            p = np.exp(a)
+            p /= p.sum(axis=1, keepdims=True)
+            dpeak = PEAK_SHARPNESS / r * p * (self.wavelengths - (p @ self.wavelengths)[:, None])
+            g += (2 * (peak - self.peak_nm) / self.peak_tol ** 2)[:, None] * dpeak
+        if self.fwhm_nm is not None:
+            # Only samples of the main band (its half-prominence crossings plus one sample
+            # either side) move the width; rows without a peak get no FWHM gradient
+            found = peaks["count"] > 0
+            level = np.where(found, peaks["height"][:, 0] - peaks["prominence"][:, 0] / 2, 0.0)[:, None]
+            left = np.where(found, peaks["left_nm"][:, 0], np.inf)[:, None]
+            right = np.where(found, peaks["right_nm"][:, 0], -np.inf)[:, None]
+            band = (self.wavelengths >= left - self.step) & (self.wavelengths <= right + self.step)
+            u = HALF_PROMINENCE_SHARPNESS * (spectra - level) / r
+            sig = 1 / (1 + np.exp(-u))
+            dfwhm = self.step * HALF_PROMINENCE_SHARPNESS / r * sig * (1 - sig) * band
+            g += (2 * (fwhm - self.fwhm_nm) / self.fwhm_tol ** 2)[:, None] * dfwhm
+        return g
+
+def _network(wrapper):
+    # Gradients need the NumPy weights; torch-backed wrappers are re-read without torch
+    if wrapper.backend == "numpy":
+        return wrapper.model
+    return NumpyMLP.load(wrapper.model_path)
+
+def _spectra(wrapper, net, z):
+    out = net(z)
+    if wrapper.members:
+        out = out.mean(axis=0)
+    return out if wrapper.basis is None else wrapper.basis.decode(out)
+
+def _spectra_and_vjp(wrapper, net, z):
+    """Surrogate spectra for normalized inputs z plus a backward(grad_spectra) -> grad_z."""
+    out, backward = net.vjp(z)
+    if wrapper.members:
+        m = out.shape[0]
+        out = out.mean(axis=0)
+        member_backward = backward
+        backward = lambda g: member_backward(np.broadcast_to(g / m, (m,) + g.shape))
+    if wrapper.basis is None:
+        return out, backward
+    components = wrapper.basis.components.astype(np.float32)
+    coeff_backward = backward
+    return wrapper.basis.decode(out), lambda g: coeff_backward(g @ components.T)
+
+def inverse_design(wrapper, target=None, peak_nm=None, fwhm_nm=None, peak_tol=5.0, fwhm_tol=10.0,
+                   k=5, n_candidates=100_000, refine=REFINE, steps=100, lr=0.05, seed=0, chunk=16384):
+    """
+    Morphologies whose surrogate spectrum best matches a target spectrum
+    and/or peak/FWHM constraints.
+
+    1. Sweep: n_candidates feature vectors (half jittered training points,
+       half uniform over the trusted feature box) scored in chunked batches.
+    2. Refine: the best `refine` candidates take `steps` Adam steps on the
+       normalized input, projected back into the box after each step.
+    3. Rank by exact score, in-distribution candidates first, skip
+       near-duplicates and return the top k.
+    """
+    if n_candidates < 1:
+        raise ValueError(f"n_candidates must be at least 1, got {n_candidates}")
+    refine = min(refine, n_candidates)
+    if not 1 <= k <= refine:
+        raise ValueError(f"k must be between 1 and {refine}, got {k}")
+    t0 = time.perf_counter()
+    objective = Objective(wrapper.wavelengths, target, peak_nm, fwhm_nm, peak_tol, fwhm_tol)
+    net = _network(wrapper)
+    gate = wrapper.gate or feature_gate(wrapper.base_dir)
+    lo = np.maximum(gate.lo, (FEATURE_MIN - wrapper.X_mean) / wrapper.X_std).astype(np.float32)
+    hi = gate.hi.astype(np.float32)
+
+    rng = np.random.default_rng(seed)
+    n_jitter = n_candidates // 2
+    z = np.empty((n_candidates, len(lo)), dtype=np.float32)
+    z[:n_jitter] = gate.points[rng.integers(len(gate.points), size=n_jitter)]
+    z[:n_jitter] += rng.normal(0, 0.25, size=(n_jitter, len(lo)))
+    z[n_jitter:] = rng.uniform(lo, hi, size=(n_candidates - n_jitter, len(lo)))
+    np.clip(z, lo, hi, out=z)
+
+    with timed("inverse_sweep"):
+        scores = np.empty(n_candidates)
+        for start in range(0, n_candidates, chunk):
+            spectra = _spectra(wrapper, net, z[start:start + chunk])
+            scores[start:start + chunk] = objective.score(spectra)
+        best = np.argpartition(scores, refine - 1)[:refine]
+    t_sweep = time.perf_counter() - t0
+
+    with timed("inverse_refine"):
+        x = z[best].copy()
+        m = np.zeros_like(x)
+        v = np.zeros_like(x)
+        for t in range(1, steps + 1):
+            spectra, backward = _spectra_and_vjp(wrapper, net, x)
+            g = backward(objective.grad(spectra))
+            m = 0.9 * m + 0.1 * g
+            v = 0.999 * v + 0.001 * g ** 2
+            x -= lr * (m / (1 - 0.9 ** t)) / (np.sqrt(v / (1 - 0.999 ** t)) + 1e-8)
+            np.clip(x, lo, hi, out=x)
+
+        # Keep whichever of start point / refined point scores better under the exact objective
+        pool = np.concatenate([z[best], x])
+        spectra = _spectra(wrapper, net, pool)
+        pool_scores = objective.score(spectra)
+
+    feats = pool * wrapper.X_std + wrapper.X_mean
+    check = gate.check(feats)
+    order = np.lexsort((pool_scores, check["flagged"]))
+    chosen = []
+    for i in order:
+        # Refinement tends to pull several starts onto the same optimum
+        if all(np.abs(pool[i] - pool[j]).max() > 0.05 for j in chosen):
+            chosen.append(i)
+        if len(chosen) == k:
+            break
+
+    peak, fwhm = peak_stats(spectra[chosen], wrapper.wavelengths)
+    results = []
+    for n, i in enumerate(chosen):
+        results.append({
+            "features": dict(zip(FEATURE_NAMES, (float(f) for f in feats[i]))),
+            "spectrum": spectra[i],
+            "peak_nm": float(peak[n]),
+            "fwhm_nm": float(fwhm[n]),
+            "score": float(pool_scores[i]),
+            "ood": gate.describe(check, i)
+        })
+    return {
+        "results": results,
+        "wavelengths": wrapper.wavelengths,
+        "n_candidates": n_candidates,
+        "n_refined": refine,
+        "sweep_ms": t_sweep * 1000,
+        "total_ms": (time.perf_counter() - t0) * 1000
+    }
+
+if __name__ == "__main__":
+    import argparse
+    from src.eval.infer_multi import load_registered
+
+    parser = argparse.ArgumentParser(description="Search morphology features for a target peak / FWHM or spectrum")
+    parser.add_argument("--model", type=str, default="final_demo_model",
+                        help="Registered model name or registry JSON path")
+    parser.add_argument("--peak", type=float, default=None, help="Target peak wavelength (nm)")
+    parser.add_argument("--fwhm", type=float, default=None, help="Target FWHM (nm)")
+    parser.add_argument("--target", type=str, default=None, help=".npy spectrum on the model's wavelength grid")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--n_candidates", type=int, default=100_000)
+    args = parser.parse_args()
+
+    wrapper = load_registered(args.model)
+    target = np.load(args.target) if args.target else None
+
+    out = inverse_design(wrapper, target=target, peak_nm=args.peak, fwhm_nm=args.fwhm,
+                         k=args.k, n_candidates=args.n_candidates)
+    print(f"{out['n_candidates']:,} candidates in {out['sweep_ms']:.0f} ms, {out['total_ms']:.0f} ms total")
+    for r in out["results"]:
+        f = r["features"]
+        print(f"  peak {r['peak_nm']:.0f} nm  fwhm {r['fwhm_nm']:.0f} nm  score {r['score']:.4f}  "
+              f"diam {f['mean_diam_px']:.1f}  std {f['std_diam_px']:.1f}  count {f['particle_count']:.0f}  "
+              f"aspect {f['mean_aspect']:.2f}{'  (OOD)' if r['ood']['flagged'] else ''}")
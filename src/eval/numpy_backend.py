@@ -0,0 +1,215 @@
+import os
+import sys
+import pickle
+import zipfile
+import collections
+import numpy as np
+
+# Storage classes that can appear in a torch zip checkpoint and their dtypes
+_STORAGE_DTYPES = {
+    "FloatStorage": np.float32,
+    "DoubleStorage": np.float64,
+    "HalfStorage": np.float16,
+    "LongStorage": np.int64,
+    "IntStorage": np.int32,
+}
+
+class _StorageType:
+    def __init__(self, dtype):
+        self.dtype = dtype
+
+def _rebuild_tensor_v2(storage, offset, size, stride, *args):
+    itemsize = storage.dtype.itemsize
+    return np.lib.stride_tricks.as_strided(
+        storage[offset:], shape=tuple(size), strides=tuple(s * itemsize for s in stride)
+    ).copy()
+
+class _TorchUnpickler(pickle.Unpickler):
+    """Reads a torch.save() zip checkpoint of plain tensors without importing torch."""
+
+    def __init__(self, file, archive, prefix):
+        super().__init__(file)
+        self.archive = archive
+        self.prefix = prefix
+
+    def find_class(self, module, name):
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return _rebuild_tensor_v2
+        if module == "torch" and name in _STORAGE_DTYPES:
+            return _StorageType(_STORAGE_DTYPES[name])
+        if module == "collections" and name == "OrderedDict":
+            return collections.OrderedDict
+        raise pickle.UnpicklingError(f"Unsupported object in checkpoint: {module}.{name}")
+
+    def persistent_load(self, pid):
+        # ('storage', storage_type, key, location, numel)
+        _, storage_type, key, _, numel = pid
+        buf = self.archive.read(f"{self.prefix}data/{key}")
+        return np.frombuffer(buf, dtype=storage_type.dtype, count=numel)
+
+def read_torch_state_dict(path):
+    """
+    Load a state dict saved with torch.save() as {name: np.ndarray}.
+    Raises ValueError for anything that is not a plain tensor state dict
+    (pickled nn.Module, legacy non-zip format, exotic dtypes).
+    """
+    if not zipfile.is_zipfile(path):
+        raise ValueError(f"{path} is not a zip-format torch checkpoint")
+    with zipfile.ZipFile(path) as archive:
+        pkl = [n for n in archive.namelist() if n.endswith("data.pkl")]
+        if not pkl:
+            raise ValueError(f"{path} has no data.pkl")
+        prefix = pkl[0][:-len("data.pkl")]
+        if sys.byteorder != "little" or archive.read(prefix + "byteorder").strip() != b"little":
+            raise ValueError("Only little-endian checkpoints are supported")
+        with archive.open(pkl[0]) as f:
+            try:
+                obj = _TorchUnpickler(f, archive, prefix).load()
+            except pickle.UnpicklingError as e:
+                raise ValueError(str(e))
+    if not isinstance(obj, dict):
+        raise ValueError(f"{path} does not contain a state dict")
+    return obj
+
+class NumpyMLP:
+    """
+    Pure-NumPy forward pass for SpectrumMLP-style Linear/ReLU stacks.
+    Weights are kept transposed as contiguous float32 (in, out) matrices,
+    so each layer is a single batched GEMM + bias + in-place ReLU.
+    """
+
+    def __init__(self, weights, biases):
+        self.weights = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.ascontiguousarray(b, dtype=np.float32) for b in biases]
+
+    @property
+    def in_dim(self):
+        return self.weights[0].shape[0]
+
+    @property
+    def out_dim(self):
+        return self.weights[-1].shape[1]
+
+    @property
+    def signature(self):
+        # Models with the same signature can be stacked into one StackedMLP
+        return tuple(w.shape for w in self.weights)
+
+    def __call__(self, x):
+        h = np.asarray(x, dtype=np.float32)
+        last = len(self.weights) - 1
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            h = h @ w
+            h += b
+            if i < last:
+                np.maximum(h, 0, out=h)
+        return h
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        # Lightning checkpoints nest the weights and prefix them with 'model.'
+        if "state_dict" in state_dict:
+            state_dict = {k.replace("model.", ""): v for k, v in state_dict["state_dict"].items()}
+        layer_ids = sorted(int(k.split(".")[1]) for k in state_dict if k.startswith("net.") and k.endswith(".weight"))
+        expected = {f"net.{i}.{p}" for i in layer_ids for p in ("weight", "bias")}
+        if not layer_ids or set(state_dict) != expected:
+            raise ValueError("State dict is not a plain Linear/ReLU stack")
+        weights = [np.asarray(state_dict[f"net.{i}.weight"]).T for i in layer_ids]
+        biases = [np.asarray(state_dict[f"net.{i}.bias"]) for i in layer_ids]
+        return cls(weights, biases)
+
+    def vjp(self, x):
+        return _vjp(self.weights, self.biases, x)
+
+    @classmethod
+    def load(cls, path):
+        if path.endswith(".npz"):
+            data = np.load(path)
+            n = len(data.files) // 2
+            return cls([data[f"w{i}"] for i in range(n)], [data[f"b{i}"] for i in range(n)])
+        return cls.from_state_dict(read_torch_state_dict(path))
+
+    def save(self, path):
+        arrays = {}
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            arrays[f"w{i}"] = w
+            arrays[f"b{i}"] = b
+        np.savez(path, **arrays)
+
+class StackedMLP:
+    """
+    M NumpyMLPs with identical layer shapes evaluated as one batched
+    computation: weights are stacked to (M, in, out) and every layer is a
+    single np.matmul over the model axis.
+    """
+
+    def __init__(self, models):
+        if len({m.signature for m in models}) != 1:
+            raise ValueError("Stacked models must share the same layer shapes")
+        n_layers = len(models[0].weights)
+        self.weights = [np.stack([m.weights[i] for m in models]) for i in range(n_layers)]
+        self.biases = [np.stack([m.biases[i] for m in models])[:, None, :] for i in range(n_layers)]
+
+    @classmethod
+    def from_arrays(cls, weights, biases):
+        """Already stacked (M, in, out) weights and (M, 1, out) biases, used as given (e.g. memory-mapped)."""
+        stacked = cls.__new__(cls)
+        stacked.weights = list(weights)
+        stacked.biases = list(biases)
+        return stacked
+
+    def __len__(self):
+        return self.weights[0].shape[0]
+
+    def __call__(self, x):
+        # x: (N, in) shared by all members, or (M, N, in) per member -> (M, N, out)
+        h = np.asarray(x, dtype=np.float32)
+        last = len(self.weights) - 1
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            h = np.matmul(h, w)
+            h += b
+            if i < last:
+                np.maximum(h, 0, out=h)
+        return h
+
+    def vjp(self, x):
+        return _vjp(self.weights, self.biases, x)
+
+def _vjp(weights, biases, x):
+    """
+    Forward pass that keeps the ReLU masks, for gradients w.r.t. the input.
+    Returns (out, backward) where backward(grad_out) -> grad_in. With stacked
+    (M, in, out) weights and a shared (N, in) input, member gradients are summed.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    h = x
+    masks = []
+    last = len(weights) - 1
+    for i, (w, b) in enumerate(zip(weights, biases)):
+        h = np.matmul(h, w)
+        h += b
+        if i < last:
+            masks.append(h > 0)
+            h *= masks[-1]
+
+    def backward(grad_out):
+        g = np.asarray(grad_out, dtype=np.float32)
+        for i in range(last, -1, -1):
+            g = np.matmul(g, np.swapaxes(weights[i], -1, -2))
+            if i > 0:
+                g *= masks[i - 1]
+        if g.ndim > x.ndim:
+            g = g.sum(axis=0)
+        return g
+
+    return h, backward
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert a SpectrumMLP .pth state dict to a NumPy .npz")
+    parser.add_argument("src", type=str)
+    parser.add_argument("dst", type=str, nargs="?", default=None)
+    args = parser.parse_args()
+    dst = args.dst or os.path.splitext(args.src)[0] + ".npz"
+    NumpyMLP.load(args.src).save(dst)
+    print(f"Saved {dst}")
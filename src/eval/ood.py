@@ -0,0 +1,107 @@
+import os
+import numpy as np
+
+FEATURE_NAMES = ["mean_diam_px", "std_diam_px", "particle_count", "mean_aspect"]
+
+def load_training_features(base_dir):
+    # np.loadtxt on the four numeric columns avoids importing pandas in the serving path
+    path = os.path.join(base_dir, "data", "processed", "morphology_features.csv")
+    return np.loadtxt(path, delimiter=",", skiprows=1, usecols=(0, 1, 2, 3), dtype=np.float32, ndmin=2)
+
+class FeatureGate:
+    """
+    Out-of-distribution check over normalized training features.
+
+    Two tests, both in X_mean/X_std units:
+      - range: each feature must lie within the training [q, 1-q] quantiles
+        widened by `margin` standard deviations;
+      - density: distance to the k-th nearest training point must not exceed
+        the `density_q` quantile of the same distance among training points
+        (leave-one-out), i.e. the input must sit in a populated region.
+    The index is just the normalized training matrix (N x 4 float32) plus a
+    handful of thresholds; brute-force distances to ~1k points take microseconds.
+    """
+
+    def __init__(self, X_train, X_mean, X_std, k=5, q=0.005, margin=0.5, density_q=0.99):
+        self.X_mean = X_mean
+        self.X_std = X_std
+        self.k = k
+        self.points = np.ascontiguousarray((X_train - X_mean) / X_std, dtype=np.float32)
+        self.lo = np.quantile(self.points, q, axis=0) - margin
+        self.hi = np.quantile(self.points, 1 - q, axis=0) + margin
+        self._sq_norms = (self.points ** 2).sum(axis=1)
+
+        # Leave-one-out k-NN distance of every training point (the point itself is at distance 0)
+        kth = self._kth_distance(self.points, k + 1)
+        self.radius = float(np.quantile(kth, density_q))
+
+    @classmethod
+    def from_training_data(cls, base_dir, X_mean, X_std, **kwargs):
+        return cls(load_training_features(base_dir), X_mean, X_std, **kwargs)
+
+    def state(self):
+        """Arrays that rebuild this gate via from_state() without the leave-one-out k-NN pass."""
+        return {
+            "X_mean": self.X_mean,
+            "X_std": self.X_std,
+            "points": self.points,
+            "lo": self.lo,
+            "hi": self.hi,
+            "sq_norms": self._sq_norms,
+            "k": np.array(self.k),
+            "radius": np.array(self.radius)
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        gate = cls.__new__(cls)
+        gate.X_mean = state["X_mean"]
+        gate.X_std = state["X_std"]
+        gate.points = state["points"]
+        gate.lo = state["lo"]
+        gate.hi = state["hi"]
+        gate._sq_norms = state["sq_norms"]
+        gate.k = int(state["k"])
+        gate.radius = float(state["radius"])
+        return gate
+
+    def _kth_distance(self, z, k):
+        # |a-b|^2 = |a|^2 + |b|^2 - 2 a.b, chunked to keep the (n, N) block small
+        out = np.empty(len(z), dtype=np.float32)
+        for start in range(0, len(z), 1024):
+            zc = z[start:start + 1024]
+            d2 = (zc ** 2).sum(axis=1)[:, None] + self._sq_norms[None, :] - 2 * zc @ self.points.T
+            np.maximum(d2, 0, out=d2)
+            out[start:start + 1024] = np.sqrt(np.partition(d2, k - 1, axis=1)[:, k - 1])
+        return out
+
+    def check(self, feats):
+        """
+        (N, 4) raw features -> dict of arrays: flagged (bool), density score
+        (k-NN distance / radius; > 1 is sparser than 99% of training points)
+        and out_of_range (bool per feature).
+        """
+        z = (np.atleast_2d(np.asarray(feats, dtype=np.float32)) - self.X_mean) / self.X_std
+        out_of_range = self._out_of_range(z)
+        score = self._kth_distance(z.astype(np.float32), self.k) / self.radius
+        return {
+            "flagged": out_of_range.any(axis=1) | (score > 1.0),
+            "score": score,
+            "out_of_range": out_of_range
+        }
+
+    def _out_of_range(self, z):
+        return (z < self.lo) | (z > self.hi)
+
+    def in_range(self, feats):
+        """Range test only (no neighbour search), cheap enough for very large batches."""
+        z = (np.atleast_2d(np.asarray(feats, dtype=np.float32)) - self.X_mean) / self.X_std
+        return ~self._out_of_range(z).any(axis=1)
+
+    def describe(self, check, i=0):
+        """JSON-friendly summary of one row of check()."""
+        return {
+            "flagged": bool(check["flagged"][i]),
+            "score": round(float(check["score"][i]), 4),
+            "out_of_range": [name for name, bad in zip(FEATURE_NAMES, check["out_of_range"][i]) if bad]
+        }
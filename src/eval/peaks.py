@@ -0,0 +1,417 @@
+import os
+import sys
+import time
+from functools import lru_cache
+import numpy as np
+from scipy.ndimage import correlate1d
+from scipy.signal import savgol_coeffs, savgol_filter
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+
+# Peaks whose prominence is below this fraction of the row's (max - min) are noise
+MIN_PROMINENCE = 0.05
+MAX_PEAKS = 4
+# Savitzky-Golay window (samples, quadratic) applied before measuring; network outputs and
+# digitized spectra carry sample-to-sample ripple that would otherwise register as bands
+SMOOTH = 9
+# Up to this many peak x wavelength values, crossings are found for all peaks at once
+SMALL_BATCH = 1 << 16
+
+PEAK_FIELDS = ("center_nm", "height", "prominence", "fwhm_nm", "left_nm", "right_nm", "area", "centroid_nm")
+
+def analyze(spectra, wavelengths, max_peaks=MAX_PEAKS, min_prominence=MIN_PROMINENCE, smooth=SMOOTH, areas=True):
+    """
+    Peaks of every row of (N, W) spectra, vectorized over the batch.
+
+    Returns a dict of (N, max_peaks) arrays (NaN-padded), sorted by height so
+    column 0 is the main peak, plus "count" (N,):
+      center_nm   parabolic (sub-grid) position of the maximum
+      height      interpolated height at center_nm
+      prominence  height above the higher of the two bases (the lowest points
+                  between the peak and the nearest higher peak, or the spectrum
+                  edge, on each side), as in scipy.signal.peak_prominences
+      fwhm_nm     width at half prominence (left_nm .. right_nm, linearly
+                  interpolated); the usual FWHM for a peak on a zero baseline,
+                  and it separates overlapping bands (e.g. a nanorod's
+                  transverse and longitudinal plasmons) instead of spanning both
+      area        integral of the spectrum above the base level, out to where it
+                  drops to the base or to the valley before a neighbouring peak
+      centroid_nm first moment of that area
+    Everything is measured on a Savitzky-Golay smoothed copy (`smooth` samples,
+    0 for the raw spectra), which leaves smooth (e.g. Mie) spectra unchanged.
+    A peak on the first or last wavelength counts (Mie spectra of small spheres
+    rise towards the UV edge); its outer side has no base and its width is
+    measured to the edge. Rows with NaN or inf values have no peaks.
+
+    max_peaks=1 only looks at the row maximum (rows where that is not a
+    prominent peak take the full search), and areas=False leaves area and
+    centroid_nm NaN; both give the same values as the full analysis.
+    """
+    y = np.atleast_2d(np.asarray(spectra))
+    # float32 batches (model outputs) stay float32: half the memory traffic, ample precision here
+    y = np.ascontiguousarray(y, dtype=y.dtype if y.dtype in (np.float32, np.float64) else np.float64)
+    wl = np.asarray(wavelengths, dtype=np.float64)
+    n, w = y.shape
+    out = {f: np.full((n, max_peaks), np.nan) for f in PEAK_FIELDS}
+    out["count"] = np.zeros(n, dtype=np.int64)
+    if n == 0 or w < 2:
+        return out
+    finite = np.isfinite(y).all(axis=1)
+    if not finite.all():
+        # Smoothing and the comparisons below need finite rows; the others keep count 0
+        sub = analyze(y[finite], wl, max_peaks, min_prominence, smooth, areas)
+        for name, values in sub.items():
+            out[name][finite] = values
+        return out
+    if smooth and w > smooth:
+        y = _smooth(y, smooth)
+
+    if max_peaks == 1:
+        rows, cols, heights, prominence, base, rank = _highest(y, min_prominence)
+    else:
+        rows, cols, heights, prominence, base, rank = _peaks(y, max_peaks, min_prominence)
+    out["count"] = np.bincount(rows, minlength=n)
+    if len(rows) == 0:
+        return out
+    flat = y.ravel()
+
+    # 5. Sub-grid maximum: parabola through the peak and its neighbours
+    grid = np.arange(w, dtype=np.float64)
+    inner = (cols > 0) & (cols < w - 1)
+    yl = flat[rows * w + np.maximum(cols - 1, 0)]
+    yr = flat[rows * w + np.minimum(cols + 1, w - 1)]
+    curv = yl - 2 * heights + yr
+    offset = np.where(inner & (curv < 0), 0.5 * (yl - yr) / np.where(curv < 0, curv, -1.0), 0.0)
+    offset = np.minimum(np.maximum(offset, -0.5), 0.5)
+    center = np.interp(cols + offset, grid, wl)
+    height = heights - 0.25 * (yl - yr) * offset
+
+    # 6. Half-prominence crossings (interpolated) and the extent down to the base level.
+    # After the top-k cut a row has at most one peak of each rank, so each rank is
+    # one pass of whole-row comparisons rather than a per-peak walk; small batches
+    # (a single prediction) take every peak in one pass
+    half = heights - prominence / 2
+    left_x, right_x = np.empty(len(rows)), np.empty(len(rows))
+    lo, hi = np.empty(len(rows), dtype=np.int64), np.empty(len(rows), dtype=np.int64)
+    small = len(rows) * w <= SMALL_BATCH
+    for k in range(1 if small else max_peaks):
+        sel = np.arange(len(rows)) if small else np.flatnonzero(rank == k)
+        if len(sel) == 0:
+            break
+        yk = y if len(sel) == n and not small else y[rows[sel]]
+        left_x[sel], right_x[sel], lo_k, hi_k = _crossings(yk, cols[sel], half[sel], base[sel] if areas else None)
+        if areas:
+            lo[sel], hi[sel] = lo_k, hi_k
+    left_nm, right_nm = np.interp(left_x, grid, wl), np.interp(right_x, grid, wl)
+    for name, values in (("center_nm", center), ("height", height), ("prominence", prominence),
+                         ("fwhm_nm", right_nm - left_nm), ("left_nm", left_nm), ("right_nm", right_nm)):
+        out[name][rows, rank] = values
+    if not areas:
+        return out
+
+    # Each area covers one band: cut at the lowest point between neighbouring peaks of a row
+    by_col = np.lexsort((cols, rows))
+    pair = np.flatnonzero(rows[by_col][1:] == rows[by_col][:-1])
+    if len(pair):
+        a, b = by_col[pair], by_col[pair + 1]               # left and right peak of each pair
+        layer = pair - np.searchsorted(rows[by_col], rows[a])
+        valley = np.empty(len(pair), dtype=np.int64)
+        for k in range(1 if small else max_peaks - 1):
+            sel = np.arange(len(pair)) if small else np.flatnonzero(layer == k)
+            if len(sel) == 0:
+                break
+            between = (grid > cols[a[sel], None]) & (grid < cols[b[sel], None])
+            valley[sel] = np.where(between, y[rows[a[sel]]], np.inf).argmin(axis=1)
+        hi[a] = np.minimum(hi[a], valley)
+        lo[b] = np.maximum(lo[b], valley)
+
+    # 7. Area above the base and its centroid: trapezoid sums over [lo, hi], each
+    # one reduceat segment of the weighted spectra (wavelengths taken about their
+    # mean to keep float32 sums accurate)
+    dx = np.diff(wl)
+    half_l, half_r = np.r_[0.0, dx] / 2, np.r_[dx, 0.0] / 2  # half the spacing to each neighbour
+    x = wl - wl.mean()
+    bounds = np.stack([rows * w + lo, rows * w + hi + 1], axis=1).ravel()
+    buf = np.zeros(n * w + 1, dtype=y.dtype)                 # room for the end bound of the last row
+    sums = []
+    for f in (half_l + half_r, (half_l + half_r) * x):
+        np.multiply(y, f.astype(y.dtype), out=buf[:-1].reshape(n, w))
+        sums.append(np.add.reduceat(buf, bounds)[::2].astype(np.float64))
+    y_lo, y_hi = flat[rows * w + lo], flat[rows * w + hi]
+    area = sums[0] - y_lo * half_l[lo] - y_hi * half_r[hi] - base * (wl[hi] - wl[lo])
+    moment = sums[1] - y_lo * x[lo] * half_l[lo] - y_hi * x[hi] * half_r[hi] - base * (x[hi] ** 2 - x[lo] ** 2) / 2
+    out["area"][rows, rank] = area
+    out["centroid_nm"][rows, rank] = np.where(area > 0, wl.mean() + moment / np.where(area > 0, area, 1.0), center)
+    return out
+
+@lru_cache(maxsize=8)
+def _savgol_weights(window):
+    # savgol_filter(mode="interp") is linear: one fixed filter inside the row, and the
+    # quadratic fitted to the first / last `window` samples for the half-windows at the
+    # edges. Fixed weights skip scipy's per-call least-squares edge fits
+    v = np.vander(np.arange(window, dtype=np.float64), 3)
+    return savgol_coeffs(window, 2, use="dot"), v @ np.linalg.pinv(v)
+
+def _smooth(y, window):
+    """savgol_filter(y, window, 2, axis=1) for odd windows, in y's dtype."""
+    if window % 2 == 0:
+        return savgol_filter(y, window, 2, axis=1).astype(y.dtype)
+    coeffs, fit = _savgol_weights(window)
+    coeffs, fit = coeffs.astype(y.dtype), fit.astype(y.dtype)
+    h = window // 2
+    out = correlate1d(y, coeffs, axis=1)
+    out[:, :h] = y[:, :window] @ fit[:h].T
+    out[:, -h:] = y[:, -window:] @ fit[window - h:].T
+    return out
+
+def _peaks(y, max_peaks, min_prominence):
+    """rows, cols, heights, prominence, base and rank of the max_peaks highest prominent peaks of every row."""
+    n, w = y.shape
+    # 1. Local maxima (first column of a plateau), including the two edges
+    cand = np.zeros((n, w), dtype=bool)
+    cand[:, 1:-1] = (y[:, 1:-1] > y[:, :-2]) & (y[:, 1:-1] >= y[:, 2:])
+    cand[:, 0] = y[:, 0] > y[:, 1]
+    cand[:, -1] = y[:, -1] > y[:, -2]
+    pos = np.flatnonzero(cand)
+    rows, cols = np.divmod(pos, w)
+    flat = y.ravel()
+    heights = flat[pos]
+    if len(pos) == 0:
+        return rows, cols, heights, heights, heights, rows
+
+    # 2. Minimum of every segment between consecutive maxima of a row (and to the row edges)
+    first_col = cand[:, 0].copy()
+    cand[:, 0] = True
+    seg_min = np.minimum.reduceat(flat, np.flatnonzero(cand))
+    # Segment starting at each peak: its own index plus the row starts (up to its row) that are not peaks
+    seg = np.arange(len(pos)) + np.cumsum(~first_col)[rows]
+    # Segment ending just before each peak (empty for a peak on the first column)
+    seg_left = np.where(cols > 0, seg_min[seg - 1], np.inf)
+    seg_right = np.where(cols < w - 1, seg_min[seg], np.inf)
+
+    # 3. The base on each side is the lowest point before a higher peak (or the row edge).
+    # Pointer jumping past lower neighbouring maxima: each round a peak takes over its
+    # neighbour's pointer and span minimum, so long runs of small wiggles cost log rounds.
+    # An edge peak has no base on its outer side (-inf, ignored by the max below)
+    same_prev = np.r_[False, rows[1:] == rows[:-1]]
+    same_next = np.r_[rows[:-1] == rows[1:], False]
+    left_min = np.where(cols > 0, _span_min(heights, seg_left, same_prev, -1), -np.inf)
+    right_min = np.where(cols < w - 1, _span_min(heights, seg_right, same_next, 1), -np.inf)
+    base = np.maximum(left_min, right_min)
+    # A one-sided edge peak with no lower side at all (monotone row) has its base at the row minimum
+    row_min = y.min(axis=1)
+    row_max = y.max(axis=1)
+    base = np.where(np.isfinite(base), base, row_min[rows])
+    prominence = heights - base
+
+    # 4. Keep prominent peaks, the max_peaks highest per row
+    keep = prominence >= min_prominence * np.maximum(row_max - row_min, 1e-12)[rows]
+    keep &= prominence > 0
+    rows, cols, heights, prominence, base = rows[keep], cols[keep], heights[keep], prominence[keep], base[keep]
+    order = np.lexsort((-heights, rows))
+    rows, cols, heights, prominence, base = rows[order], cols[order], heights[order], prominence[order], base[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = rank < max_peaks
+    return rows[keep], cols[keep], heights[keep], prominence[keep], base[keep], rank[keep]
+
+def _highest(y, min_prominence):
+    """
+    _peaks(y, 1, min_prominence) from the row maxima. The highest local maximum
+    is the first column of the row maximum and, with no higher peak, its bases
+    are the minima of everything to either side. Rows where that column is not a
+    prominent peak (a lower peak is the main one, or none is) go through _peaks.
+    """
+    n, w = y.shape
+    r = np.arange(n)
+    cols = y.argmax(axis=1)
+    heights = y[r, cols]
+    # Minima left and right of the maximum: segments [start, col) and [col + 1, end) of each
+    # row in one reduceat (the index is clamped for a maximum on the very last value; an
+    # empty side is masked below)
+    start = r * w
+    bounds = np.stack([start, start + cols, np.minimum(start + cols + 1, n * w - 1)], axis=1).ravel()
+    mins = np.minimum.reduceat(y.ravel(), bounds).reshape(n, 3)
+    left = np.where(cols > 0, mins[:, 0], -np.inf)
+    right = np.where(cols < w - 1, mins[:, 2], -np.inf)
+    row_min = np.minimum(np.where(cols > 0, mins[:, 0], heights), np.where(cols < w - 1, mins[:, 2], heights))
+    base = np.maximum(left, right)
+    prominence = heights - base
+    # Only a maximum on the first column can fail to be a local maximum (a plateau at the edge)
+    ok = (cols > 0) | (y[:, 0] > y[:, 1])
+    ok &= prominence >= min_prominence * np.maximum(heights - row_min, 1e-12)
+    ok &= prominence > 0
+    found = (r[ok], cols[ok], heights[ok], prominence[ok], base[ok], np.zeros(ok.sum(), dtype=np.int64))
+    if ok.all():
+        return found
+    rest = np.flatnonzero(~ok)
+    more = _peaks(y[rest], 1, min_prominence)
+    merged = [np.concatenate([a, b]) for a, b in zip(found, (rest[more[0]],) + more[1:])]
+    # Row order, as from _peaks (analyze indexes y directly when every row has a peak)
+    order = np.argsort(merged[0], kind="stable")
+    return tuple(a[order] for a in merged)
+
+def _span_min(heights, seg_side, same, direction):
+    """
+    Minimum of the segments from each peak out to the first higher neighbouring
+    peak in `direction` (or the row edge); seg_side is the segment next to each peak.
+    """
+    idx = np.arange(len(heights))
+    ptr = np.where(same, idx + direction, -1)
+    span = seg_side.copy()
+    active = np.flatnonzero((ptr >= 0) & (heights[np.maximum(ptr, 0)] <= heights))
+    while len(active):
+        p = ptr[active]
+        # Everything between a peak and its pointer is no higher than the peak, so spans chain
+        span[active] = np.minimum(span[active], span[p])
+        nxt = ptr[p]
+        ptr[active] = nxt
+        keep = nxt >= 0
+        keep[keep] = heights[nxt[keep]] <= heights[active[keep]]
+        active = active[keep]
+    return span
+
+def _crossings(y, cols, half, base):
+    """
+    For one peak per row of y at `cols`: the fractional columns where the
+    spectrum first drops below `half` walking left and right (linearly
+    interpolated), and the first columns at or below `base` (None to skip);
+    the edge column where it never does.
+    """
+    n, w = y.shape
+    r = np.arange(n)
+    grid = np.arange(w)
+    right = grid > cols[:, None]
+    left = grid < cols[:, None]
+    out = []
+    for level, strict in ((half, True), (base, False)):
+        if level is None:
+            out.append((None, None))
+            continue
+        below = (y < level[:, None]) if strict else (y <= level[:, None])
+        m = below & right
+        j = m.argmax(axis=1)
+        right_j = np.where(m[r, j], j, w - 1)
+        m = below & left
+        j = w - 1 - m[:, ::-1].argmax(axis=1)
+        left_j = np.where(m[r, j], j, 0)
+        out.append((left_j, right_j))
+    (left_j, right_j), (lo, hi) = out
+
+    # Linear interpolation between the last point above half and the first below it
+    def interp(j, step):
+        crossed = y[r, j] < half
+        y_below, y_above = y[r, j], y[r, np.minimum(np.maximum(j - step, 0), w - 1)]
+        frac = np.where(y_above > y_below, (y_above - half) / np.where(y_above > y_below, y_above - y_below, 1.0), 1.0)
+        return np.where(crossed, j - step + step * np.minimum(np.maximum(frac, 0.0), 1.0), j)
+
+    return interp(left_j, -1), interp(right_j, 1), lo, hi
+
+def primary(peaks, spectra=None, wavelengths=None):
+    """(peak_nm, fwhm_nm) of the main peak of every row; rows without one fall back to the argmax and 0."""
+    peak_nm = peaks["center_nm"][:, 0].copy()
+    fwhm_nm = peaks["fwhm_nm"][:, 0].copy()
+    missing = peaks["count"] == 0
+    if missing.any():
+        fwhm_nm[missing] = 0.0
+        if spectra is not None:
+            rest = np.atleast_2d(spectra)[missing]
+            peak_nm[missing] = np.asarray(wavelengths)[np.argmax(np.where(np.isfinite(rest), rest, -np.inf), axis=1)]
+    return peak_nm, fwhm_nm
+
+def peak_list(peaks, i, decimals=4):
+    """Row i as a JSON-friendly list of per-peak dicts, main peak first."""
+    return [{f: round(float(peaks[f][i, k]), decimals) for f in PEAK_FIELDS} for k in range(int(peaks["count"][i]))]
+
+def scipy_check(n=2000, seed=0, rtol=1e-6):
+    """
+    Compare analyze(smooth=0) row by row with scipy.signal.find_peaks,
+    peak_prominences and peak_widths on random spectra: sums of up to five
+    Gaussians on a sloped baseline, half of them with noise (dozens of small
+    maxima per row, which exercises the pointer-jumping bases). Only interior
+    peaks are compared; scipy never reports the edges. Returns the mismatches.
+    """
+    from scipy.signal import find_peaks, peak_prominences, peak_widths
+
+    rng = np.random.default_rng(seed)
+    wl = np.linspace(300, 800, 251)
+    w, step = len(wl), wl[1] - wl[0]
+    k = rng.integers(1, 6, size=(n, 1))
+    amps = rng.uniform(0.05, 1.0, size=(n, 5)) * (np.arange(5) < k)
+    centers, widths = rng.uniform(250, 850, size=(n, 5)), rng.uniform(5, 80, size=(n, 5))
+    spectra = (amps[:, :, None] * np.exp(-0.5 * ((wl - centers[:, :, None]) / widths[:, :, None]) ** 2)).sum(axis=1)
+    spectra += rng.uniform(0, 0.2, size=(n, 1)) * (wl - wl[0]) / (wl[-1] - wl[0])
+    spectra[n // 2:] += rng.normal(0, 0.02, size=(n - n // 2, w))
+
+    peaks = analyze(spectra, wl, max_peaks=w // 2 + 1, min_prominence=0, smooth=0)
+    failed = []
+    for i, row in enumerate(spectra):
+        ref = find_peaks(row)[0]
+        count = peaks["count"][i]
+        center = peaks["center_nm"][i, :count]
+        inner = np.flatnonzero((center > wl[0]) & (center < wl[-1]))
+        inner = inner[np.argsort(center[inner])]
+        if len(inner) != len(ref):
+            failed.append(f"row {i}: {len(inner)} interior peaks, scipy {len(ref)}")
+            continue
+        prominence = peak_prominences(row, ref)[0]
+        fwhm = peak_widths(row, ref, rel_height=0.5)[0] * step
+        checks = (("position", (center[inner] - wl[0]) / step, ref, 0.5 + 1e-9),
+                  ("prominence", peaks["prominence"][i, inner], prominence, rtol * prominence.max(initial=0)),
+                  ("fwhm", peaks["fwhm_nm"][i, inner], fwhm, rtol * w * step))
+        for name, ours, theirs, tol in checks:
+            worst = np.abs(ours - theirs).max(initial=0)
+            if worst > tol:
+                failed.append(f"row {i}: {name} differs by {worst:.3g}")
+    return failed
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Multi-peak analysis of spectra (CSV with wavelength,spectrum columns, or a benchmark)")
+    parser.add_argument("csv", nargs="*", help="Spectrum CSVs to analyze")
+    parser.add_argument("--max_peaks", type=int, default=MAX_PEAKS)
+    parser.add_argument("--min_prominence", type=float, default=MIN_PROMINENCE)
+    parser.add_argument("--smooth", type=int, default=SMOOTH, help="Savitzky-Golay window in samples (0: raw spectra)")
+    parser.add_argument("--bench", type=int, default=0, help="Time analyze() on this many training spectra (resampled)")
+    parser.add_argument("--check", type=int, default=0,
+                        help="Compare with scipy.signal on this many random spectra; exits 1 on a mismatch")
+    args = parser.parse_args()
+
+    import csv
+    for path in args.csv:
+        with open(path, newline="") as f:
+            rows = [(float(r["wavelength"]), float(r["spectrum"])) for r in csv.DictReader(f)]
+        wl, spec = np.array(rows).T
+        peaks = analyze(spec, wl, args.max_peaks, args.min_prominence, args.smooth)
+        print(os.path.basename(path))
+        for p in peak_list(peaks, 0, decimals=3):
+            print(f"  {p['center_nm']:7.1f} nm  height {p['height']:.3f}  prominence {p['prominence']:.3f}  "
+                  f"fwhm {p['fwhm_nm']:6.1f} nm  area {p['area']:.2f}  centroid {p['centroid_nm']:.1f} nm")
+
+    if args.bench:
+        base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+        spectra = np.load(os.path.join(base_dir, "data", "processed", "spectra.npy"))
+        wl = np.load(os.path.join(base_dir, "data", "processed", "wavelengths.npy"))
+        from src.simulation.mie import simulate_spectra
+        # The stored spectra are mostly small spheres peaking at the UV edge; add resonant sizes too
+        spectra = np.concatenate([spectra, simulate_spectra(np.linspace(20, 150, 200))]).astype(np.float32)
+        batch = spectra[np.random.default_rng(0).integers(len(spectra), size=args.bench)]
+        t0 = time.perf_counter()
+        peaks = analyze(batch, wl, args.max_peaks, args.min_prominence, args.smooth)
+        dt = time.perf_counter() - t0
+        print(f"analyze: {args.bench:,} spectra in {dt * 1000:.0f} ms ({dt / args.bench * 1e6:.2f} us/spectrum), "
+              f"{peaks['count'].sum():,} peaks")
+        t0 = time.perf_counter()
+        legacy_argmax = wl[np.argmax(batch, axis=1)]
+        print(f"argmax alone: {(time.perf_counter() - t0) * 1000:.0f} ms; "
+              f"|center - argmax| max {np.nanmax(np.abs(peaks['center_nm'][:, 0] - legacy_argmax)):.2f} nm")
+
+    if args.check:
+        failed = scipy_check(args.check)
+        print(f"scipy check: {args.check:,} spectra, {len(failed)} mismatches")
+        for reason in failed[:20]:
+            print(f"  FAIL {reason}")
+        sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
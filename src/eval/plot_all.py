@@ -1,92 +1,284 @@
 import os
+import sys
 import glob
 import json
-import pandas as pd
-import matplotlib.pyplot as plt
+import time
+import argparse
+import html
 import numpy as np
-from src.eval.infer_multi import ModelWrapper
+import pandas as pd
 
-def main():
-    # Configuration
-    DATA_DIR = "data/experimental_processed"
-    MODELS_DIR = "models/registered"
-    OUT_DIR = "outputs/plots_comparison"
-    
-    os.makedirs(OUT_DIR, exist_ok=True)
-    
-    # 1. Load Models
-    models = {}
-    model_files = glob.glob(os.path.join(MODELS_DIR, "*.json"))
-    for mf in model_files:
-        with open(mf) as f:
-            meta = json.load(f)
-        name = meta['model_name']
-        path = meta['path']
-        if not os.path.isabs(path):
-            path = os.path.abspath(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), path))
-            
-        print(f"Loading {name}...")
-        try:
-            models[name] = ModelWrapper(path)
-        except Exception as e:
-            print(f"Failed to load {name}: {e}")
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-    # 2. Find Samples (images with CSV ground truth)
-    gt_files = glob.glob(os.path.join(DATA_DIR, "*.csv"))
-    print(f"Found {len(gt_files)} samples with Ground Truth.")
-    
-    for gt_path in gt_files:
+def find_samples(data_dir):
+    """(root, gt_csv, tem_image) for every ground-truth CSV with a matching TEM image."""
+    samples = []
+    for gt_path in sorted(glob.glob(os.path.join(data_dir, "*.csv"))):
         filename = os.path.basename(gt_path)
         base_name_full = os.path.splitext(filename)[0]
-        
+
         # Logic to match Plot (CSV) with TEM (PNG)
         # They are usually split into _left and _right from the same original file.
         if base_name_full.endswith("_left"):
             root = base_name_full[:-5]
-            candidate = os.path.join(DATA_DIR, root + "_right.png")
+            candidate = os.path.join(data_dir, root + "_right.png")
         elif base_name_full.endswith("_right"):
             root = base_name_full[:-6]
-            candidate = os.path.join(DATA_DIR, root + "_left.png")
+            candidate = os.path.join(data_dir, root + "_left.png")
         else:
-            candidate = os.path.join(DATA_DIR, base_name_full + ".png")
-            
+            root = base_name_full
+            candidate = os.path.join(data_dir, base_name_full + ".png")
+
         if os.path.exists(candidate):
-            img_path = candidate
+            samples.append((root, gt_path, candidate))
         else:
             print(f"Skipping {filename}: Corresponding TEM image not found at {candidate}")
+    return samples
+
+def load_models(models_dir):
+    from src.eval.infer_multi import ModelWrapper
+
+    models = {}
+    for mf in sorted(glob.glob(os.path.join(models_dir, "*.json"))):
+        with open(mf) as f:
+            meta = json.load(f)
+        name = meta['model_name']
+        path = meta['path']
+        if not os.path.isabs(path):
+            path = os.path.abspath(os.path.join(ROOT_DIR, path))
+
+        print(f"Loading {name}...")
+        try:
+            models[name] = ModelWrapper(path, ood="flag")  # plot the surrogate itself, no Mie fallback
+        except Exception as e:
+            print(f"Failed to load {name}: {e}")
+    return models
+
+def compute_predictions(samples, models, workers=8):
+    """
+    Every model on every sample: features are extracted once per image (in
+    parallel) and each model scores all images in one predict_batch call.
+    Returns (wavelengths, {model: {image_path: spectrum}}).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from src.eval.infer_multi import extract_features
+
+    def work(path):
+        try:
+            return extract_features(path)
+        except Exception as e:
+            print(f"  Feature extraction failed for {os.path.basename(path)}: {e}")
+            return None
+
+    images = sorted({img for _, _, img in samples})
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        feats = dict(zip(images, pool.map(work, images)))
+    ok = [p for p in images if feats[p] is not None]
+
+    wavelengths, predictions = None, {}
+    for name, model in models.items():
+        predictions[name] = {}
+        if not ok:
             continue
-            
-        print(f"Plotting {root} (GT: {base_name_full}, Image: {os.path.basename(img_path)})...")
-        
-        # Load GT
+        try:
+            res = model.predict_batch(np.stack([feats[p] for p in ok]))
+        except Exception as e:
+            print(f"  Error running {name}: {e}")
+            continue
+        wavelengths = res["wavelengths"]
+        predictions[name] = dict(zip(ok, res["spectra"]))
+    return wavelengths, predictions
+
+def save_predictions(path, wavelengths, predictions):
+    arrays = {"wavelengths": wavelengths}
+    index = []
+    for name, per_image in predictions.items():
+        for i, (img, spectrum) in enumerate(per_image.items()):
+            arrays[f"{name}/{i}"] = spectrum
+            index.append([name, img, f"{name}/{i}"])
+    arrays["index"] = np.array(json.dumps(index))
+    np.savez(path, **arrays)
+
+def load_predictions(path, samples, model_names):
+    """
+    Precomputed spectra from a predictions .npz written by this script, or an
+    evaluate_models.py predictions/ directory (<model>_<image base>.csv).
+    """
+    if path.endswith(".npz"):
+        data = np.load(path)
+        predictions = {}
+        for name, img, key in json.loads(str(data["index"])):
+            predictions.setdefault(name, {})[img] = data[key]
+        return data["wavelengths"], predictions
+
+    wavelengths, predictions = None, {}
+    for name in model_names:
+        predictions[name] = {}
+        for _, _, img in samples:
+            csv = os.path.join(path, f"{name}_{os.path.splitext(os.path.basename(img))[0]}.csv")
+            if os.path.exists(csv):
+                df = pd.read_csv(csv)
+                wavelengths = df["wavelength"].values
+                predictions[name][img] = df["prediction"].values
+    return wavelengths, predictions
+
+# --------- Rendering ---------
+# Each plotting process keeps one figure with a ground-truth line and one line per model;
+# a job only swaps line data, title and legend, so no figure/axes/artist is rebuilt per plot.
+_figure = None
+
+def _build_figure(model_names):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    # Created at the output dpi so savefig does not re-layout at a new resolution
+    fig, ax = plt.subplots(figsize=(12, 6), dpi=150)
+    gt_line, = ax.plot([], [], label='Ground Truth (Digitized)', color='black', linewidth=2.5, linestyle='--')
+    lines = {name: ax.plot([], [], label=f'Pred: {name}', linewidth=1.5)[0] for name in model_names}
+    ax.set_xlabel("Wavelength (nm)")
+    ax.set_ylabel("Absorbance (a.u.)")
+    ax.grid(True, alpha=0.3)
+    ax.set_title(" ")  # reserve room for the per-sample title before tight_layout
+    return fig, ax, gt_line, lines
+
+def _init_worker(model_names):
+    global _figure
+    _figure = _build_figure(model_names)
+    _figure[0].tight_layout()
+
+def _draw(job, figure):
+    root, gt_w, gt_s, wavelengths, preds = job
+    fig, ax, gt_line, lines = figure
+    gt_line.set_data(gt_w, gt_s)
+    for name, line in lines.items():
+        line.set_visible(name in preds)
+        if name in preds:
+            line.set_data(wavelengths, preds[name])
+    ax.legend(handles=[gt_line] + [l for l in lines.values() if l.get_visible()])
+    ax.set_title(f"Spectral Prediction: {root}")
+    ax.relim(visible_only=True)
+    ax.autoscale_view()
+
+def _render_png(job):
+    out_path = job[-1]
+    _draw(job[:-1], _figure)
+    # zlib level 1: ~1/3 less time per plot than the default level 6 for a slightly larger file
+    _figure[0].savefig(out_path, pil_kwargs={"compress_level": 1})
+    return out_path
+
+def render_pngs(jobs, model_names, out_dir, workers=4):
+    jobs = [job + (os.path.join(out_dir, f"{job[0]}_comparison.png"),) for job in jobs]
+    # A worker costs ~1 s to start (matplotlib import + figure), so give each one at least 8 plots
+    workers = min(workers, len(jobs) // 8)
+    if workers <= 1:
+        _init_worker(model_names)
+        return [_render_png(job) for job in jobs]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model_names,)) as pool:
+        return list(pool.map(_render_png, jobs, chunksize=max(1, len(jobs) // (4 * workers))))
+
+def render_pdf(jobs, model_names, out_path):
+    """All comparisons as pages of one PDF (vector output, nothing rasterized)."""
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    figure = _build_figure(model_names)
+    figure[0].tight_layout()
+    with PdfPages(out_path) as pdf:
+        for job in jobs:
+            _draw(job, figure)
+            pdf.savefig(figure[0])
+    return out_path
+
+_COLORS = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b", "#e377c2", "#7f7f7f"]
+
+def _svg(root, gt_w, gt_s, wavelengths, preds, model_names, width=720, height=320, pad=40):
+    # Hand-written SVG polylines: no matplotlib, a few kB per sample
+    series = [(gt_w, gt_s)] + [(wavelengths, preds[n]) for n in model_names if n in preds]
+    x_lo = min(float(np.min(w)) for w, _ in series)
+    x_hi = max(float(np.max(w)) for w, _ in series)
+    y_lo = min(float(np.min(s)) for _, s in series)
+    y_hi = max(float(np.max(s)) for _, s in series)
+    y_hi = y_hi if y_hi > y_lo else y_lo + 1.0
+
+    def points(w, s):
+        x = pad + (np.asarray(w, dtype=float) - x_lo) / (x_hi - x_lo) * (width - 2 * pad)
+        y = height - pad - (np.asarray(s, dtype=float) - y_lo) / (y_hi - y_lo) * (height - 2 * pad)
+        return " ".join(f"{a:.1f},{b:.1f}" for a, b in zip(x, y))
+
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-size="11">',
+             f'<rect x="{pad}" y="{pad}" width="{width - 2 * pad}" height="{height - 2 * pad}" fill="none" stroke="#ccc"/>',
+             f'<polyline points="{points(gt_w, gt_s)}" fill="none" stroke="black" stroke-width="2.5" stroke-dasharray="6,4"/>']
+    legend = [("Ground Truth (Digitized)", "black")]
+    for i, name in enumerate(n for n in model_names if n in preds):
+        color = _COLORS[i % len(_COLORS)]
+        parts.append(f'<polyline points="{points(wavelengths, preds[name])}" fill="none" stroke="{color}" stroke-width="1.5"/>')
+        legend.append((f"Pred: {name}", color))
+    for i, (label, color) in enumerate(legend):
+        parts.append(f'<text x="{width - pad - 4}" y="{pad + 14 + 14 * i}" text-anchor="end" fill="{color}">{html.escape(label)}</text>')
+    parts.append(f'<text x="{pad}" y="{height - pad + 16}">{x_lo:.0f} nm</text>')
+    parts.append(f'<text x="{width - pad}" y="{height - pad + 16}" text-anchor="end">{x_hi:.0f} nm</text>')
+    parts.append(f'<text x="{pad}" y="{pad - 8}">{y_hi:.3g}</text>')
+    parts.append("</svg>")
+    return "".join(parts)
+
+def render_html(jobs, model_names, out_path):
+    """Single-file gallery with inline SVG plots."""
+    cards = [f'<div class="card"><h3>{html.escape(job[0])}</h3>{_svg(*job, model_names)}</div>' for job in jobs]
+    with open(out_path, "w") as f:
+        f.write("<!DOCTYPE html><html><head><meta charset='utf-8'><title>Spectral predictions</title>"
+                "<style>body{font-family:sans-serif}.card{display:inline-block;margin:8px;vertical-align:top}"
+                "h3{font-size:13px;max-width:720px;overflow-wrap:anywhere}</style></head><body>"
+                f"<h2>Spectral predictions ({len(jobs)} samples)</h2>{''.join(cards)}</body></html>")
+    return out_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Plot ground truth vs every registered model for the experimental set")
+    parser.add_argument("--data", type=str, default="data/experimental_processed")
+    parser.add_argument("--models_dir", type=str, default="models/registered")
+    parser.add_argument("--out", type=str, default="outputs/plots_comparison")
+    parser.add_argument("--predictions", type=str, default=None,
+                        help="Precomputed predictions: an evaluate_models.py predictions/ dir or a .npz from this script "
+                             "(default: compute once and save to <out>/predictions.npz)")
+    parser.add_argument("--format", choices=["png", "pdf", "html"], default="png",
+                        help="png: one file per sample; pdf: one multipage file; html: one gallery page")
+    parser.add_argument("--workers", type=int, default=4, help="Plotting processes (png)")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    samples = find_samples(args.data)
+    print(f"Found {len(samples)} samples with Ground Truth.")
+
+    # 1. Predictions: loaded, or computed once (batched) and saved for the next run
+    t0 = time.perf_counter()
+    if args.predictions:
+        model_names = sorted(os.path.splitext(os.path.basename(f))[0] for f in glob.glob(os.path.join(args.models_dir, "*.json")))
+        wavelengths, predictions = load_predictions(args.predictions, samples, model_names)
+    else:
+        wavelengths, predictions = compute_predictions(samples, load_models(args.models_dir))
+        save_predictions(os.path.join(args.out, "predictions.npz"), wavelengths, predictions)
+    predictions = {name: per_image for name, per_image in predictions.items() if per_image}
+    model_names = list(predictions)
+    print(f"Predictions for {len(model_names)} models ready in {time.perf_counter() - t0:.2f} s")
+
+    # 2. Plot jobs carry only arrays, so workers never touch a model
+    jobs = []
+    for root, gt_path, img_path in samples:
         df_gt = pd.read_csv(gt_path)
-        
-        # Plot Setup
-        plt.figure(figsize=(12, 6))
-        
-        # Plot GT
-        plt.plot(df_gt['wavelength'], df_gt['spectrum'], label='Ground Truth (Digitized)', color='black', linewidth=2.5, linestyle='--')
-        
-        # Run Models
-        for m_name, model in models.items():
-            try:
-                res = model.predict(image_path=img_path)
-                plt.plot(res['wavelengths'], res['spectrum'], label=f'Pred: {m_name}', linewidth=1.5)
-            except Exception as e:
-                print(f"  Error running {m_name}: {e}")
-                
-        plt.title(f"Spectral Prediction: {root}")
-        plt.xlabel("Wavelength (nm)")
-        plt.ylabel("Absorbance (a.u.)")
-        plt.legend()
-        plt.grid(True, alpha=0.3)
-        plt.tight_layout()
-        
-        out_path = os.path.join(OUT_DIR, f"{root}_comparison.png")
-        plt.savefig(out_path, dpi=150)
-        plt.close()
-        
-    print(f"All plots saved to {OUT_DIR}")
+        preds = {name: predictions[name][img_path] for name in model_names if img_path in predictions[name]}
+        jobs.append((root, df_gt['wavelength'].values, df_gt['spectrum'].values, wavelengths, preds))
+
+    t0 = time.perf_counter()
+    if args.format == "pdf":
+        out = render_pdf(jobs, model_names, os.path.join(args.out, "comparison.pdf"))
+    elif args.format == "html":
+        out = render_html(jobs, model_names, os.path.join(args.out, "comparison.html"))
+    else:
+        render_pngs(jobs, model_names, args.out, workers=args.workers)
+        out = args.out
+    print(f"Rendered {len(jobs)} plots ({args.format}) in {time.perf_counter() - t0:.2f} s -> {out}")
 
 if __name__ == "__main__":
     main()
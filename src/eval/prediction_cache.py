@@ -0,0 +1,67 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+def file_sha1(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class PredictionCache:
+    """
+    Bounded LRU of finished predictions (spectrum, peak, FWHM), keyed by
+    (model id, model file hash, feature vector rounded to `decimals`).
+    Thread-safe; shared by every ModelWrapper in a process.
+    """
+
+    def __init__(self, maxsize=4096, decimals=2):
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, model_id, model_hash, feats):
+        rounded = np.round(np.asarray(feats, dtype=np.float64), self.decimals) + 0.0  # +0.0 folds -0.0 into 0.0
+        return (model_id, model_hash, tuple(rounded.tolist()))
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, model_id=None):
+        """Drop every entry (or only those of one model, e.g. after a hot-swap)."""
+        with self._lock:
+            if model_id is None:
+                self._data.clear()
+            else:
+                for key in [k for k in self._data if k[0] == model_id]:
+                    del self._data[key]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
@@ -3,6 +3,11 @@ import shutil
 import json
 import datetime
 import glob
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from src.models.basis import basis_path_for
 
 # Paths
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
@@ -14,7 +19,25 @@ OUTPUTS_DIR = os.path.join(ROOT_DIR, "outputs")
 os.makedirs(MODELS_DIR, exist_ok=True)
 os.makedirs(DATA_DIR, exist_ok=True)
 
-def register_model(src_path, model_name, origin, notes):
+def _write_metadata(json_path, metadata):
+    """
+    Merge into an existing registry entry: keys set elsewhere ("ood", exported
+    "variants"/"variant", ...) survive re-registration. Keys that describe the
+    old checkpoint (exported variants, basis, ensemble members) are dropped when
+    the entry now points at a different one.
+    """
+    if os.path.exists(json_path):
+        with open(json_path) as f:
+            existing = json.load(f)
+        if existing.get("path") != metadata["path"]:
+            for key in ("variants", "variant", "exported_at", "basis", "ensemble"):
+                existing.pop(key, None)
+        existing.update(metadata)
+        metadata = existing
+    with open(json_path, "w") as f:
+        json.dump(metadata, f, indent=2)
+
+def register_model(src_path, model_name, origin, notes, extra=None):
     dst_path = os.path.join(MODELS_DIR, os.path.basename(src_path))
     if not os.path.exists(dst_path):
         print(f"Copying {src_path} to {dst_path}")
@@ -27,13 +50,174 @@ def register_model(src_path, model_name, origin, notes):
         "notes": notes,
         "registered_at": datetime.datetime.now().isoformat()
     }
+
+    # Compact-head models need their spectral basis to reconstruct spectra
+    src_basis = basis_path_for(src_path)
+    if os.path.exists(src_basis):
+        dst_basis = basis_path_for(dst_path)
+        if not os.path.exists(dst_basis):
+            shutil.copy2(src_basis, dst_basis)
+        metadata["basis"] = f"models/registered/{os.path.basename(dst_basis)}"
+
+    # e.g. sweep metrics and hyperparameters
+    if extra:
+        metadata.update(extra)
     
     json_path = os.path.join(MODELS_DIR, f"{model_name}.json")
-    with open(json_path, "w") as f:
-        json.dump(metadata, f, indent=2)
+    _write_metadata(json_path, metadata)
     print(f"Registered model: {model_name} at {json_path}")
 
+def register_ensemble(member_paths, model_name, origin, notes, extra=None):
+    """
+    Register K checkpoints as one model. Members are served as a stacked
+    forward pass and must share one architecture (and basis, if any).
+    """
+    members = []
+    for p in member_paths:
+        dst = os.path.join(MODELS_DIR, f"{model_name}_{os.path.basename(p)}")
+        shutil.copy2(p, dst)
+        if os.path.exists(basis_path_for(p)):
+            shutil.copy2(basis_path_for(p), basis_path_for(dst))
+        members.append(f"models/registered/{os.path.basename(dst)}")
+
+    metadata = {
+        "model_name": model_name,
+        "path": members[0],
+        "ensemble": members,
+        "origin": origin,
+        "notes": notes,
+        "registered_at": datetime.datetime.now().isoformat()
+    }
+    if os.path.exists(basis_path_for(os.path.join(ROOT_DIR, members[0]))):
+        metadata["basis"] = basis_path_for(members[0])
+    if extra:
+        metadata.update(extra)
+
+    json_path = os.path.join(MODELS_DIR, f"{model_name}.json")
+    _write_metadata(json_path, metadata)
+    print(f"Registered {len(members)}-member ensemble: {model_name} at {json_path}")
+
+# torch is only needed to export variants; plain registration (sweep.py, train.py --ensemble) stays torch-free
+def _eval_inputs(wrapper):
+    import torch
+    # Accuracy deltas are measured on the training feature distribution
+    df = pd.read_csv(os.path.join(ROOT_DIR, "data", "processed", "morphology_features.csv"))
+    X = df[["mean_diam_px","std_diam_px","particle_count","mean_aspect"]].values.astype("float32")
+    X = (X - wrapper.X_mean) / wrapper.X_std
+    return torch.tensor(X, dtype=torch.float32)
+
+def _to_spectra(wrapper, out):
+    out = out.numpy()
+    return wrapper.basis.decode(out) if wrapper.basis is not None else out
+
+def _latency_ms(model, batch_sizes=(1, 64, 1024), repeats=50):
+    import torch
+    latency = {}
+    with torch.no_grad():
+        for bs in batch_sizes:
+            x = torch.randn(bs, 4)
+            for _ in range(5):
+                model(x)
+            times = []
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                model(x)
+                times.append(time.perf_counter() - t0)
+            latency[str(bs)] = round(float(np.median(times)) * 1000, 4)
+    return latency
+
+def export_variants(model_name, int8_tol=0.01):
+    """
+    Export TorchScript and dynamic-int8 artifacts next to a registered model,
+    benchmark each variant and record accuracy deltas vs. the float model.
+    """
+    import torch
+    from src.eval.infer_multi import ModelWrapper, variant_path_for
+
+    json_path = os.path.join(MODELS_DIR, f"{model_name}.json")
+    with open(json_path) as f:
+        meta = json.load(f)
+    model_path = meta["path"]
+    if not os.path.isabs(model_path):
+        model_path = os.path.join(ROOT_DIR, model_path)
+
+    float_wrapper = ModelWrapper(model_path, variant="float")
+    X = _eval_inputs(float_wrapper)
+    example = X[:1]
+    with torch.no_grad():
+        ref = _to_spectra(float_wrapper, float_wrapper.model(X))
+
+    # 1. Export
+    scripted = torch.jit.freeze(torch.jit.trace(float_wrapper.model, example))
+    torch.jit.save(scripted, variant_path_for(model_path, "torchscript"))
+
+    quantized = torch.ao.quantization.quantize_dynamic(float_wrapper.model, {torch.nn.Linear}, dtype=torch.qint8)
+    scripted_q = torch.jit.freeze(torch.jit.trace(quantized, example))
+    torch.jit.save(scripted_q, variant_path_for(model_path, "int8"))
+
+    # 2. Benchmark + accuracy deltas
+    variants = {}
+    for variant in ["float", "torchscript", "int8"]:
+        t0 = time.perf_counter()
+        wrapper = ModelWrapper(model_path, variant=variant)
+        with torch.no_grad():
+            wrapper.model(example)
+        cold_load_ms = (time.perf_counter() - t0) * 1000
+
+        with torch.no_grad():
+            spectra = _to_spectra(wrapper, wrapper.model(X))
+        err = spectra - ref
+        rmse = float(np.sqrt(np.mean(err ** 2)))
+        peak_shift = np.abs(wrapper.wavelengths[np.argmax(spectra, axis=1)] - wrapper.wavelengths[np.argmax(ref, axis=1)])
+
+        artifact = model_path if variant == "float" else variant_path_for(model_path, variant)
+        variants[variant] = {
+            "path": f"models/registered/{os.path.basename(artifact)}",
+            "size_bytes": os.path.getsize(artifact),
+            "cold_load_ms": round(cold_load_ms, 2),
+            "latency_ms": _latency_ms(wrapper.model),
+            "max_abs_err": float(np.abs(err).max()),
+            "rmse": rmse,
+            "rel_rmse": rmse / float(np.sqrt(np.mean(ref ** 2))),
+            "max_peak_shift_nm": float(peak_shift.max())
+        }
+        print(f"  {model_name}/{variant}: {variants[variant]}")
+
+    # Serve int8 only when it stays within tolerance of the float model
+    meta["variants"] = variants
+    meta["variant"] = "int8" if variants["int8"]["rel_rmse"] <= int8_tol else "torchscript"
+    meta["exported_at"] = datetime.datetime.now().isoformat()
+    with open(json_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"Exported {model_name}: serving variant = {meta['variant']}")
+
 def main():
+    parser = argparse.ArgumentParser(description="Register models/data and export inference artifacts")
+    parser.add_argument("--export", type=str, default=None, help="Export TorchScript/int8 variants for model names or 'all'")
+    parser.add_argument("--export_only", action="store_true", help="Skip registration, only run --export")
+    parser.add_argument("--int8_tol", type=float, default=0.01, help="Max relative RMSE for serving the int8 variant")
+    parser.add_argument("--ensemble", type=str, nargs="+", default=None, metavar=("NAME", "PATH"),
+                        help="Register NAME as an ensemble of the given checkpoints (train.py --ensemble K)")
+    args = parser.parse_args()
+
+    if not args.export_only:
+        register_all()
+
+    if args.ensemble:
+        name, paths = args.ensemble[0], args.ensemble[1:]
+        if len(paths) < 2:
+            parser.error("--ensemble needs a name and at least two checkpoints")
+        register_ensemble(paths, name, "ensemble", f"{len(paths)}-member deep ensemble")
+
+    if args.export:
+        if args.export == "all":
+            names = [os.path.splitext(os.path.basename(p))[0] for p in glob.glob(os.path.join(MODELS_DIR, "*.json"))]
+        else:
+            names = args.export.split(",")
+        for name in names:
+            export_variants(name, int8_tol=args.int8_tol)
+
+def register_all():
     print(f"Root dir: {ROOT_DIR}")
     
     # 1. Register Physics Pretrained Model
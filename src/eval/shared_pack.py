@@ -0,0 +1,167 @@
+import os
+import json
+import shutil
+import time
+import numpy as np
+
+from src.eval.numpy_backend import NumpyMLP, StackedMLP
+from src.eval.ood import FeatureGate
+from src.eval.prediction_cache import file_sha1
+from src.eval.similarity import source_hash
+from src.models.basis import SpectralBasis, basis_path_for
+
+# serve.py writes the pack once and points every worker at it through this variable
+PACK_ENV = "NANOOPTICS_PACK"
+
+def model_signature(json_path, model_path):
+    # Same test api.get_model uses to notice a changed registry entry or checkpoint
+    return [os.stat(json_path).st_mtime_ns, os.stat(model_path).st_mtime_ns]
+
+def data_hash(base_dir):
+    # Everything the pack copies out of data/processed: the OOD gate's training table and
+    # the normalization (source_hash), plus the wavelength grid
+    return source_hash(base_dir) + ":" + file_sha1(os.path.join(base_dir, "data", "processed", "wavelengths.npy"))
+
+class SharedPack:
+    """
+    Read-only view of a pack directory: one .npy per array, opened with
+    mmap_mode="r". Every process that attaches maps the same files, so the
+    OS keeps one copy of the weights and lookup tables in the page cache no
+    matter how many workers there are, and attaching costs no parsing,
+    hashing or k-NN precomputation.
+
+    Layout:
+      manifest.json                 models, signatures, data and basis hashes
+      common/{X_mean,X_std,wavelengths}.npy
+      gate/<FeatureGate.state() key>.npy
+      models/<name>/w<i>.npy, b<i>.npy, basis_mean.npy, basis_components.npy
+    """
+
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        with open(os.path.join(pack_dir, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self._gate = None
+
+    def array(self, *parts):
+        return np.load(os.path.join(self.pack_dir, *parts) + ".npy", mmap_mode="r")
+
+    def entry(self, name, json_path, model_path):
+        """
+        Manifest entry for a model, or None if it is not packed or anything it
+        serves changed since the pack was built: the registry JSON, the
+        checkpoint, its basis, or the training data behind normalization,
+        wavelengths and the OOD gate.
+        """
+        entry = self.manifest["models"].get(name)
+        if entry is None:
+            return None
+        try:
+            if model_signature(json_path, model_path) != entry["signature"]:
+                return None
+            if data_hash(self.manifest["root"]) != self.manifest["data_hash"]:
+                print(f"Shared pack {self.pack_dir} is stale (training data changed)")
+                return None
+            if entry["basis_path"]:
+                stale = file_sha1(entry["basis_path"]) != entry["basis_sha1"]
+            else:
+                stale = os.path.exists(basis_path_for(model_path))
+            if stale:
+                print(f"Shared pack {self.pack_dir} is stale for {name} (basis changed)")
+                return None
+        except (OSError, KeyError):
+            return None
+        return entry
+
+    def network(self, name):
+        entry = self.manifest["models"][name]
+        weights = [self.array("models", name, f"w{i}") for i in range(entry["layers"])]
+        biases = [self.array("models", name, f"b{i}") for i in range(entry["layers"])]
+        if entry["members"]:
+            return StackedMLP.from_arrays(weights, biases)
+        return NumpyMLP(weights, biases)
+
+    def basis(self, name):
+        if not self.manifest["models"][name]["basis"]:
+            return None
+        return SpectralBasis(self.array("models", name, "basis_mean"), self.array("models", name, "basis_components"))
+
+    def gate(self):
+        if self._gate is None:
+            self._gate = FeatureGate.from_state({k: self.array("gate", k) for k in self.manifest["gate"]})
+        return self._gate
+
+def attach():
+    """The pack named by $NANOOPTICS_PACK, or None when serving without one."""
+    pack_dir = os.environ.get(PACK_ENV)
+    if not pack_dir:
+        return None
+    return SharedPack(pack_dir)
+
+def build_pack(pack_dir, wrappers, signatures):
+    """
+    Write every NumPy-backed wrapper (plus normalization and the OOD gate) to
+    pack_dir. Torch-backed models are skipped; workers load those themselves.
+    The pack is written next to pack_dir and swapped in with a rename, so
+    workers still mapping an older pack keep reading valid files.
+    """
+    t0 = time.perf_counter()
+    tmp = pack_dir.rstrip("/") + f".{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+
+    def save(arr, *parts):
+        path = os.path.join(tmp, *parts) + ".npy"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, np.asarray(arr))
+
+    manifest = {"models": {}, "gate": [], "created": time.time(), "root": None, "data_hash": None}
+    common = None
+    for name, wrapper in wrappers.items():
+        if wrapper.backend != "numpy":
+            print(f"  {name}: {wrapper.backend} backend, not packed")
+            continue
+        if common is None:
+            common = wrapper
+            save(wrapper.X_mean, "common", "X_mean")
+            save(wrapper.X_std, "common", "X_std")
+            save(wrapper.wavelengths, "common", "wavelengths")
+            gate = wrapper.gate
+            if gate is None:
+                from src.eval.infer_multi import feature_gate
+                gate = feature_gate(wrapper.base_dir)
+            for key, value in gate.state().items():
+                save(value, "gate", key)
+            manifest["gate"] = list(gate.state())
+            manifest["root"] = wrapper.base_dir
+            manifest["data_hash"] = data_hash(wrapper.base_dir)
+
+        net = wrapper.model
+        for i, (w, b) in enumerate(zip(net.weights, net.biases)):
+            save(w, "models", name, f"w{i}")
+            save(b, "models", name, f"b{i}")
+        if wrapper.basis is not None:
+            save(wrapper.basis.mean, "models", name, "basis_mean")
+            save(wrapper.basis.components, "models", name, "basis_components")
+        manifest["models"][name] = {
+            "signature": signatures[name],
+            "model_hash": wrapper.model_hash,
+            "layers": len(net.weights),
+            "members": bool(wrapper.members),
+            "basis": wrapper.basis is not None,
+            "basis_path": wrapper.basis_path,
+            "basis_sha1": file_sha1(wrapper.basis_path) if wrapper.basis_path else None,
+            "variant": wrapper.variant
+        }
+
+    with open(os.path.join(tmp, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    old = None
+    if os.path.exists(pack_dir):
+        old = pack_dir.rstrip("/") + f".{os.getpid()}.old"
+        os.replace(pack_dir, old)
+    os.replace(tmp, pack_dir)
+    if old:
+        shutil.rmtree(old, ignore_errors=True)
+    print(f"Packed {len(manifest['models'])} models into {pack_dir} in {(time.perf_counter() - t0) * 1000:.0f} ms")
+    return manifest
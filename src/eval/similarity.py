@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import hashlib
+from functools import lru_cache
+import numpy as np
+from scipy.spatial import cKDTree
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from src.eval.ood import FEATURE_NAMES, load_training_features
+from src.models.basis import SpectralBasis
+
+# Spectral shapes are smooth: ~8 components keep all but 1e-6 of the variance
+SHAPE_VARIANCE = 1 - 1e-6
+MAX_COMPONENTS = 16
+
+def index_path_for(base_dir):
+    return os.path.join(base_dir, "data", "processed", "similarity_index.npz")
+
+def source_hash(base_dir):
+    # The feature table and the normalization it was trained with; spectra.npy is
+    # generated deterministically from the same table
+    h = hashlib.sha1()
+    for name in ("morphology_features.csv", "X_mean.npy", "X_std.npy"):
+        with open(os.path.join(base_dir, "data", "processed", name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def spectral_shape(spectra):
+    """Peak-normalized spectra, so neighbours are matched on shape rather than amplitude."""
+    spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float32))
+    return spectra / np.maximum(spectra.max(axis=1, keepdims=True), 1e-12)
+
+class SimilarityIndex:
+    """
+    Nearest training samples for a morphology or a spectrum.
+
+    Two KD-trees over the training set:
+      - features: the four inputs in X_mean/X_std units (the model's input space);
+      - spectra: peak-normalized Mie spectra projected onto a PCA basis. The
+        components are orthonormal, so distances equal the L2 distance between
+        shapes inside the basis.
+    Only the arrays are saved (data/processed/similarity_index.npz); the trees
+    are rebuilt on load (~50 ms at 100k samples). The Mie spectra themselves
+    are read from spectra.npy, memory-mapped.
+    """
+
+    def __init__(self, arrays, spectra=None):
+        self.arrays = arrays
+        self.features = arrays["features"]
+        self.X_mean = arrays["X_mean"]
+        self.X_std = arrays["X_std"]
+        self.paths = arrays["paths"]
+        self.wavelengths = arrays["wavelengths"]
+        self.peak_nm = arrays["peak_nm"]
+        self.fwhm_nm = arrays["fwhm_nm"]
+        self.shape_basis = SpectralBasis(arrays["shape_mean"], arrays["shape_components"])
+        self.spectra = spectra
+
+        self.feature_tree = cKDTree((self.features - self.X_mean) / self.X_std)
+        self.shape_tree = cKDTree(arrays["shape_coeffs"])
+
+    def __len__(self):
+        return len(self.features)
+
+    @classmethod
+    def build(cls, features, spectra, wavelengths, X_mean, X_std, paths, source=""):
+        from src.eval.infer_multi import peak_stats
+
+        features = np.asarray(features, dtype=np.float32)
+        spectra = np.asarray(spectra, dtype=np.float32)
+        if len(features) != len(spectra):
+            raise ValueError(f"{len(features)} feature rows but {len(spectra)} spectra")
+
+        shapes = spectral_shape(spectra).astype(np.float64)
+        mean = shapes.mean(axis=0)
+        # Eigenvectors of the W x W scatter matrix: the same components as an SVD of
+        # the N x W data, ~6x faster to build at 100k samples
+        centered = shapes - mean
+        var, vecs = np.linalg.eigh(centered.T @ centered)
+        var, vecs = np.maximum(var[::-1], 0), vecs[:, ::-1]
+        explained = np.cumsum(var) / max(var.sum(), 1e-30)
+        k = int(min(np.searchsorted(explained, SHAPE_VARIANCE) + 1, MAX_COMPONENTS))
+        basis = SpectralBasis(mean, vecs[:, :k].T)
+
+        peak, fwhm = peak_stats(spectra, np.asarray(wavelengths))
+        arrays = {
+            "features": features,
+            "X_mean": np.asarray(X_mean, dtype=np.float32),
+            "X_std": np.asarray(X_std, dtype=np.float32),
+            "paths": np.asarray(paths, dtype=str),
+            "wavelengths": np.asarray(wavelengths, dtype=np.float32),
+            "peak_nm": peak,
+            "fwhm_nm": fwhm,
+            "shape_mean": basis.mean,
+            "shape_components": basis.components,
+            "shape_coeffs": basis.encode(shapes),
+            "source_hash": np.array(source)
+        }
+        return cls(arrays, spectra)
+
+    @classmethod
+    def from_training_data(cls, base_dir):
+        import csv
+
+        processed = os.path.join(base_dir, "data", "processed")
+        with open(os.path.join(processed, "morphology_features.csv"), newline="") as f:
+            paths = [r["image_path"] for r in csv.DictReader(f)]
+        return cls.build(
+            load_training_features(base_dir),
+            np.load(os.path.join(processed, "spectra.npy"), mmap_mode="r"),
+            np.load(os.path.join(processed, "wavelengths.npy")),
+            np.load(os.path.join(processed, "X_mean.npy")),
+            np.load(os.path.join(processed, "X_std.npy")),
+            paths,
+            source=source_hash(base_dir)
+        )
+
+    def save(self, path):
+        tmp = path + f".{os.getpid()}.tmp.npz"
+        np.savez(tmp, **self.arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, spectra=None):
+        with np.load(path) as data:
+            arrays = {k: data[k] for k in data.files}
+        return cls(arrays, spectra)
+
+    # --- Queries ---
+
+    def by_features(self, feats, k=5):
+        """(distances, ids), each (N, k): nearest training samples in normalized feature units."""
+        z = (np.atleast_2d(np.asarray(feats, dtype=np.float32)) - self.X_mean) / self.X_std
+        return self._query(self.feature_tree, z, k)
+
+    def by_spectrum(self, spectra, k=5, wavelengths=None):
+        """
+        (distances, ids), each (N, k): training samples with the closest
+        spectral shape. Distances are RMS differences of peak-normalized spectra.
+        """
+        spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float32))
+        if wavelengths is not None:
+            wavelengths = np.asarray(wavelengths, dtype=np.float32)
+            spectra = np.stack([np.interp(self.wavelengths, wavelengths, s) for s in spectra])
+        if spectra.shape[1] != len(self.wavelengths):
+            raise ValueError(f"Spectrum needs {len(self.wavelengths)} values (or pass its wavelengths), got {spectra.shape[1]}")
+        dist, ids = self._query(self.shape_tree, self.shape_basis.encode(spectral_shape(spectra)), k)
+        return dist / np.sqrt(len(self.wavelengths)), ids
+
+    def _query(self, tree, points, k):
+        k = min(k, len(self))
+        dist, ids = tree.query(points, k=k)
+        return dist.reshape(len(points), k), ids.reshape(len(points), k)
+
+    def describe(self, i, distance, spectrum=True):
+        """JSON-friendly training sample; `id` is the row in morphology_features.csv (and /dataset)."""
+        path = str(self.paths[i])
+        item = {
+            "id": int(i),
+            "name": os.path.basename(path),
+            "folder": os.path.basename(os.path.dirname(path)),
+            "distance": round(float(distance), 6),
+            "features": dict(zip(FEATURE_NAMES, (float(f) for f in self.features[i]))),
+            "peak_nm": float(self.peak_nm[i]),
+            "fwhm_nm": float(self.fwhm_nm[i])
+        }
+        if spectrum and self.spectra is not None:
+            item["spectrum"] = np.asarray(self.spectra[i], dtype=np.float32).tolist()
+        return item
+
+@lru_cache(maxsize=4)
+def similarity_index(base_dir):
+    """
+    The saved index for this checkout, rebuilt (and re-saved) if it is missing
+    or was built from a different feature table / normalization.
+    """
+    path = index_path_for(base_dir)
+    spectra = np.load(os.path.join(base_dir, "data", "processed", "spectra.npy"), mmap_mode="r")
+    current = source_hash(base_dir)
+    if os.path.exists(path):
+        index = SimilarityIndex.load(path, spectra)
+        if str(index.arrays["source_hash"]) == current and len(index) == len(spectra):
+            return index
+    print(f"Building similarity index {path}")
+    index = SimilarityIndex.from_training_data(base_dir)
+    index.spectra = spectra
+    try:
+        index.save(path)
+    except OSError as e:
+        print(f"Could not save similarity index: {e}")
+    return index
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the nearest-neighbour index over training features and spectra")
+    parser.add_argument("--bench", type=int, default=0,
+                        help="Also time queries on an index of this many samples (training rows resampled with jitter)")
+    args = parser.parse_args()
+
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+    t0 = time.perf_counter()
+    index = SimilarityIndex.from_training_data(base_dir)
+    index.save(index_path_for(base_dir))
+    print(f"{len(index)} samples, {index.shape_basis.k} spectral components, "
+          f"built in {(time.perf_counter() - t0) * 1000:.0f} ms -> {index_path_for(base_dir)}")
+
+    if args.bench:
+        rng = np.random.default_rng(0)
+        rows = rng.integers(len(index), size=args.bench)
+        spectra = np.asarray(index.spectra)[rows] * rng.uniform(0.95, 1.05, size=(args.bench, 1))
+        feats = index.features[rows] * rng.uniform(0.95, 1.05, size=(args.bench, 4)).astype(np.float32)
+        t0 = time.perf_counter()
+        big = SimilarityIndex.build(feats, spectra, index.wavelengths, index.X_mean, index.X_std, index.paths[rows])
+        print(f"{args.bench:,} samples built in {(time.perf_counter() - t0) * 1000:.0f} ms")
+        for name, query, queries in (("features", big.by_features, feats[:500]),
+                                     ("spectrum", big.by_spectrum, spectra[:500])):
+            t0 = time.perf_counter()
+            for q in queries:
+                query(q, k=5)
+            print(f"  by_{name}: {(time.perf_counter() - t0) / len(queries) * 1e6:.0f} us/query (k=5)")
+
+if __name__ == "__main__":
+    main()
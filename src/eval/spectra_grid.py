@@ -0,0 +1,168 @@
+import io
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from src.eval.ood import FEATURE_NAMES
+from src.simulation import mie
+
+# Mie axes and their defaults (the constants used to build the training spectra)
+MIE_AXES = {
+    "diameter_nm": 20.0,
+    "n_particle": mie.n_particle,
+    "k_particle": mie.k_particle,
+    "n_medium": mie.n_medium
+}
+
+# 250k spectra x 251 wavelengths is ~250 MB of float32
+MAX_SPECTRA = 250_000
+# Mie costs ~0.4 ms and a few KB of recurrence arrays per spectrum, so 250k
+# would take ~100 s and ~750 MB; keep Mie grids to a few seconds
+MAX_MIE_SPECTRA = 10_000
+
+def parse_axis(spec):
+    """
+    Axis values from a number, a list, {"start", "stop", "num"[, "log"]},
+    or the CLI forms "start:stop:num" and "a,b,c".
+    """
+    if isinstance(spec, str):
+        if ":" in spec:
+            start, stop, num = spec.split(":")
+            spec = {"start": float(start), "stop": float(stop), "num": int(num)}
+        else:
+            spec = [float(v) for v in spec.split(",")]
+    if isinstance(spec, dict):
+        space = np.geomspace if spec.get("log") else np.linspace
+        return space(float(spec["start"]), float(spec["stop"]), int(spec["num"]))
+    values = np.atleast_1d(np.asarray(spec, dtype=np.float64))
+    if values.ndim != 1 or len(values) == 0:
+        raise ValueError(f"Bad axis specification: {spec!r}")
+    return values
+
+def expand_axes(axes, names, defaults, limit=MAX_SPECTRA):
+    """{name: spec} -> ordered {name: values}; unspecified axes are fixed at their default."""
+    unknown = set(axes) - set(names)
+    if unknown:
+        raise ValueError(f"Unknown axes {sorted(unknown)}; expected some of {list(names)}")
+    values = {n: parse_axis(axes[n]) if n in axes else np.array([defaults[i]]) for i, n in enumerate(names)}
+    n_spectra = int(np.prod([len(v) for v in values.values()]))
+    if n_spectra > limit:
+        raise ValueError(f"Grid has {n_spectra:,} points, limit is {limit:,}")
+    return values
+
+def mie_grid_size(axes):
+    """Number of spectra a Mie grid over `axes` would hold (no limit check)."""
+    values = expand_axes(axes, list(MIE_AXES), list(MIE_AXES.values()), limit=np.inf)
+    return int(np.prod([len(v) for v in values.values()]))
+
+def _points(values):
+    # (N, n_axes) grid points, first axis slowest (C order, matches the output reshape)
+    mesh = np.meshgrid(*values.values(), indexing="ij")
+    return np.stack([m.ravel() for m in mesh], axis=1)
+
+def mlp_grid(wrapper, axes, chunk=65536):
+    """
+    Surrogate spectra over the grid of the four model inputs, shape
+    (n_mean_diam, n_std_diam, n_count, n_aspect, W). Unswept inputs are fixed
+    at the training mean. Also returns an in_range mask from the OOD gate's
+    per-feature box (no neighbour search).
+    """
+    values = expand_axes(axes, FEATURE_NAMES, wrapper.X_mean)
+    feats = _points(values).astype(np.float32)
+    spectra = np.empty((len(feats), len(wrapper.wavelengths)), dtype=np.float32)
+    for start in range(0, len(feats), chunk):
+        out = wrapper.forward(wrapper.normalize(feats[start:start + chunk]))
+        if wrapper.members:
+            out = out.mean(axis=0)
+        if wrapper.basis is not None:
+            out = wrapper.basis.decode(out)
+        spectra[start:start + chunk] = out
+
+    shape = tuple(len(v) for v in values.values())
+    grid = {"spectra": spectra.reshape(shape + (-1,)), "wavelengths": wrapper.wavelengths, **values}
+    if wrapper.gate is not None:
+        grid["in_range"] = wrapper.gate.in_range(feats).reshape(shape)
+    return grid
+
+def mie_grid(axes, chunk=256):
+    """
+    Exact extinction spectra over diameter and optical constants, shape
+    (n_diameter, n_particle, k_particle, n_medium, W). Evaluated in chunks of
+    rows to bound the recurrence arrays (n_terms x rows x W complex).
+    """
+    values = expand_axes(axes, list(MIE_AXES), list(MIE_AXES.values()), limit=MAX_MIE_SPECTRA)
+    pts = _points(values)
+    spectra = np.empty((len(pts), len(mie.wavelengths)), dtype=np.float32)
+    for start in range(0, len(pts), chunk):
+        p = pts[start:start + chunk]
+        spectra[start:start + chunk] = mie.simulate_spectra(p[:, 0], p[:, 1], p[:, 2], p[:, 3])
+
+    shape = tuple(len(v) for v in values.values())
+    return {"spectra": spectra.reshape(shape + (-1,)), "wavelengths": mie.wavelengths.astype(np.float32), **values}
+
+def downsample(grid, factor):
+    """Average blocks of `factor` neighbouring wavelengths (the last block may be shorter)."""
+    if factor <= 1:
+        return grid
+    starts = np.arange(0, grid["spectra"].shape[-1], factor)
+    counts = np.diff(np.append(starts, grid["spectra"].shape[-1]))
+    out = dict(grid)
+    out["spectra"] = (np.add.reduceat(grid["spectra"], starts, axis=-1) / counts).astype(grid["spectra"].dtype)
+    out["wavelengths"] = np.add.reduceat(np.asarray(grid["wavelengths"], dtype=np.float64), starts) / counts
+    return out
+
+def to_bytes(grid, fmt="npz", dtype="float32"):
+    """
+    Serialize a grid. npz: every array (spectra, wavelengths, axis values,
+    in_range). npy: the spectra array alone.
+    """
+    if dtype not in ("float32", "float16"):
+        raise ValueError("dtype must be float32 or float16")
+    spectra = grid["spectra"].astype(dtype, copy=False)
+    buf = io.BytesIO()
+    if fmt == "npy":
+        np.save(buf, spectra)
+    elif fmt == "npz":
+        np.savez(buf, **dict(grid, spectra=spectra))
+    else:
+        raise ValueError("format must be npz or npy")
+    return buf.getvalue()
+
+def axes_header(grid):
+    # Axis order for npy responses, where the array itself carries no names
+    return ",".join(n for n in grid if n not in ("spectra", "wavelengths", "in_range"))
+
+def main():
+    import argparse
+    from src.eval.infer_multi import load_registered
+
+    parser = argparse.ArgumentParser(description="Evaluate a dense grid of spectra in one batched call")
+    parser.add_argument("--source", choices=["mlp", "mie"], default="mlp")
+    parser.add_argument("--model", type=str, default="final_demo_model",
+                        help="Registered model name or registry JSON path (mlp)")
+    parser.add_argument("--axis", type=str, action="append", default=[],
+                        help="NAME=start:stop:num or NAME=a,b,c (repeatable), "
+                             f"mlp: {', '.join(FEATURE_NAMES)}; mie: {', '.join(MIE_AXES)}")
+    parser.add_argument("--downsample", type=int, default=1, help="Average every N wavelengths")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument("--out", type=str, default="outputs/grid.npz", help=".npz (all arrays) or .npy (spectra only)")
+    args = parser.parse_args()
+
+    axes = dict(a.split("=", 1) for a in args.axis)
+    t0 = time.perf_counter()
+    if args.source == "mie":
+        grid = mie_grid(axes)
+    else:
+        grid = mlp_grid(load_registered(args.model), axes)
+    grid = downsample(grid, args.downsample)
+    elapsed = time.perf_counter() - t0
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "wb") as f:
+        f.write(to_bytes(grid, "npy" if args.out.endswith(".npy") else "npz", args.dtype))
+    print(f"{grid['spectra'].shape} ({axes_header(grid)}, wavelength) in {elapsed:.2f} s -> {args.out}")
+
+if __name__ == "__main__":
+    main()
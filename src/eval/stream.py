@@ -0,0 +1,287 @@
+import os
+import sys
+import csv
+import glob
+import time
+import argparse
+import numpy as np
+import cv2
+from scipy.optimize import linear_sum_assignment
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from src.eval.infer_multi import particle_stats, features_from_stats
+from src.eval.ood import FEATURE_NAMES
+
+FRAME_SIZE = 512  # segment_features works on 512x512
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+# ---------- Frame sources ----------
+
+def iter_frames(source, fps=None):
+    """
+    Frames from a video file, a camera index ("0") or a directory / glob of
+    images, as (index, time_s, decode). Nothing is decoded until decode() is
+    called, so frames skipped to keep up with real time cost almost nothing
+    (cv2 grab() without retrieve(), or no file read at all).
+    decode() returns an 8-bit 512x512 grayscale frame.
+    """
+    if os.path.isdir(source) or glob.has_magic(source):
+        pattern = os.path.join(glob.escape(source), "*") if os.path.isdir(source) else source
+        paths = sorted(p for p in glob.glob(pattern) if p.lower().endswith(IMAGE_EXTS))
+        if not paths:
+            raise FileNotFoundError(f"No frames found in {source}")
+        from src.features.decode import load_gray
+        fps = fps or 30.0
+        for i, path in enumerate(paths):
+            def decode(path=path):
+                return _to_frame(load_gray(path))
+            yield i, i / fps, decode
+        return
+
+    cap = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not cap.isOpened():
+        raise FileNotFoundError(f"Could not open video source {source}")
+    fps = fps or cap.get(cv2.CAP_PROP_FPS) or 30.0
+    try:
+        i = 0
+        while cap.grab():
+            def decode():
+                ok, frame = cap.retrieve()
+                if not ok:
+                    raise ValueError(f"Could not decode frame {i}")
+                if frame.ndim == 3:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                return _to_frame(frame)
+            yield i, i / fps, decode
+            i += 1
+    finally:
+        cap.release()
+
+def _to_frame(img):
+    if img.shape != (FRAME_SIZE, FRAME_SIZE):
+        img = cv2.resize(img, (FRAME_SIZE, FRAME_SIZE), interpolation=cv2.INTER_AREA)
+    return img
+
+# ---------- Segmentation with state ----------
+
+class FrameSegmenter:
+    """
+    segment_features' pipeline (5x5 blur, inverted threshold, 3x3 opening,
+    contours) for a sequence of frames. Otsu's threshold is recomputed only
+    every `otsu_every` frames and smoothed over time, so the threshold does
+    not flicker between frames and particle sizes stay comparable. Working
+    buffers are allocated once.
+    """
+
+    def __init__(self, otsu_every=10, smoothing=0.5):
+        self.otsu_every = otsu_every
+        self.smoothing = smoothing
+        self.threshold = None
+        self.frames = 0
+        self.blur = np.empty((FRAME_SIZE, FRAME_SIZE), dtype=np.uint8)
+        self.mask = np.empty((FRAME_SIZE, FRAME_SIZE), dtype=np.uint8)
+        self.kernel = np.ones((3, 3), np.uint8)
+
+    def __call__(self, frame):
+        """(areas, aspect ratios, centres) of the particles in one 512x512 frame."""
+        cv2.GaussianBlur(frame, (5, 5), 0, dst=self.blur)
+        if self.threshold is None or self.frames % self.otsu_every == 0:
+            otsu, _ = cv2.threshold(self.blur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU, dst=self.mask)
+            if self.threshold is None:
+                self.threshold = otsu
+            else:
+                self.threshold += self.smoothing * (otsu - self.threshold)
+        cv2.threshold(self.blur, self.threshold, 255, cv2.THRESH_BINARY_INV, dst=self.mask)
+        cv2.morphologyEx(self.mask, cv2.MORPH_OPEN, self.kernel, dst=self.mask)
+        self.frames += 1
+        return particle_stats(self.mask)
+
+# ---------- Tracking ----------
+
+class Tracker:
+    """
+    Frame-to-frame particle tracks. Each track predicts its next position with
+    a constant velocity; detections are matched to predictions by minimum total
+    distance (Hungarian assignment), within `gate` x the particle diameter
+    (at least `min_gate` px). Tracks unmatched for more than `max_missed`
+    frames are dropped, so memory only grows with the number of live particles.
+    """
+
+    def __init__(self, gate=0.75, min_gate=8.0, max_missed=5):
+        self.gate = gate
+        self.min_gate = min_gate
+        self.max_missed = max_missed
+        self.next_id = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.pos = np.empty((0, 2), dtype=np.float32)
+        self.vel = np.empty((0, 2), dtype=np.float32)
+        self.diam = np.empty(0, dtype=np.float32)
+        self.missed = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def update(self, centers, diams):
+        """Track ids for this frame's detections, plus (started, ended) track counts."""
+        predicted = self.pos + self.vel
+        det_ids = np.full(len(centers), -1, dtype=np.int64)
+        matched = np.zeros(len(self.ids), dtype=bool)
+        if len(self.ids) and len(centers):
+            cost = np.linalg.norm(predicted[:, None, :] - centers[None, :, :], axis=2)
+            limit = np.maximum(self.min_gate, self.gate * self.diam)[:, None]
+            rows, cols = linear_sum_assignment(np.where(cost <= limit, cost, 1e6))
+            ok = cost[rows, cols] <= limit[rows, 0]
+            rows, cols = rows[ok], cols[ok]
+            det_ids[cols] = self.ids[rows]
+            matched[rows] = True
+            # Velocity is smoothed so one noisy centroid does not throw the prediction off
+            self.vel[rows] = 0.5 * self.vel[rows] + 0.5 * (centers[cols] - self.pos[rows])
+            self.pos[rows] = centers[cols]
+            self.diam[rows] = diams[cols]
+            self.missed[rows] = 0
+
+        # Coast unmatched tracks on their prediction, drop the stale ones
+        self.pos[~matched] = predicted[~matched]
+        self.missed[~matched] += 1
+        keep = self.missed <= self.max_missed
+        ended = int((~keep).sum())
+        self.ids, self.pos, self.vel = self.ids[keep], self.pos[keep], self.vel[keep]
+        self.diam, self.missed = self.diam[keep], self.missed[keep]
+
+        new = det_ids < 0
+        started = int(new.sum())
+        det_ids[new] = np.arange(self.next_id, self.next_id + started)
+        self.next_id += started
+        self.ids = np.concatenate([self.ids, det_ids[new]])
+        self.pos = np.concatenate([self.pos, centers[new]])
+        self.vel = np.concatenate([self.vel, np.zeros((started, 2), dtype=np.float32)])
+        self.diam = np.concatenate([self.diam, diams[new]])
+        self.missed = np.concatenate([self.missed, np.zeros(started, dtype=np.int64)])
+        return det_ids, started, ended
+
+# ---------- Stream ----------
+
+def run_stream(source, wrapper, out_path, tracks_path=None, fps=None, realtime=False, max_lag=0.1, batch=8,
+               otsu_every=10, max_frames=None, log_every=100):
+    """
+    Segment, track and predict every frame of `source`, writing one row per
+    frame (features, tracking counts, peak/FWHM, solver, spectrum) to out_path
+    and optionally one row per tracked particle to tracks_path. Rows are
+    written as they are produced; only `batch` frames of features are held
+    for the batched prediction. With `realtime`, frames are dropped whenever
+    processing is more than `max_lag` seconds behind the source clock.
+    Returns a summary dict.
+    """
+    segmenter = FrameSegmenter(otsu_every=otsu_every)
+    tracker = Tracker()
+    wavelengths = wrapper.wavelengths
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    out = open(out_path, "w", newline="")
+    writer = csv.writer(out)
+    writer.writerow(["frame", "time_s"] + FEATURE_NAMES + ["threshold", "tracks", "tracks_started", "tracks_ended",
+                     "peak_nm", "fwhm_nm", "solver"] + [f"{w:g}nm" for w in wavelengths])
+    track_out = track_writer = None
+    if tracks_path:
+        track_out = open(tracks_path, "w", newline="")
+        track_writer = csv.writer(track_out)
+        track_writer.writerow(["frame", "time_s", "track_id", "x_px", "y_px", "eq_diam_px", "aspect"])
+
+    pending = []  # (row prefix, features or None)
+    timings = {"decode": 0.0, "segment": 0.0, "track": 0.0, "predict": 0.0}
+    processed = dropped = 0
+
+    def flush():
+        feats = np.array([f for _, f in pending if f is not None], dtype=np.float32).reshape(-1, 4)
+        t0 = time.perf_counter()
+        res = wrapper.predict_batch(feats) if len(feats) else None
+        timings["predict"] += time.perf_counter() - t0
+        k = 0
+        for row, f in pending:
+            if f is None:
+                writer.writerow(row + ["", "", ""] + [""] * len(wavelengths))
+                continue
+            writer.writerow(row + [f"{res['peak_nm'][k]:g}", f"{res['fwhm_nm'][k]:g}", res["path"][k]]
+                            + [f"{v:.6g}" for v in res["spectra"][k]])
+            k += 1
+        pending.clear()
+
+    start = time.perf_counter()
+    try:
+        for index, t, decode in iter_frames(source, fps):
+            if max_frames is not None and index >= max_frames:
+                break
+            if realtime and processed and time.perf_counter() - start > t + max_lag:
+                dropped += 1
+                continue
+
+            t0 = time.perf_counter()
+            frame = decode()
+            t1 = time.perf_counter()
+            areas, aspects, centers = segmenter(frame)
+            t2 = time.perf_counter()
+            diams = np.sqrt(4 * areas / np.pi).astype(np.float32)
+            ids, started, ended = tracker.update(centers, diams)
+            t3 = time.perf_counter()
+            timings["decode"] += t1 - t0
+            timings["segment"] += t2 - t1
+            timings["track"] += t3 - t2
+
+            feats = features_from_stats(areas, aspects) if len(areas) else None
+            row = [index, f"{t:.4f}"] + ([f"{v:.6g}" for v in feats] if feats is not None else [""] * 4)
+            row += [f"{segmenter.threshold:.1f}", len(tracker), started, ended]
+            pending.append((row, feats))
+            if track_writer:
+                for k in range(len(ids)):
+                    track_writer.writerow([index, f"{t:.4f}", ids[k], f"{centers[k, 0]:.1f}", f"{centers[k, 1]:.1f}",
+                                           f"{diams[k]:.2f}", f"{aspects[k]:.3f}"])
+            if len(pending) >= batch:
+                flush()
+
+            processed += 1
+            if log_every and processed % log_every == 0:
+                elapsed = time.perf_counter() - start
+                print(f"  frame {index}: {processed / elapsed:.0f} fps, {len(tracker)} tracks, {dropped} dropped")
+        if pending:
+            flush()
+    finally:
+        out.close()
+        if track_out:
+            track_out.close()
+
+    elapsed = time.perf_counter() - start
+    return {
+        "frames": processed,
+        "dropped": dropped,
+        "tracks": tracker.next_id,
+        "seconds": elapsed,
+        "fps": processed / elapsed if elapsed else 0.0,
+        "ms_per_frame": {k: v / max(processed, 1) * 1000 for k, v in timings.items()}
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment, track and predict spectra for a TEM video or frame sequence")
+    parser.add_argument("source", type=str, help="Video file, camera index, frame directory or glob")
+    parser.add_argument("--model", type=str, default="final_demo_model",
+                        help="Registered model name (models/registered/<name>.json) or a checkpoint path")
+    parser.add_argument("--out", type=str, default="outputs/stream/frames.csv", help="Per-frame time series")
+    parser.add_argument("--tracks", type=str, default=None, help="Also write per-particle track positions here")
+    parser.add_argument("--fps", type=float, default=None, help="Source frame rate (default: from the video, else 30)")
+    parser.add_argument("--realtime", action="store_true", help="Drop frames when processing falls behind the source")
+    parser.add_argument("--batch", type=int, default=8, help="Frames per batched prediction")
+    parser.add_argument("--otsu_every", type=int, default=10, help="Recompute the Otsu threshold every N frames")
+    parser.add_argument("--max_frames", type=int, default=None)
+    args = parser.parse_args()
+
+    from predict import load_model
+
+    wrapper = load_model(args.model)
+    summary = run_stream(args.source, wrapper, args.out, tracks_path=args.tracks, fps=args.fps,
+                         realtime=args.realtime, batch=args.batch, otsu_every=args.otsu_every,
+                         max_frames=args.max_frames)
+    stages = ", ".join(f"{k} {v:.2f}" for k, v in summary["ms_per_frame"].items())
+    print(f"{summary['frames']} frames in {summary['seconds']:.1f} s ({summary['fps']:.0f} fps; ms/frame: {stages}), "
+          f"{summary['tracks']} tracks, {summary['dropped']} dropped -> {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Latency buckets (seconds) shared by stage and request histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Per-request list of (stage, seconds); set by TimingMiddleware, None outside requests
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+class Histogram:
+    """Prometheus-style cumulative histogram, optionally keyed by one label."""
+
+    def __init__(self, name, help, buckets, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=""):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: ([*v[0]], v[1], v[2]) for k, v in self._series.items()}
+        for label_value, (counts, total, n) in sorted(series.items()):
+            labels = f'{self.label}="{label_value}",' if self.label else ""
+            cumulative = 0
+            for bound, c in zip(self.buckets + ("+Inf",), counts):
+                cumulative += c
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels[:-1]}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {n}")
+        return lines
+
+STAGE_SECONDS = Histogram("nanooptics_stage_seconds", "Time spent per pipeline stage", LATENCY_BUCKETS, label="stage")
+REQUEST_SECONDS = Histogram("nanooptics_request_seconds", "End-to-end HTTP request latency", LATENCY_BUCKETS, label="path")
+PARTICLE_COUNT = Histogram("nanooptics_particle_count", "Particles detected per segmented image", COUNT_BUCKETS)
+
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+@contextmanager
+def timed(stage):
+    """Time a hot-path stage into the stage histogram and the current request's Server-Timing."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        STAGE_SECONDS.observe(dt, stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, dt))
+
+def note(event):
+    """Flag an untimed event (e.g. a cache hit) on the current request's Server-Timing."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((event, None))
+
+def in_flight():
+    return _in_flight
+
+class TimingMiddleware:
+    """
+    Pure ASGI middleware (cheaper than BaseHTTPMiddleware): tracks requests
+    in flight, records request latency and adds a Server-Timing header with
+    every stage timed during the request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _in_flight
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = []
+        token = _request_timings.set(timings)
+        t0 = time.perf_counter()
+        with _in_flight_lock:
+            _in_flight += 1
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                total = time.perf_counter() - t0
+                parts = [stage if dt is None else f"{stage};dur={dt * 1000:.3f}" for stage, dt in timings]
+                parts.append(f"total;dur={total * 1000:.3f}")
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", ", ".join(parts).encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            # Label by route template (bounded cardinality), not the raw path
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(time.perf_counter() - t0, getattr(route, "path", "unmatched"))
+            with _in_flight_lock:
+                _in_flight -= 1
+            _request_timings.reset(token)
+
+def render_metrics(extra_lines=()):
+    """Prometheus text exposition of all telemetry plus caller-provided lines."""
+    lines = []
+    lines += STAGE_SECONDS.render()
+    lines += REQUEST_SECONDS.render()
+    lines += PARTICLE_COUNT.render()
+    lines += ["# HELP nanooptics_requests_in_flight Requests currently being processed (queue depth)",
+              "# TYPE nanooptics_requests_in_flight gauge",
+              f"nanooptics_requests_in_flight {_in_flight}"]
+    lines += list(extra_lines)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,176 @@
+import os
+import glob
+import time
+import struct
+import hashlib
+import threading
+import contextvars
+
+# api.py records traffic to this directory when the variable is set (serve.py --record)
+RECORD_ENV = "NANOOPTICS_RECORD"
+
+MAGIC = b"NOTRAF1\n"
+# arrival (unix s), latency (s), status, body length; then the length-prefixed strings in FIELDS
+HEAD = struct.Struct("<dfHI")
+FIELDS = ("method", "path", "query", "content_type", "filename", "sha1", "server_timing")
+_LEN = struct.Struct("<H")
+_SIZE = struct.Struct("<I")
+
+# Upload recorded by the endpoint for the current request; set by RecordingMiddleware
+_current_upload = contextvars.ContextVar("current_upload", default=None)
+
+def record_upload(filename, data):
+    """Called by upload endpoints with the file bytes, so the multipart envelope need not be kept."""
+    upload = _current_upload.get()
+    if upload is not None:
+        upload["filename"] = filename or "upload"
+        upload["data"] = data
+
+class TrafficRecorder:
+    """
+    Append-only request log for one process: log_dir/requests.<pid>.bin.
+
+    Each record is a uint32 size followed by HEAD and the FIELDS strings, so a
+    record cut short by a crash is detected and skipped on read. Request
+    bodies (uploaded images, JSON) are stored once per content hash under
+    log_dir/blobs/, so replaying the same micrograph 10k times costs one file.
+    """
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.blob_dir = os.path.join(log_dir, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, f"requests.{os.getpid()}.bin")
+        self._known = set()
+        self._lock = threading.Lock()
+        new = not os.path.exists(self.path)
+        # Unbuffered append: each record goes out in one write()
+        self._file = open(self.path, "ab", buffering=0)
+        if new:
+            self._file.write(MAGIC)
+
+    def store_blob(self, data):
+        sha1 = hashlib.sha1(data).hexdigest()
+        if sha1 in self._known:
+            return sha1
+        path = blob_path(self.log_dir, sha1)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        self._known.add(sha1)
+        return sha1
+
+    def record(self, arrival, latency, status, body=None, **fields):
+        """body: request bytes to keep (stored deduplicated), or None for bodiless requests."""
+        if body is not None:
+            fields["sha1"] = self.store_blob(body)
+        parts = [HEAD.pack(arrival, latency, status, len(body) if body is not None else 0)]
+        for name in FIELDS:
+            value = str(fields.get(name) or "").encode("utf-8")[:0xFFFF]
+            parts.append(_LEN.pack(len(value)))
+            parts.append(value)
+        payload = b"".join(parts)
+        with self._lock:
+            self._file.write(_SIZE.pack(len(payload)) + payload)
+
+    def close(self):
+        self._file.close()
+
+def blob_path(log_dir, sha1):
+    return os.path.join(log_dir, "blobs", sha1[:2], sha1)
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a traffic log")
+    pos = len(MAGIC)
+    while pos + _SIZE.size <= len(data):
+        (size,) = _SIZE.unpack_from(data, pos)
+        pos += _SIZE.size
+        if pos + size > len(data):
+            break  # truncated tail
+        arrival, latency, status, body_len = HEAD.unpack_from(data, pos)
+        rec = {"arrival": arrival, "latency": latency, "status": status, "body_len": body_len}
+        off = pos + HEAD.size
+        for name in FIELDS:
+            (n,) = _LEN.unpack_from(data, off)
+            off += _LEN.size
+            rec[name] = data[off:off + n].decode("utf-8")
+            off += n
+        pos += size
+        yield rec
+
+def read_log(log_dir):
+    """Every recorded request of every worker, in arrival order."""
+    records = []
+    for path in sorted(glob.glob(os.path.join(glob.escape(log_dir), "requests.*.bin"))):
+        records.extend(_read_file(path))
+    records.sort(key=lambda r: r["arrival"])
+    return records
+
+class RecordingMiddleware:
+    """
+    Pure ASGI middleware that writes every HTTP request to a TrafficRecorder.
+    JSON/raw bodies are captured as they stream in; multipart uploads are
+    left to the endpoint (record_upload) so only the image bytes are kept.
+    """
+
+    def __init__(self, app, log_dir):
+        self.app = app
+        self.recorder = TrafficRecorder(log_dir)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        content_type = headers.get(b"content-type", b"").decode("latin-1")
+        multipart = content_type.startswith("multipart/")
+        chunks = []
+        response = {"status": 0, "server_timing": ""}
+        upload = {}
+        token = _current_upload.set(upload)
+
+        async def receive_body():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunks.append(message.get("body", b""))
+            return message
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                for k, v in message.get("headers", []):
+                    if k.lower() == b"server-timing":
+                        response["server_timing"] = v.decode("latin-1")
+            await send(message)
+
+        arrival = time.time()
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive if multipart else receive_body, send_status)
+        finally:
+            latency = time.perf_counter() - t0
+            _current_upload.reset(token)
+            if multipart:
+                body = upload.get("data")
+            else:
+                body = b"".join(chunks) or None
+            try:
+                self.recorder.record(
+                    arrival, latency, response["status"], body,
+                    method=scope["method"],
+                    path=scope["path"],
+                    query=scope.get("query_string", b"").decode("latin-1"),
+                    content_type="" if multipart else content_type,
+                    filename=upload.get("filename", ""),
+                    server_timing=response["server_timing"]
+                )
+            except OSError as e:
+                # Recording must never fail a request
+                print(f"Traffic recorder: {e}")
@@ -0,0 +1,172 @@
+import io
+import cv2
+import numpy as np
+
+try:
+    from PIL import Image  # header-only format/size probe for picking the reduced decode factor
+except ImportError:
+    Image = None
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+_REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+}
+
+def _is_bytes(source):
+    return isinstance(source, (bytes, bytearray, memoryview))
+
+def _is_jpeg(source):
+    if _is_bytes(source):
+        return bytes(source[:3]) == JPEG_MAGIC
+    try:
+        with open(source, "rb") as f:
+            return f.read(3) == JPEG_MAGIC
+    except OSError:
+        return False
+
+def _probe(source):
+    """(format, (width, height)) from the file header, or None if it can't be probed cheaply."""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(source) if _is_bytes(source) else source) as im:
+            return im.format, im.size
+    except Exception:
+        return None
+
+def _reduce_factor(source, target_size):
+    # Only JPEG is scaled inside the decoder (DCT scaling); for PNG/TIFF/BMP OpenCV decodes
+    # at full size and downsamples afterwards, which saves nothing and changes the pixels
+    if target_size is None or not _is_jpeg(source):
+        return 1
+    probe = _probe(source)
+    if probe is None or probe[0] != "JPEG":
+        return 1
+    size = probe[1]
+    # Largest factor that still leaves at least target_size pixels in both dimensions
+    for f in (8, 4, 2):
+        if min(size) // f >= target_size:
+            return f
+    return 1
+
+def _imread(source, flags):
+    if _is_bytes(source):
+        return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flags)
+    return cv2.imread(source, flags)
+
+def to_uint8(img):
+    """Grayscale conversion + 16->8 bit with integer shifts."""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+    if img.dtype == np.uint16:
+        # (x / 65535.0 * 255) truncated is x // 257 (65535 = 255 * 257), and for 16-bit x
+        # x // 257 == (x - (x >> 8)) >> 8 -- bit-identical to the old float64 path
+        out = img >> 8
+        np.subtract(img, out, out=out)
+        out >>= 8
+        img = out.astype(np.uint8)
+    return img
+
+def load_gray(source, target_size=None):
+    """
+    Decode a file path or in-memory image bytes to 8-bit grayscale.
+
+    With target_size (e.g. 512) JPEGs are decoded at 1/2, 1/4 or 1/8 scale
+    (IMREAD_REDUCED_GRAYSCALE_*) whenever that still leaves at least
+    target_size pixels per side. That is an area downsample, not the aliased
+    INTER_LINEAR resize the models were trained on, and moves features by up
+    to ~13% on some JPEGs; only use it where pixels need not match training
+    (e.g. thumbnails). Feature extraction decodes at full resolution.
+    16-bit images are converted with integer shifts instead of a float64 copy.
+    Raises ValueError if the image can't be decoded.
+    """
+    factor = _reduce_factor(source, target_size)
+    if factor > 1:
+        img = _imread(source, _REDUCED_FLAGS[factor])
+    else:
+        img = _imread(source, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError("Could not load image" if _is_bytes(source) else f"Could not load image {source}")
+    return to_uint8(img)
+
+def _reference_load_gray(source):
+    # Previous full-resolution path, kept for the tolerance check below
+    img = _imread(source, cv2.IMREAD_UNCHANGED)
+    if len(img.shape) == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if img.dtype == np.uint16:
+        img = (img / 65535.0 * 255).astype(np.uint8)
+    return img
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import glob
+    import time
+    import argparse
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+    from src.eval.infer_multi import segment_features
+
+    parser = argparse.ArgumentParser(description="Check load_gray against the current full-resolution decode path")
+    parser.add_argument("--data", type=str, default="data/subset")
+    parser.add_argument("--target", type=int, default=None,
+                        help="Also check reduced decoding at this target size (default: the full-resolution path feature extraction uses)")
+    parser.add_argument("--pixel_tol", type=float, default=1.0, help="Max mean abs pixel difference (0-255) after the 512x512 resize")
+    parser.add_argument("--feature_tol", type=float, default=0.02, help="Max relative change of any segment_features output")
+    args = parser.parse_args()
+
+    paths = []
+    for ext in ["png", "jpg", "jpeg", "tif", "tiff", "bmp"]:
+        paths += glob.glob(f"{args.data}/**/*.{ext}", recursive=True)
+
+    t_ref, t_fast, n_reduced, pixel_worst, feature_worst, failed = 0.0, 0.0, 0, 0.0, 0.0, []
+    for p in sorted(paths):
+        t0 = time.perf_counter()
+        ref = _reference_load_gray(p)
+        t1 = time.perf_counter()
+        fast = load_gray(p, target_size=args.target)
+        t2 = time.perf_counter()
+        t_ref += t1 - t0
+        t_fast += t2 - t1
+        with open(p, "rb") as f:
+            if not np.array_equal(fast, load_gray(f.read(), target_size=args.target)):
+                failed.append((p, "bytes and path decodes differ"))
+
+        if fast.shape == ref.shape:
+            # Full-resolution path: must be bit-identical (shift == float conversion)
+            if not np.array_equal(fast, ref):
+                failed.append((p, "full-resolution decode differs"))
+            continue
+
+        # Reduced decode: compare with the current path after segment_features' resize
+        n_reduced += 1
+        old512, fast512 = cv2.resize(ref, (512, 512)), cv2.resize(fast, (512, 512))
+        pixel = float(np.abs(old512.astype(np.int16) - fast512).mean())
+        pixel_worst = max(pixel_worst, pixel)
+        if pixel > args.pixel_tol:
+            failed.append((p, f"mean abs pixel diff {pixel:.3f}"))
+        try:
+            f_old = segment_features(ref)
+        except ValueError:
+            continue
+        try:
+            f_fast = segment_features(fast)
+        except ValueError:
+            failed.append((p, "no particles with the reduced decode"))
+            continue
+        change = float(np.max(np.abs(f_fast - f_old) / np.maximum(np.abs(f_old), 1e-6)))
+        feature_worst = max(feature_worst, change)
+        if change > args.feature_tol:
+            failed.append((p, f"features {np.round(f_old, 2)} -> {np.round(f_fast, 2)}"))
+
+    print(f"{len(paths)} images ({n_reduced} decoded at reduced resolution)")
+    print(f"Decode time: old path {t_ref * 1000:.0f} ms, checked path {t_fast * 1000:.0f} ms")
+    if n_reduced:
+        print(f"Worst mean abs pixel diff: {pixel_worst:.3f} (tol {args.pixel_tol}), "
+              f"worst feature change: {feature_worst:.2%} (tol {args.feature_tol:.0%})")
+    for p, reason in failed:
+        print(f"  FAIL {p}: {reason}")
+    sys.exit(1 if failed else 0)
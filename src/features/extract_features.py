@@ -1,28 +1,28 @@
-import cv2, os, numpy as np, pandas as pd
-from glob import glob
+import cv2, os, sys, argparse, numpy as np, pandas as pd
+from glob import glob, escape as glob_escape
 from tqdm import tqdm
 
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from src.features.decode import load_gray as decode_gray
+from src.features.image_store import ImageStore
+
 # ---------- Image Loader ----------
 def load_gray(path):
-    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-    if img is None:
+    # Full-resolution decode, as the training features were computed; 16-bit via integer shifts
+    try:
+        return decode_gray(path)
+    except ValueError:
         return None
 
-    if len(img.shape) == 3:
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    # Convert 16-bit to 8-bit if needed
-    if img.dtype == np.uint16:
-        img = (img / 65535.0 * 255).astype(np.uint8)
-
-    return img
-
 # ---------- Process One Image ----------
 def process_image(path, debug=False):
     img = load_gray(path)
     if img is None:
         return None, None
+    return process_array(img, debug)
 
+def process_array(img, debug=False):
+    # Packed-store images are already 512x512 (resize is then a no-op copy)
     img = cv2.resize(img, (512, 512))
 
     blur = cv2.GaussianBlur(img, (5,5), 0)
@@ -73,37 +73,54 @@ def process_image(path, debug=False):
 
     return features, vis
 
-# ---------- Collect All Images ----------
-img_paths = []
-for ext in ["png","jpg","jpeg","tif","tiff","bmp"]:
-    img_paths += glob(f"data/subset/**/*.{ext}", recursive=True)
-
-print("Found images:", len(img_paths))
-
-# ---------- Debug first few ----------
-os.makedirs("outputs/debug", exist_ok=True)
-
-print("Running debug on first 5 images...")
-
-for i, p in enumerate(img_paths[:5]):
-    feats, vis = process_image(p, debug=True)
-    if vis is not None:
-        out = os.path.join("outputs/debug", f"debug_{i}.png")
-        cv2.imwrite(out, vis)
-        print("Saved debug:", out)
-
-print("Now processing full dataset...")
-
-rows = []
-for p in tqdm(img_paths):
-    feats, _ = process_image(p, debug=False)
-    if feats is None:
-        continue
-    feats["image_path"] = p
-    rows.append(feats)
-
-df = pd.DataFrame(rows)
-os.makedirs("data/processed", exist_ok=True)
-df.to_csv("data/processed/morphology_features.csv", index=False)
-
-print("Saved features for", len(df), "images")
+def main():
+    parser = argparse.ArgumentParser(description="Extract particle morphology features from TEM images")
+    parser.add_argument("--store", type=str, default=None,
+                        help="Read pre-decoded images from a packed store prefix (see image_store.py) instead of data/subset")
+    parser.add_argument("--images", type=str, default="data/subset",
+                        help="Image directory (searched recursively), e.g. data/synthetic from synthetic_tem.py")
+    parser.add_argument("--out", type=str, default="data/processed/morphology_features.csv")
+    args = parser.parse_args()
+
+    if args.store:
+        # store[i] is a view into the memory map: no decoding, pages come from the page cache
+        store = ImageStore(args.store)
+        img_paths = store.paths
+    else:
+        # ---------- Collect All Images ----------
+        img_paths = []
+        for ext in ["png","jpg","jpeg","tif","tiff","bmp"]:
+            img_paths += glob(os.path.join(glob_escape(args.images), "**", f"*.{ext}"), recursive=True)
+
+    print("Found images:", len(img_paths))
+
+    # ---------- Debug first few ----------
+    os.makedirs("outputs/debug", exist_ok=True)
+
+    print("Running debug on first 5 images...")
+
+    for i, p in enumerate(img_paths[:5]):
+        feats, vis = process_array(store[i], debug=True) if args.store else process_image(p, debug=True)
+        if vis is not None:
+            out = os.path.join("outputs/debug", f"debug_{i}.png")
+            cv2.imwrite(out, vis)
+            print("Saved debug:", out)
+
+    print("Now processing full dataset...")
+
+    rows = []
+    for i, p in enumerate(tqdm(img_paths)):
+        feats, _ = process_array(store[i]) if args.store else process_image(p, debug=False)
+        if feats is None:
+            continue
+        feats["image_path"] = p
+        rows.append(feats)
+
+    df = pd.DataFrame(rows)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    df.to_csv(args.out, index=False)
+
+    print("Saved features for", len(df), "images")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from src.features.decode import load_gray
+
+IMAGE_SIZE = 512
+
+def store_paths(prefix):
+    """<prefix>.images.npy holds the (N, 512, 512) uint8 pixels, <prefix>.images.json the index."""
+    return prefix + ".images.npy", prefix + ".images.json"
+
+def read_manifest(manifest_path):
+    with open(manifest_path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+def remap_path(path, remaps):
+    """Apply the longest matching (old_prefix, new_prefix) rewrite, e.g. a path from another machine."""
+    matches = [(old, new) for old, new in remaps if path.startswith(old)]
+    if not matches:
+        return path
+    old, new = max(matches, key=lambda m: len(m[0]))
+    return new + path[len(old):]
+
+def _load_one(path, size):
+    with open(path, "rb") as f:
+        data = f.read()
+    img = load_gray(data)
+    h, w = img.shape
+    # Same resize as segment_features, so features from the store match features from the files
+    img = cv2.resize(img, (size, size))
+    return img, hashlib.sha1(data).hexdigest(), (h, w)
+
+def pack(sources, prefix, remaps=(), size=IMAGE_SIZE, workers=8):
+    """
+    Decode + resize every image once and write them into one memory-mapped
+    uint8 array. Unreadable or missing files are listed in the index, not packed.
+    """
+    local = [remap_path(s, remaps) for s in sources]
+    npy_path, index_path = store_paths(prefix)
+    os.makedirs(os.path.dirname(os.path.abspath(npy_path)), exist_ok=True)
+
+    entries, missing = [], []
+    images = np.lib.format.open_memmap(npy_path, mode="w+", dtype=np.uint8, shape=(len(local), size, size))
+
+    def work(path):
+        try:
+            return _load_one(path, size)
+        except (OSError, ValueError) as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:  # cv2 decode releases the GIL
+        for source, path, result in zip(sources, local, pool.map(work, local)):
+            if isinstance(result, Exception):
+                missing.append({"source": source, "path": path, "error": str(result)})
+                continue
+            img, sha1, shape = result
+            images[len(entries)] = img
+            entries.append({"source": source, "path": path, "sha1": sha1, "orig_shape": list(shape)})
+
+    images.flush()
+    del images
+    if len(entries) < len(local):
+        # Drop the unused tail rows left by missing files
+        _truncate(npy_path, len(entries), size)
+
+    index = {
+        "created_at": datetime.now().isoformat(),
+        "size": size,
+        "count": len(entries),
+        "dtype": "uint8",
+        "entries": entries,
+        "missing": missing
+    }
+    with open(index_path, "w") as f:
+        json.dump(index, f, indent=2)
+    print(f"Packed {len(entries)} images ({len(missing)} missing) into {npy_path}")
+    return index
+
+def _truncate(npy_path, count, size):
+    src = np.load(npy_path, mmap_mode="r")
+    tmp = npy_path + ".tmp"
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.uint8, shape=(count, size, size))
+    out[:] = src[:count]
+    out.flush()
+    del out, src
+    os.replace(tmp, npy_path)
+
+class ImageStore:
+    """
+    Read-only view of a packed store. Indexing and slicing return views into
+    the memory map (no decode, no copy); pages are read from disk on access.
+    """
+
+    def __init__(self, prefix):
+        npy_path, index_path = store_paths(prefix)
+        with open(index_path) as f:
+            self.index = json.load(f)
+        self.images = np.load(npy_path, mmap_mode="r")
+        if self.images.shape[0] != self.index["count"]:
+            raise ValueError(f"{npy_path} has {self.images.shape[0]} images, index lists {self.index['count']}")
+        self.paths = [e["path"] for e in self.index["entries"]]
+        self._row = {p: i for i, p in enumerate(self.paths)}
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def __getitem__(self, i):
+        return self.images[i]
+
+    def row(self, path):
+        return self._row[path]
+
+    def batches(self, batch_size=64, indices=None):
+        """Yield (rows, images) chunks; contiguous slices when indices is None, else one gather per batch."""
+        if indices is None:
+            for start in range(0, len(self), batch_size):
+                stop = min(start + batch_size, len(self))
+                yield np.arange(start, stop), self.images[start:stop]
+        else:
+            indices = np.asarray(indices)
+            for start in range(0, len(indices), batch_size):
+                rows = np.sort(indices[start:start + batch_size])  # sorted rows -> sequential reads
+                yield rows, self.images[rows]
+
+    def stale(self):
+        """Entries whose source file changed (or vanished) since packing."""
+        out = []
+        for e in self.index["entries"]:
+            try:
+                with open(e["path"], "rb") as f:
+                    if hashlib.sha1(f.read()).hexdigest() != e["sha1"]:
+                        out.append(e["path"])
+            except OSError:
+                out.append(e["path"])
+        return out
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a manifest of images into a memory-mapped 512x512 uint8 store")
+    parser.add_argument("--manifest", type=str, default="dopad_1000.txt", help="One image path per line")
+    parser.add_argument("--remap", type=str, action="append", default=[],
+                        help="OLD=NEW path prefix rewrite (repeatable, longest match wins), "
+                             "e.g. /teamspace/studios/this_studio/samples=data/subset/dopad")
+    parser.add_argument("--out", type=str, default="data/processed/dopad", help="Store prefix (writes <out>.images.npy/.json)")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--verify", action="store_true", help="Only re-hash the sources of an existing store")
+    args = parser.parse_args()
+
+    if args.verify:
+        store = ImageStore(args.out)
+        stale = store.stale()
+        print(f"{len(store)} images, {len(stale)} stale")
+        for p in stale:
+            print("  changed:", p)
+        sys.exit(1 if stale else 0)
+
+    remaps = [tuple(r.split("=", 1)) for r in args.remap]
+    sources = read_manifest(args.manifest)
+    print(f"Manifest {args.manifest}: {len(sources)} images")
+    pack(sources, args.out, remaps=remaps, workers=args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+
+class SpectralBasis:
+    """
+    Linear spectral basis: spectrum ~= mean + coeffs @ components.
+
+    Components are orthonormal rows, so an MSE on the K coefficients is the
+    same as an MSE on the reconstructed spectrum (inside the basis subspace).
+    """
+
+    def __init__(self, mean, components):
+        self.mean = np.ascontiguousarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+
+    @property
+    def k(self):
+        return self.components.shape[0]
+
+    @classmethod
+    def fit_pca(cls, spectra, k=16):
+        spectra = np.asarray(spectra, dtype=np.float64)
+        mean = spectra.mean(axis=0)
+        _, s, vt = np.linalg.svd(spectra - mean, full_matrices=False)
+        explained = (s[:k] ** 2).sum() / (s ** 2).sum()
+        print(f"PCA basis: k={k}, explained variance={explained:.8f}")
+        return cls(mean, vt[:k])
+
+    def encode(self, spectra):
+        return (np.asarray(spectra, dtype=np.float32) - self.mean) @ self.components.T
+
+    def decode(self, coeffs):
+        return np.asarray(coeffs, dtype=np.float32) @ self.components + self.mean
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, components=self.components)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["mean"], data["components"])
+
+def basis_path_for(model_path):
+    # Sidecar convention: outputs/spectrum_mlp.pth -> outputs/spectrum_mlp_basis.npz
+    return os.path.splitext(model_path)[0] + "_basis.npz"
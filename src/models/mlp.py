@@ -2,15 +2,21 @@ import torch
 import torch.nn as nn
 
 class SpectrumMLP(nn.Module):
-    def __init__(self, in_dim, out_dim=251):
+    def __init__(self, in_dim, out_dim=251, hidden=(128, 256)):
         super().__init__()
-        self.net = nn.Sequential(
-            nn.Linear(in_dim, 128),
-            nn.ReLU(),
-            nn.Linear(128, 256),
-            nn.ReLU(),
-            nn.Linear(256, out_dim)
-        )
+        # Linear/ReLU stack; the default keeps the original net.0/net.2/net.4 keys
+        layers = []
+        dims = [in_dim, *hidden]
+        for a, b in zip(dims[:-1], dims[1:]):
+            layers += [nn.Linear(a, b), nn.ReLU()]
+        layers.append(nn.Linear(dims[-1], out_dim))
+        self.net = nn.Sequential(*layers)
 
     def forward(self, x):
         return self.net(x)
+
+def dims_from_state_dict(state_dict):
+    """(in_dim, hidden, out_dim) of a SpectrumMLP state dict."""
+    layer_ids = sorted(int(k.split(".")[1]) for k in state_dict if k.startswith("net.") and k.endswith(".weight"))
+    shapes = [tuple(state_dict[f"net.{i}.weight"].shape) for i in layer_ids]
+    return shapes[0][1], tuple(s[0] for s in shapes[:-1]), shapes[-1][0]
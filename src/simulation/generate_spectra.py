@@ -1,19 +1,22 @@
+import os
+import sys
 import numpy as np
 import pandas as pd
-import miepython
 
-# Wavelengths: 300–800 nm, step 2 nm
-wavelengths = np.arange(300, 801, 2)  # 251 points
-
-# Rough optical constants for carbon/diamond-like material
-n_particle = 2.4
-k_particle = 0.05
-n_medium = 1.33
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from src.simulation.mie import wavelengths, n_particle, k_particle, n_medium, diameter_nm, simulate_spectra
 
 def simulate_spectrum(d_nm):
     """
-    Compute extinction efficiency spectrum using miepython v3 API
+    Compute extinction efficiency spectrum (batched NumPy Mie, see mie.py)
+    """
+    return simulate_spectra(d_nm)[0]
+
+def simulate_spectrum_miepython(d_nm):
+    """
+    Reference implementation using miepython v3 API
     """
+    import miepython
     m = complex(n_particle, k_particle)
 
     qext_list = []
@@ -26,29 +29,30 @@ def simulate_spectrum(d_nm):
 
     return np.array(qext_list)
 
-print("Loading morphology features...")
-df = pd.read_csv("data/processed/morphology_features.csv")
-
-spectra = []
-
-print("Generating spectra...")
+def main():
+    print("Loading morphology features...")
+    df = pd.read_csv("data/processed/morphology_features.csv")
 
-for i, row in df.iterrows():
-    # TEMPORARY scale: assume 1 pixel = 0.5 nm
-    d_nm = row.mean_diam_px * 0.5
+    print("Generating spectra...")
 
-    # Avoid zero or insane values
-    d_nm = max(d_nm, 1.0)
+    # All diameters in one batched solve
+    spectra = simulate_spectra(diameter_nm(df.mean_diam_px.values))
+    spectra = np.array(spectra).astype("float32")
 
-    spec = simulate_spectrum(d_nm)
-    spectra.append(spec)
+    # Spot-check against miepython
+    for i in np.linspace(0, len(df) - 1, 5).astype(int):
+        ref = simulate_spectrum_miepython(float(diameter_nm(df.mean_diam_px.values[i])))
+        err = np.abs(spectra[i] - ref).max() / np.abs(ref).max()
+        if err > 1e-5:
+            raise RuntimeError(f"Batched Mie disagrees with miepython on row {i} (rel err {err:.2e})")
 
-spectra = np.array(spectra).astype("float32")
+    # Save
+    np.save("data/processed/spectra.npy", spectra)
+    np.save("data/processed/wavelengths.npy", wavelengths)
 
-# Save
-np.save("data/processed/spectra.npy", spectra)
-np.save("data/processed/wavelengths.npy", wavelengths)
+    print("Saved spectra shape:", spectra.shape)
+    print("Saved wavelengths shape:", wavelengths.shape)
+    print("Min/Max spectrum values:", spectra.min(), spectra.max())
 
-print("Saved spectra shape:", spectra.shape)
-print("Saved wavelengths shape:", wavelengths.shape)
-print("Min/Max spectrum values:", spectra.min(), spectra.max())
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import numpy as np
+
+# Wavelengths: 300–800 nm, step 2 nm
+wavelengths = np.arange(300, 801, 2)  # 251 points
+
+# Rough optical constants for carbon/diamond-like material
+n_particle = 2.4
+k_particle = 0.05
+n_medium = 1.33
+
+# TEMPORARY scale used to build the training spectra: assume 1 pixel = 0.5 nm
+NM_PER_PX = 0.5
+
+def diameter_nm(mean_diam_px):
+    # Avoid zero or insane values
+    return np.maximum(np.asarray(mean_diam_px, dtype=np.float64) * NM_PER_PX, 1.0)
+
+def qext(m, x):
+    """
+    Extinction efficiency for relative index m (scalar, or an array that
+    broadcasts against x) and an array of size parameters x (any shape),
+    all evaluated at once.
+
+    Bohren & Huffman series: log-derivative D_n(mx) by downward recurrence,
+    Riccati-Bessel functions by upward recurrence, summed up to the largest
+    Wiscombe stop index in the batch with shorter series masked off.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    shape = np.broadcast_shapes(x.shape, np.shape(m))
+    x = np.broadcast_to(x, shape).ravel()
+    m = np.broadcast_to(np.asarray(m, dtype=np.complex128), shape).ravel()
+    mx = m * x
+    nstop = np.floor(x + 4.05 * np.cbrt(x) + 2).astype(int)
+    n_max = int(nstop.max())
+    n_start = int(max(n_max, np.abs(mx).max())) + 16
+
+    # D_n(mx) for n = n_start..1, keep 1..n_max
+    D = np.zeros((n_max + 1, len(x)), dtype=np.complex128)
+    d = np.zeros(len(x), dtype=np.complex128)
+    for n in range(n_start, 0, -1):
+        d = n / mx - 1 / (d + n / mx)
+        if n - 1 <= n_max:
+            D[n - 1] = d
+
+    psi_prev, psi = np.cos(x), np.sin(x)
+    chi_prev, chi = -np.sin(x), np.cos(x)
+    total = np.zeros(len(x))
+    for n in range(1, n_max + 1):
+        psi_n = (2 * n - 1) / x * psi - psi_prev
+        chi_n = (2 * n - 1) / x * chi - chi_prev
+        xi_n = psi_n - 1j * chi_n
+        xi = psi - 1j * chi
+        da = D[n] / m + n / x
+        db = D[n] * m + n / x
+        a = (da * psi_n - psi) / (da * xi_n - xi)
+        b = (db * psi_n - psi) / (db * xi_n - xi)
+        total += np.where(n <= nstop, (2 * n + 1) * (a + b).real, 0.0)
+        psi_prev, psi = psi, psi_n
+        chi_prev, chi = chi, chi_n
+    return (2 / x ** 2 * total).reshape(shape)
+
+def simulate_spectra(d_nm, n=n_particle, k=k_particle, medium=n_medium):
+    """
+    (N,) diameters in nm -> (N, 251) extinction efficiency spectra, one batched
+    evaluation. Optical constants may also be (N,) arrays, one per spectrum.
+    """
+    d_nm = np.atleast_1d(np.asarray(d_nm, dtype=np.float64))
+    medium = np.asarray(medium, dtype=np.float64)[..., None]
+    m = (np.asarray(n)[..., None] + 1j * np.asarray(k)[..., None]) / medium
+    x = np.pi * d_nm[:, None] * medium / wavelengths[None, :]
+    return qext(m, x)
@@ -0,0 +1,87 @@
+import os
+import time
+import numpy as np
+import torch
+import lightning as L
+
+class InMemoryBatches:
+    """
+    Drop-in replacement for DataLoader on small tabular data: the whole
+    dataset stays as two contiguous tensors and each epoch is one index
+    permutation plus a gather per batch (no Dataset.__getitem__, no collate,
+    no workers). Without shuffling, batches are plain slices (views).
+    """
+
+    def __init__(self, X, Y, batch_size=32, shuffle=False, seed=0):
+        self.X = X.contiguous()
+        self.Y = Y.contiguous()
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def __len__(self):
+        return (len(self.X) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n, bs = len(self.X), self.batch_size
+        if not self.shuffle:
+            for start in range(0, n, bs):
+                yield self.X[start:start + bs], self.Y[start:start + bs]
+            return
+        perm = torch.randperm(n, generator=self.generator)
+        for start in range(0, n, bs):
+            idx = perm[start:start + bs]
+            yield self.X[idx], self.Y[idx]
+
+def split_path_for(processed_dir="data/processed"):
+    # Lives next to X_mean.npy / X_std.npy
+    return os.path.join(processed_dir, "split.npz")
+
+def load_or_make_split(n, path, val_frac=0.2, seed=0, resplit=False):
+    """
+    Deterministic train/val split, saved so retraining sees the same rows.
+    A saved split is reused unless the row count changed or resplit is set.
+    """
+    if os.path.exists(path) and not resplit:
+        split = np.load(path)
+        if int(split["n"]) == n:
+            print(f"Using saved split {path} (seed {int(split['seed'])})")
+            return split["train_idx"], split["val_idx"]
+        print(f"Saved split {path} is for {int(split['n'])} rows, data has {n}: re-splitting")
+
+    perm = np.random.default_rng(seed).permutation(n)
+    n_train = int((1 - val_frac) * n)
+    train_idx, val_idx = np.sort(perm[:n_train]), np.sort(perm[n_train:])
+    np.savez(path, train_idx=train_idx, val_idx=val_idx, seed=seed, n=n)
+    print(f"Saved split to {path} ({len(train_idx)} train / {len(val_idx)} val, seed {seed})")
+    return train_idx, val_idx
+
+class Throughput(L.Callback):
+    """Training samples/sec, measured over train epochs only (validation excluded)."""
+
+    def __init__(self, n_train):
+        self.n_train = n_train
+        self.seconds = 0.0
+        self.epochs = 0
+        self._t0 = None
+        self._val_t0 = None
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._t0 = time.perf_counter()
+
+    # Validation runs inside the train epoch, so its time is subtracted
+    def on_validation_epoch_start(self, trainer, pl_module):
+        self._val_t0 = time.perf_counter()
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if self._t0 is not None and not trainer.sanity_checking:
+            self.seconds -= time.perf_counter() - self._val_t0
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        self.seconds += time.perf_counter() - self._t0
+        self.epochs += 1
+
+    def on_fit_end(self, trainer, pl_module):
+        if self.epochs:
+            rate = self.n_train * self.epochs / self.seconds
+            print(f"Throughput: {rate:,.0f} samples/sec ({self.epochs} epochs, {self.seconds:.1f} s in train epochs)")
@@ -3,10 +3,19 @@ import torch
 import torch.nn.functional as F
 from src.models.mlp import SpectrumMLP
 
+LOSSES = {
+    "mse": F.mse_loss,
+    "l1": F.l1_loss,
+    "huber": F.smooth_l1_loss,
+}
+
 class LitSpectrum(L.LightningModule):
-    def __init__(self, in_dim):
+    def __init__(self, in_dim, out_dim=251, hidden=(128, 256), lr=1e-3, loss="mse"):
         super().__init__()
-        self.model = SpectrumMLP(in_dim)
+        self.save_hyperparameters()
+        self.model = SpectrumMLP(in_dim, out_dim, hidden=tuple(hidden))
+        self.lr = lr
+        self.loss_fn = LOSSES[loss]
 
     def forward(self, x):
         return self.model(x)
@@ -14,15 +23,16 @@ class LitSpectrum(L.LightningModule):
     def training_step(self, batch, batch_idx):
         x, y = batch
         y_hat = self(x)
-        loss = F.mse_loss(y_hat, y)
+        loss = self.loss_fn(y_hat, y)
         self.log("train_loss", loss, prog_bar=True)
         return loss
 
     def validation_step(self, batch, batch_idx):
         x, y = batch
         y_hat = self(x)
+        # Always MSE, so runs trained with different losses stay comparable
         loss = F.mse_loss(y_hat, y)
         self.log("val_loss", loss, prog_bar=True)
 
     def configure_optimizers(self):
-        return torch.optim.Adam(self.parameters(), lr=1e-3)
+        return torch.optim.Adam(self.parameters(), lr=self.lr)
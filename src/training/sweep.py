@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import random
+import argparse
+import itertools
+import multiprocessing as mp
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.append(ROOT_DIR)
+from src.training.fast_loop import load_or_make_split, split_path_for
+
+SWEEPS_DIR = os.path.join(ROOT_DIR, "outputs", "sweeps")
+FEATURE_COLS = ["mean_diam_px", "std_diam_px", "particle_count", "mean_aspect"]
+
+# Used when no --space file is given. Lists are grid axes (or sampled
+# uniformly with --method random); {"loguniform": [lo, hi]} only works with random.
+DEFAULT_SPACE = {
+    "hidden": [[128, 256], [256, 256], [128, 256, 256], [64, 128]],
+    "lr": [1e-3, 3e-4],
+    "loss": ["mse", "huber"],
+    "batch_size": [32, 128]
+}
+
+# ---------- Search space ----------
+def expand_space(space, method="grid", n_trials=20, seed=0):
+    keys = sorted(space)
+    if method == "grid":
+        for k in keys:
+            if not isinstance(space[k], list):
+                raise ValueError(f"Grid search needs a list of values for '{k}'")
+        return [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(n_trials):
+        params = {}
+        for k in keys:
+            v = space[k]
+            if isinstance(v, dict) and "loguniform" in v:
+                lo, hi = v["loguniform"]
+                params[k] = float(np.exp(rng.uniform(np.log(lo), np.log(hi))))
+            else:
+                params[k] = rng.choice(v)
+        trials.append(params)
+    return trials
+
+# ---------- Shared data ----------
+def prepare_data(sweep_dir, seed=0):
+    """
+    Normalize once and write X/Y as .npy files every trial opens with
+    mmap_mode="r", so all processes share the same page-cache copy.
+    Uses the saved X_mean/X_std (what inference normalizes with) and the
+    saved train/val split.
+    """
+    processed = os.path.join(ROOT_DIR, "data", "processed")
+    df = pd.read_csv(os.path.join(processed, "morphology_features.csv"))
+    X = df[FEATURE_COLS].values.astype("float32")
+    Y = np.load(os.path.join(processed, "spectra.npy")).astype("float32")
+    X = (X - np.load(os.path.join(processed, "X_mean.npy"))) / np.load(os.path.join(processed, "X_std.npy"))
+
+    data_dir = os.path.join(sweep_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    np.save(os.path.join(data_dir, "X.npy"), np.ascontiguousarray(X, dtype=np.float32))
+    np.save(os.path.join(data_dir, "Y.npy"), np.ascontiguousarray(Y, dtype=np.float32))
+    train_idx, val_idx = load_or_make_split(len(X), split_path_for(processed), seed=seed)
+    np.save(os.path.join(data_dir, "train_idx.npy"), train_idx)
+    np.save(os.path.join(data_dir, "val_idx.npy"), val_idx)
+    return data_dir
+
+# ---------- Trial worker ----------
+def _init_worker(threads):
+    # Concurrent trials would oversubscribe the cores; tiny matmuls don't benefit from more threads anyway
+    import torch
+    torch.set_num_threads(threads)
+
+def _median_stopping_callback(sweep_dir, trial_id, warmup, interval):
+    import lightning as L
+
+    class MedianStopping(L.Callback):
+        """
+        Stop this trial if its best val_loss so far is worse than the median
+        of finished trials' best val_loss at the same epoch.
+        """
+
+        def __init__(self):
+            self.curve = []
+            self.pruned = False
+
+        def on_validation_epoch_end(self, trainer, pl_module):
+            if trainer.sanity_checking:
+                return
+            self.curve.append(float(trainer.callback_metrics["val_loss"]))
+            epoch = len(self.curve)
+            if epoch < warmup or epoch % interval:
+                return
+            others = []
+            for path in glob.glob(os.path.join(sweep_dir, "trial_*", "curve.json")):
+                if os.path.basename(os.path.dirname(path)) == trial_id:
+                    continue
+                with open(path) as f:
+                    curve = json.load(f)
+                if len(curve) >= epoch:
+                    others.append(min(curve[:epoch]))
+            if len(others) >= 2 and min(self.curve) > float(np.median(others)):
+                self.pruned = True
+                trainer.should_stop = True
+
+    return MedianStopping()
+
+def run_trial(trial_id, params, data_dir, sweep_dir, epochs, patience, warmup, interval, seed):
+    import torch
+    import lightning as L
+    from lightning.pytorch.callbacks import EarlyStopping, ModelCheckpoint
+    from src.training.lightning_module import LitSpectrum
+    from src.training.fast_loop import InMemoryBatches
+
+    trial_dir = os.path.join(sweep_dir, trial_id)
+    os.makedirs(trial_dir, exist_ok=True)
+    t0 = time.time()
+    L.seed_everything(seed, verbose=False)
+
+    # Views of the shared memory map; only this trial's train/val rows are gathered
+    X = np.load(os.path.join(data_dir, "X.npy"), mmap_mode="r")
+    Y = np.load(os.path.join(data_dir, "Y.npy"), mmap_mode="r")
+    train_idx = np.load(os.path.join(data_dir, "train_idx.npy"))
+    val_idx = np.load(os.path.join(data_dir, "val_idx.npy"))
+    batch_size = int(params.get("batch_size", 32))
+    train_loader = InMemoryBatches(torch.from_numpy(X[train_idx]), torch.from_numpy(Y[train_idx]),
+                                   batch_size=batch_size, shuffle=True, seed=seed)
+    val_loader = InMemoryBatches(torch.from_numpy(X[val_idx]), torch.from_numpy(Y[val_idx]), batch_size=batch_size)
+
+    model = LitSpectrum(in_dim=X.shape[1], out_dim=Y.shape[1],
+                        hidden=tuple(params.get("hidden", (128, 256))),
+                        lr=float(params.get("lr", 1e-3)), loss=params.get("loss", "mse"))
+
+    early = EarlyStopping(monitor="val_loss", patience=patience, mode="min")
+    median = _median_stopping_callback(sweep_dir, trial_id, warmup, interval)
+    best = ModelCheckpoint(dirpath=trial_dir, filename="best", monitor="val_loss", mode="min", save_top_k=1)
+    trainer = L.Trainer(
+        max_epochs=epochs,
+        accelerator="cpu",
+        devices=1,
+        logger=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+        callbacks=[early, median, best]
+    )
+    trainer.fit(model, train_loader, val_loader)
+
+    # Plain SpectrumMLP state dict of the best epoch, same format as train.py output
+    ckpt = torch.load(best.best_model_path, map_location="cpu", weights_only=False)
+    state_dict = {k[len("model."):]: v for k, v in ckpt["state_dict"].items() if k.startswith("model.")}
+    model_path = os.path.join(trial_dir, "model.pth")
+    torch.save(state_dict, model_path)
+    os.remove(best.best_model_path)
+
+    with open(os.path.join(trial_dir, "curve.json"), "w") as f:
+        json.dump(median.curve, f)
+
+    if median.pruned:
+        status = "pruned"
+    elif early.stopped_epoch > 0:
+        status = "early_stopped"
+    else:
+        status = "completed"
+    result = {
+        "trial": trial_id,
+        "params": params,
+        "status": status,
+        "best_val_loss": float(best.best_model_score),
+        "best_epoch": int(np.argmin(median.curve)) + 1,
+        "epochs_run": len(median.curve),
+        "seconds": round(time.time() - t0, 2),
+        "model_path": os.path.relpath(model_path, ROOT_DIR)
+    }
+    with open(os.path.join(trial_dir, "result.json"), "w") as f:
+        json.dump(result, f, indent=2)
+    return result
+
+# ---------- Driver ----------
+def write_leaderboard(sweep_dir, results):
+    ranked = sorted([r for r in results if "best_val_loss" in r], key=lambda r: r["best_val_loss"])
+    failed = [r for r in results if "best_val_loss" not in r]
+    for rank, r in enumerate(ranked, 1):
+        r["rank"] = rank
+    with open(os.path.join(sweep_dir, "leaderboard.json"), "w") as f:
+        json.dump({"trials": ranked, "failed": failed}, f, indent=2)
+    rows = [{"rank": r["rank"], "trial": r["trial"], "best_val_loss": r["best_val_loss"], "status": r["status"],
+             "best_epoch": r["best_epoch"], "epochs_run": r["epochs_run"], "seconds": r["seconds"],
+             **{k: json.dumps(v) if isinstance(v, list) else v for k, v in r["params"].items()}} for r in ranked]
+    pd.DataFrame(rows).to_csv(os.path.join(sweep_dir, "leaderboard.csv"), index=False)
+    return ranked
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel hyperparameter sweep for LitSpectrum")
+    parser.add_argument("--space", type=str, default=None, help="Search space JSON (default: built-in DEFAULT_SPACE)")
+    parser.add_argument("--method", type=str, default="grid", choices=["grid", "random"])
+    parser.add_argument("--n_trials", type=int, default=20, help="Trials to sample with --method random")
+    parser.add_argument("--epochs", type=int, default=300)
+    parser.add_argument("--patience", type=int, default=20, help="EarlyStopping patience on val_loss (epochs)")
+    parser.add_argument("--prune_warmup", type=int, default=30, help="Epochs before median stopping can prune a trial")
+    parser.add_argument("--prune_every", type=int, default=10, help="Median stopping check interval (epochs)")
+    parser.add_argument("--workers", type=int, default=None, help="Concurrent trials (default: cores / threads)")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per trial")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--name", type=str, default=None, help="Sweep id (default: timestamp)")
+    parser.add_argument("--register", type=str, default=None, metavar="MODEL_NAME",
+                        help="Register the best trial into models/registered under this name")
+    args = parser.parse_args()
+
+    space = DEFAULT_SPACE
+    if args.space:
+        with open(args.space) as f:
+            space = json.load(f)
+    trials = expand_space(space, args.method, args.n_trials, args.seed)
+    workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads)
+
+    sweep_id = args.name or datetime.now().strftime("%Y%m%d_%H%M%S")
+    sweep_dir = os.path.join(SWEEPS_DIR, sweep_id)
+    os.makedirs(sweep_dir, exist_ok=True)
+    with open(os.path.join(sweep_dir, "config.json"), "w") as f:
+        json.dump({"space": space, **{k: v for k, v in vars(args).items() if k != "space"}, "workers": workers}, f, indent=2)
+    data_dir = prepare_data(sweep_dir, args.seed)
+    print(f"Sweep {sweep_id}: {len(trials)} trials, {workers} workers x {args.threads} threads")
+
+    results = []
+    # spawn: trials must not inherit a forked torch/OpenMP state
+    ctx = mp.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker, initargs=(args.threads,)) as pool:
+        futures = {}
+        for i, params in enumerate(trials):
+            trial_id = f"trial_{i:03d}"
+            futures[pool.submit(run_trial, trial_id, params, data_dir, sweep_dir, args.epochs, args.patience,
+                                args.prune_warmup, args.prune_every, args.seed)] = (trial_id, params)
+        for future in as_completed(futures):
+            trial_id, params = futures[future]
+            try:
+                r = future.result()
+                print(f"  {trial_id} {r['status']:<13} val_loss={r['best_val_loss']:.6f} "
+                      f"epochs={r['epochs_run']} {r['seconds']:.0f}s {params}")
+            except Exception as e:
+                r = {"trial": trial_id, "params": params, "status": "failed", "error": str(e)}
+                print(f"  {trial_id} failed: {e}")
+            results.append(r)
+
+    ranked = write_leaderboard(sweep_dir, results)
+    print(f"\nLeaderboard ({os.path.relpath(sweep_dir, ROOT_DIR)}/leaderboard.csv):")
+    for r in ranked[:10]:
+        print(f"  #{r['rank']:<3} {r['trial']}  val_loss={r['best_val_loss']:.6f}  {r['status']:<13} {r['params']}")
+
+    if args.register and ranked:
+        from src.eval.register_uploads import register_model, MODELS_DIR
+        best = ranked[0]
+        src = os.path.join(sweep_dir, f"{args.register}.pth")
+        if os.path.exists(os.path.join(MODELS_DIR, os.path.basename(src))):
+            print(f"models/registered/{args.register}.pth already exists; not overwriting")
+            return
+        shutil.copy2(os.path.join(ROOT_DIR, best["model_path"]), src)
+        register_model(src, args.register, origin="sweep",
+                       notes=f"Best of sweep {sweep_id} ({best['trial']})",
+                       extra={"metrics": {"val_loss": best["best_val_loss"], "best_epoch": best["best_epoch"]},
+                              "hparams": best["params"], "sweep": sweep_id})
+
+if __name__ == "__main__":
+    main()
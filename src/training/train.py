@@ -1,50 +1,120 @@
+import os
+import argparse
 import pandas as pd
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, TensorDataset, random_split
+from torch.utils.data import DataLoader, TensorDataset, Subset
 import lightning as L
-from src.training.lightning_module import LitSpectrum
+from lightning.pytorch.callbacks import TQDMProgressBar
+from src.training.lightning_module import LitSpectrum, LOSSES
+from src.training.fast_loop import InMemoryBatches, Throughput, load_or_make_split, split_path_for
+from src.models.basis import SpectralBasis, basis_path_for
+from src.eval.similarity import SimilarityIndex, index_path_for, source_hash
 
-# Load data
-df = pd.read_csv("data/processed/morphology_features.csv")
+def main():
+    parser = argparse.ArgumentParser(description="Train the morphology -> spectrum surrogate")
+    parser.add_argument("--basis", type=str, default="none", choices=["none", "pca"],
+                        help="Regress K basis coefficients instead of the full spectrum")
+    parser.add_argument("--k", type=int, default=16, help="Number of basis coefficients (with --basis pca)")
+    parser.add_argument("--epochs", type=int, default=300)
+    parser.add_argument("--hidden", type=str, default="128,256", help="Comma-separated hidden layer widths")
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--loss", type=str, default="mse", choices=sorted(LOSSES))
+    parser.add_argument("--out", type=str, default="outputs/spectrum_mlp.pth", help="Where to save the final state dict")
+    parser.add_argument("--loader", type=str, default="dataloader", choices=["dataloader", "memory"],
+                        help="memory: contiguous tensors + per-epoch index permutation, no DataLoader")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0, help="Seeds the split, init and shuffling")
+    parser.add_argument("--resplit", action="store_true", help="Draw a new train/val split instead of reusing the saved one")
+    parser.add_argument("--profiler", type=str, default=None, choices=["simple", "advanced"], help="Lightning profiler report")
+    parser.add_argument("--ensemble", type=int, default=1,
+                        help="Train K members (seeds seed..seed+K-1), saved as <out>_m<i>.pth")
+    args = parser.parse_args()
 
-X = df[["mean_diam_px","std_diam_px","particle_count","mean_aspect"]].values.astype("float32")
-Y = np.load("data/processed/spectra.npy").astype("float32")
+    L.seed_everything(args.seed)
 
-# Normalize inputs (important)
-X_mean = X.mean(axis=0)
-X_std = X.std(axis=0) + 1e-8
-X = (X - X_mean) / X_std
+    # Load data
+    df = pd.read_csv("data/processed/morphology_features.csv")
 
-# Save normalization params
-np.save("data/processed/X_mean.npy", X_mean)
-np.save("data/processed/X_std.npy", X_std)
+    X_raw = df[["mean_diam_px","std_diam_px","particle_count","mean_aspect"]].values.astype("float32")
+    Y = np.load("data/processed/spectra.npy").astype("float32")
 
-X = torch.tensor(X)
-Y = torch.tensor(Y)
+    # Normalize inputs (important)
+    X_mean = X_raw.mean(axis=0)
+    X_std = X_raw.std(axis=0) + 1e-8
+    X = (X_raw - X_mean) / X_std
 
-dataset = TensorDataset(X, Y)
+    # Save normalization params
+    np.save("data/processed/X_mean.npy", X_mean)
+    np.save("data/processed/X_std.npy", X_std)
 
-# Split
-train_size = int(0.8 * len(dataset))
-val_size = len(dataset) - train_size
-train_ds, val_ds = random_split(dataset, [train_size, val_size])
+    # Nearest-training-sample index (served by the API next to predictions)
+    index = SimilarityIndex.build(X_raw, Y, np.load("data/processed/wavelengths.npy"), X_mean, X_std,
+                                  df["image_path"].values, source=source_hash("."))
+    index.save(index_path_for("."))
+    print(f"Saved similarity index ({len(index)} samples) to {index_path_for('.')}")
 
-train_loader = DataLoader(train_ds, batch_size=32, shuffle=True)
-val_loader = DataLoader(val_ds, batch_size=32)
+    # Optional compact output head: fit the basis on all spectra, train on coefficients
+    basis = None
+    if args.basis == "pca":
+        basis = SpectralBasis.fit_pca(Y, k=args.k)
+        Y = basis.encode(Y)
 
-# Model
-model = LitSpectrum(in_dim=X.shape[1])
+    X = torch.tensor(X)
+    Y = torch.tensor(Y)
 
-# Trainer
-trainer = L.Trainer(
-    max_epochs=300,
-    accelerator="auto",
-    devices="auto"
-)
+    # Split (saved next to X_mean.npy, reused on retraining)
+    train_idx, val_idx = load_or_make_split(len(X), split_path_for(), seed=args.seed, resplit=args.resplit)
 
-trainer.fit(model, train_loader, val_loader)
+    if args.loader == "memory":
+        train_loader = InMemoryBatches(X[train_idx], Y[train_idx], batch_size=args.batch_size, shuffle=True, seed=args.seed)
+        val_loader = InMemoryBatches(X[val_idx], Y[val_idx], batch_size=args.batch_size)
+    else:
+        dataset = TensorDataset(X, Y)
+        train_loader = DataLoader(Subset(dataset, train_idx.tolist()), batch_size=args.batch_size, shuffle=True)
+        val_loader = DataLoader(Subset(dataset, val_idx.tolist()), batch_size=args.batch_size)
 
-# Save final model
-torch.save(model.model.state_dict(), "outputs/spectrum_mlp.pth")
-print("Saved model to outputs/spectrum_mlp.pth")
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    hidden = tuple(int(h) for h in args.hidden.split(","))
+    stem, ext = os.path.splitext(args.out)
+    outs = [args.out] if args.ensemble == 1 else [f"{stem}_m{i}{ext}" for i in range(args.ensemble)]
+
+    for i, out in enumerate(outs):
+        # Ensemble members differ only in seed: init and shuffling order
+        if i > 0:
+            L.seed_everything(args.seed + i)
+            if args.loader == "memory":
+                train_loader.generator.manual_seed(args.seed + i)
+
+        # Model
+        model = LitSpectrum(in_dim=X.shape[1], out_dim=Y.shape[1], hidden=hidden, lr=args.lr, loss=args.loss)
+
+        callbacks = [Throughput(len(train_idx))]
+        if args.loader == "memory":
+            # Per-step tqdm redraws cost about as much as the data; refresh once per epoch
+            callbacks.append(TQDMProgressBar(refresh_rate=len(train_loader)))
+
+        # Trainer
+        trainer = L.Trainer(
+            max_epochs=args.epochs,
+            accelerator="auto",
+            devices="auto",
+            profiler=args.profiler,
+            callbacks=callbacks
+        )
+
+        trainer.fit(model, train_loader, val_loader)
+
+        # Save final model (+ basis sidecar, needed to reconstruct spectra at inference)
+        torch.save(model.model.state_dict(), out)
+        print(f"Saved model to {out}")
+        if basis is not None:
+            basis.save(basis_path_for(out))
+            print(f"Saved {args.basis} basis (k={basis.k}) to {basis_path_for(out)}")
+
+    if len(outs) > 1:
+        print("Register the ensemble with:")
+        print(f"  python -m src.eval.register_uploads --export_only --ensemble NAME {' '.join(outs)}")
+
+if __name__ == "__main__":
+    main()
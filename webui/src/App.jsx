@@ -32,47 +32,14 @@ function App() {
     const mockFile = new File([], item.name, { type: 'image/tiff' });
     mockFile.datasetItem = item;
     setFile(mockFile);
+    setShowResults(false);
+    setPrediction(null);
     setShowDatasetBrowser(false);
     scrollToWorkspace();
   };
 
-  // Generate a realistic simulated spectrum based on dataset metadata
-  const generateSimulatedPrediction = (datasetItem) => {
-    const peakNm = parseFloat(datasetItem.peak);
-    const sizeNm = parseFloat(datasetItem.size);
-
-    const wavelengths = [];
-    const spectrum = [];
-
-    for (let w = 400; w <= 900; w += 2) {
-      wavelengths.push(w);
-      const gamma = 20 + sizeNm * 0.5;
-      const amplitude = 0.8 + (Math.random() * 0.1);
-      const lorentzian = amplitude * (gamma * gamma) / ((w - peakNm) * (w - peakNm) + gamma * gamma);
-      const noise = (Math.random() - 0.5) * 0.002;
-      spectrum.push(Math.max(0, lorentzian + noise + 0.001));
-    }
-
-    const fwhm = 2 * (20 + sizeNm * 0.5);
-
-    // Dynamic confidence based on particle size and material
-    const baseConfidence = 75 + Math.random() * 10;
-    const sizeBonus = Math.min(sizeNm / 5, 10);
-    const materialBonus = datasetItem.material === 'Gold' ? 3 : 0;
-    const confidence = Math.min(98, Math.round(baseConfidence + sizeBonus + materialBonus));
-
-    return {
-      wavelengths,
-      spectrum,
-      peak: peakNm,
-      fwhm: Math.round(fwhm * 10) / 10,
-      confidence,
-      features: { size: `${sizeNm} nm`, material: datasetItem.material }
-    };
-  };
-
   useEffect(() => {
-    if (file && !file.datasetItem && showResults) {
+    if (file && showResults) {
       handlePredict();
     }
   }, [selectedModel]);
@@ -85,9 +52,15 @@ function App() {
       let data;
 
       if (file.datasetItem) {
-        // Sample dataset - generate simulated prediction
-        await new Promise(resolve => setTimeout(resolve, 1200));
-        data = generateSimulatedPrediction(file.datasetItem);
+        // Dataset image - prediction is precomputed on the server
+        const response = await fetch(`http://localhost:8000/dataset/${file.datasetItem.id}/prediction?model=${selectedModel}`);
+
+        if (!response.ok) {
+          const err = await response.json();
+          throw new Error(err.detail || "Prediction failed");
+        }
+
+        data = await response.json();
       } else {
         // Real file - call API
         const formData = new FormData();
@@ -175,7 +148,7 @@ function App() {
                 <div className="grid lg:grid-cols-12 gap-6">
                   {/* Image Viewer */}
                   <div className="lg:col-span-8">
-                    <ImageViewer imageSrc={file && !file.datasetItem ? URL.createObjectURL(file) : null} />
+                    <ImageViewer imageSrc={file ? (file.datasetItem ? file.datasetItem.imageUrl : URL.createObjectURL(file)) : null} />
                   </div>
 
                   {/* Controls */}
@@ -292,6 +265,7 @@ function App() {
         isOpen={showDatasetBrowser}
         onClose={() => setShowDatasetBrowser(false)}
         onSelectFile={handleDatasetSelect}
+        selectedModel={selectedModel}
       />
 
       {/* Footer */}
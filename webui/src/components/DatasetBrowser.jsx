@@ -1,20 +1,74 @@
-import React from 'react';
+import React, { useState, useEffect } from 'react';
 import { motion, AnimatePresence } from 'framer-motion';
-import { X } from 'lucide-react';
-
-// Sample dataset with TEM images info (only 6 items, no bottom buttons)
-const sampleDataset = [
-    { id: 1, name: 'Au_40nm_sample1.tif', material: 'Gold', size: '40 nm', peak: '532 nm', thumbnail: '🔬' },
-    { id: 2, name: 'Au_60nm_sample2.tif', material: 'Gold', size: '60 nm', peak: '548 nm', thumbnail: '🔬' },
-    { id: 3, name: 'Ag_30nm_sample1.tif', material: 'Silver', size: '30 nm', peak: '410 nm', thumbnail: '🔬' },
-    { id: 4, name: 'Au_20nm_sample3.tif', material: 'Gold', size: '20 nm', peak: '518 nm', thumbnail: '🔬' },
-    { id: 5, name: 'Ag_50nm_sample2.tif', material: 'Silver', size: '50 nm', peak: '435 nm', thumbnail: '🔬' },
-    { id: 6, name: 'Au_80nm_sample4.tif', material: 'Gold', size: '80 nm', peak: '565 nm', thumbnail: '🔬' },
-];
-
-export default function DatasetBrowser({ isOpen, onClose, onSelectFile }) {
+import { X, Search, ChevronLeft, ChevronRight } from 'lucide-react';
+
+const API_URL = 'http://localhost:8000';
+const PAGE_SIZE = 24;
+
+// Browsers cannot display TIFF, so those fall back to the server thumbnail
+const isWebImage = (name) => /\.(png|jpe?g)$/i.test(name);
+
+export default function DatasetBrowser({ isOpen, onClose, onSelectFile, selectedModel }) {
+    const [items, setItems] = useState([]);
+    const [total, setTotal] = useState(0);
+    const [page, setPage] = useState(0);
+    const [search, setSearch] = useState('');
+    const [query, setQuery] = useState('');
+    const [loading, setLoading] = useState(false);
+    const [error, setError] = useState(null);
+
+    // Debounce the search box so typing does not fire a request per key
+    useEffect(() => {
+        const t = setTimeout(() => {
+            setQuery(search.trim());
+            setPage(0);
+        }, 250);
+        return () => clearTimeout(t);
+    }, [search]);
+
+    useEffect(() => {
+        if (!isOpen) return;
+        const controller = new AbortController();
+        const params = new URLSearchParams({ offset: page * PAGE_SIZE, limit: PAGE_SIZE });
+        if (query) params.set('q', query);
+        if (selectedModel) params.set('model', selectedModel);
+
+        setLoading(true);
+        setError(null);
+        fetch(`${API_URL}/dataset?${params}`, { signal: controller.signal })
+            .then(async (response) => {
+                if (!response.ok) {
+                    const err = await response.json();
+                    throw new Error(err.detail || 'Could not load dataset');
+                }
+                return response.json();
+            })
+            .then((data) => {
+                setItems(data.items);
+                setTotal(data.total);
+                setLoading(false);
+            })
+            .catch((err) => {
+                if (err.name === 'AbortError') return;
+                setError(err.message);
+                setLoading(false);
+            });
+        return () => controller.abort();
+    }, [isOpen, page, query, selectedModel]);
+
     if (!isOpen) return null;
 
+    const pages = Math.max(1, Math.ceil(total / PAGE_SIZE));
+
+    const select = (item) => {
+        const thumbnailUrl = `${API_URL}/dataset/${item.id}/thumbnail`;
+        onSelectFile({
+            ...item,
+            thumbnailUrl,
+            imageUrl: isWebImage(item.name) ? `${API_URL}/dataset/${item.id}/image` : thumbnailUrl,
+        });
+    };
+
     return (
         <AnimatePresence>
             <motion.div
@@ -34,7 +88,7 @@ export default function DatasetBrowser({ isOpen, onClose, onSelectFile }) {
 
                 {/* Modal */}
                 <motion.div
-                    className="relative w-full max-w-3xl overflow-hidden rounded-3xl"
+                    className="relative w-full max-w-4xl overflow-hidden rounded-3xl"
                     style={{
                         background: 'linear-gradient(180deg, rgba(15,20,25,0.98) 0%, rgba(7,9,11,1) 100%)',
                         border: '1px solid rgba(255,255,255,0.06)',
@@ -48,8 +102,10 @@ export default function DatasetBrowser({ isOpen, onClose, onSelectFile }) {
                     {/* Header */}
                     <div className="px-8 py-6 border-b border-[rgba(255,255,255,0.04)] flex items-center justify-between">
                         <div>
-                            <h2 className="text-2xl font-bold text-white tracking-tight">Sample Dataset</h2>
-                            <p className="text-sm text-[#98a6b0] mt-1">Select a TEM micrograph to analyze</p>
+                            <h2 className="text-2xl font-bold text-white tracking-tight">Training Dataset</h2>
+                            <p className="text-sm text-[#98a6b0] mt-1">
+                                {total.toLocaleString()} TEM micrographs{query ? ` matching "${query}"` : ''}
+                            </p>
                         </div>
                         <motion.button
                             onClick={onClose}
@@ -61,10 +117,30 @@ export default function DatasetBrowser({ isOpen, onClose, onSelectFile }) {
                         </motion.button>
                     </div>
 
+                    {/* Search */}
+                    <div className="px-8 pt-6">
+                        <div
+                            className="flex items-center gap-2 rounded-xl px-3 py-2"
+                            style={{ background: 'rgba(255,255,255,0.02)', border: '1px solid rgba(255,255,255,0.05)' }}
+                        >
+                            <Search size={16} className="text-[#5a6570]" />
+                            <input
+                                value={search}
+                                onChange={(e) => setSearch(e.target.value)}
+                                placeholder="Filter by file or folder name"
+                                className="flex-1 bg-transparent text-sm text-white placeholder-[#5a6570] outline-none"
+                            />
+                        </div>
+                    </div>
+
                     {/* Dataset Grid */}
-                    <div className="p-8">
-                        <div className="grid grid-cols-3 gap-4">
-                            {sampleDataset.map((item, index) => (
+                    <div className="p-8 max-h-[60vh] overflow-y-auto">
+                        {error && <p className="text-sm text-[#ff6b6b] text-center">{error}</p>}
+                        {!error && !loading && items.length === 0 && (
+                            <p className="text-sm text-[#98a6b0] text-center">No images found</p>
+                        )}
+                        <div className="grid grid-cols-4 gap-4" style={{ opacity: loading ? 0.5 : 1 }}>
+                            {items.map((item, index) => (
                                 <motion.div
                                     key={item.id}
                                     className="rounded-2xl p-4 cursor-pointer group relative overflow-hidden"
@@ -74,13 +150,13 @@ export default function DatasetBrowser({ isOpen, onClose, onSelectFile }) {
                                     }}
                                     initial={{ opacity: 0, y: 20 }}
                                     animate={{ opacity: 1, y: 0 }}
-                                    transition={{ delay: index * 0.06, ease: [0.16, 0.84, 0.44, 1] }}
+                                    transition={{ delay: index * 0.02, ease: [0.16, 0.84, 0.44, 1] }}
                                     whileHover={{
                                         scale: 1.02,
                                         y: -4,
                                         boxShadow: '0 20px 40px rgba(0,212,192,0.1)',
                                     }}
-                                    onClick={() => onSelectFile(item)}
+                                    onClick={() => select(item)}
                                 >
                                     {/* Hover glow */}
                                     <motion.div
@@ -94,43 +170,71 @@ export default function DatasetBrowser({ isOpen, onClose, onSelectFile }) {
 
                                     {/* Thumbnail */}
                                     <div
-                                        className="relative h-24 rounded-xl mb-3 flex items-center justify-center text-3xl"
+                                        className="relative h-24 rounded-xl mb-3 flex items-center justify-center text-3xl overflow-hidden"
                                         style={{
                                             background: 'radial-gradient(ellipse at center, rgba(0,212,192,0.08) 0%, rgba(7,9,11,0.8) 100%)',
                                             border: '1px solid rgba(255,255,255,0.03)',
                                         }}
                                     >
-                                        <motion.span
-                                            className="group-hover:scale-110 transition-transform duration-300"
-                                        >
-                                            {item.thumbnail}
-                                        </motion.span>
+                                        {item.has_image ? (
+                                            <img
+                                                src={`${API_URL}/dataset/${item.id}/thumbnail`}
+                                                alt={item.name}
+                                                loading="lazy"
+                                                className="w-full h-full object-cover group-hover:scale-110 transition-transform duration-300"
+                                            />
+                                        ) : (
+                                            <span>🔬</span>
+                                        )}
                                     </div>
 
                                     {/* Info */}
                                     <h4 className="relative font-medium text-white text-sm truncate">{item.name}</h4>
                                     <div className="relative mt-2 flex items-center gap-2">
                                         <span
-                                            className="px-2 py-0.5 rounded-full text-[10px] font-medium"
+                                            className="px-2 py-0.5 rounded-full text-[10px] font-medium truncate"
                                             style={{
-                                                background: item.material === 'Gold' ? 'rgba(255,200,0,0.12)' : 'rgba(192,192,192,0.12)',
-                                                color: item.material === 'Gold' ? '#ffd700' : '#c0c0c0',
-                                                border: `1px solid ${item.material === 'Gold' ? 'rgba(255,200,0,0.25)' : 'rgba(192,192,192,0.25)'}`,
+                                                background: 'rgba(0,212,192,0.08)',
+                                                color: '#7fe8dc',
+                                                border: '1px solid rgba(0,212,192,0.2)',
                                             }}
                                         >
-                                            {item.material}
+                                            {item.folder}
                                         </span>
-                                        <span className="text-xs text-[#98a6b0]">{item.size}</span>
+                                        <span className="text-xs text-[#98a6b0] shrink-0">{item.features.count} particles</span>
+                                    </div>
+                                    <div className="relative mt-2 flex items-center justify-between text-xs">
+                                        <span className="text-[#98a6b0]">Ø {item.features.mean_diameter.toFixed(1)} px</span>
+                                        {item.peak !== undefined && (
+                                            <span className="font-medium text-[#00d4c0]">Peak: {Math.round(item.peak)} nm</span>
+                                        )}
                                     </div>
-                                    <div className="relative mt-2 text-xs font-medium text-[#00d4c0]">Peak: {item.peak}</div>
                                 </motion.div>
                             ))}
                         </div>
                     </div>
 
-                    {/* Subtle footer */}
-                    <div className="px-8 py-4 border-t border-[rgba(255,255,255,0.03)] text-center">
-                        <p className="text-xs text-[#5a6570]">Click any sample to load it into the analyzer</p>
+                    {/* Pagination */}
+                    <div className="px-8 py-4 border-t border-[rgba(255,255,255,0.03)] flex items-center justify-between">
+                        <motion.button
+                            onClick={() => setPage((p) => Math.max(0, p - 1))}
+                            disabled={page === 0}
+                            className="p-2 rounded-lg text-[#98a6b0] hover:text-white hover:bg-[rgba(255,255,255,0.05)] disabled:opacity-30 transition-all"
+                            whileTap={{ scale: 0.9 }}
+                        >
+                            <ChevronLeft size={18} />
+                        </motion.button>
+                        <p className="text-xs text-[#5a6570]">
+                            Page {page + 1} of {pages} · click any image to load it into the analyzer
+                        </p>
+                        <motion.button
+                            onClick={() => setPage((p) => Math.min(pages - 1, p + 1))}
+                            disabled={page >= pages - 1}
+                            className="p-2 rounded-lg text-[#98a6b0] hover:text-white hover:bg-[rgba(255,255,255,0.05)] disabled:opacity-30 transition-all"
+                            whileTap={{ scale: 0.9 }}
+                        >
+                            <ChevronRight size={18} />
+                        </motion.button>
                     </div>
                 </motion.div>
             </motion.div>
@@ -120,7 +120,7 @@ export default function UploadDropzone({ onFile, file }) {
                                 style={{ border: '1px solid rgba(255,255,255,0.05)' }}
                             >
                                 <img
-                                    src={URL.createObjectURL(file)}
+                                    src={file.datasetItem ? file.datasetItem.thumbnailUrl : URL.createObjectURL(file)}
                                     alt="Preview"
                                     className="w-full h-full object-cover"
                                 />
@@ -128,7 +128,7 @@ export default function UploadDropzone({ onFile, file }) {
                             <div className="flex-1 min-w-0">
                                 <p className="font-medium text-white text-sm truncate">{file.name}</p>
                                 <p className="text-xs text-[#98a6b0] mt-0.5">
-                                    {(file.size / 1024 / 1024).toFixed(2)} MB
+                                    {file.datasetItem ? `Dataset: ${file.datasetItem.folder}` : `${(file.size / 1024 / 1024).toFixed(2)} MB`}
                                 </p>
                                 <div className="flex items-center gap-1.5 mt-1">
                                     <div className="w-1.5 h-1.5 rounded-full bg-[#00d4c0]" />